@@ -30,6 +30,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    "surveys.metrics.RequestMetricsMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -86,6 +87,22 @@ else:
         }
     }
 
+# Cache
+# Use a shared backend (Redis/Memcached) in production so every worker sees the same
+# survey schema versions.
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default='encuestasite'),
+    }
+}
+
+# Per-view latency/query metrics exposed at /metrics/ (staff only)
+SURVEYS_METRICS_ENABLED = config('SURVEYS_METRICS_ENABLED', default=True, cast=bool)
+# With several workers, point this at a directory outside the source tree (e.g. /var/lib/encuestasite/metrics):
+# each worker writes its totals there and /metrics/ adds them up. Empty keeps them per process
+SURVEYS_METRICS_DIR = config('SURVEYS_METRICS_DIR', default='')
+
 AUTH_PASSWORD_VALIDATORS = []
 
 LANGUAGE_CODE = 'es-es'
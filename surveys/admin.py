@@ -2,6 +2,7 @@ from django.contrib import admin
 from django import forms
 from .models import Survey, Section, Question, Option, Interviewer, ResponseSet, Answer, Municipio, Ubicacion, UbicacionListFile # Updated import
 from .forms import QuestionAdminForm
+from .persistence import delete_responses
 
 class OptionInline(admin.TabularInline):
     model = Option
@@ -124,6 +125,10 @@ class ResponseSetAdmin(admin.ModelAdmin):
     search_fields = ("identificacion", "full_name", "email", "phone")
     inlines = [AnswerInline]
 
+    def delete_queryset(self, request, queryset):
+        # "Eliminar seleccionados": update the stats rollups once, not per response
+        delete_responses(queryset)
+
 @admin.register(Answer)
 class AnswerAdmin(admin.ModelAdmin):
     list_display = ("response", "question")
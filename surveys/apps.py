@@ -1,6 +1,8 @@
-
 from django.apps import AppConfig
 
 class SurveysConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'surveys'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,52 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+
+
+class LocalLRUCache:
+    """Small thread-safe, process-local LRU that sits in front of Django's cache."""
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def get_version(key):
+    """Current value of a version counter stored in Django's cache."""
+    version = cache.get(key)
+    if version is None:
+        # Seed with a timestamp so a flushed cache never hands out an old version again
+        version = int(time.time() * 1000)
+        if not cache.add(key, version, timeout=None):
+            version = cache.get(key, version)
+    return version
+
+
+def bump_version(key):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # The counter was evicted: seeding it again already yields a fresh version
+        return get_version(key)
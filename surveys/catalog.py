@@ -0,0 +1,196 @@
+"""
+Versioned Municipio/Ubicacion catalog.
+
+Every change to a Municipio or Ubicacion bumps the catalog version (see signals.py), so
+any payload derived from the catalog can be cached forever under its version and served
+with a strong ETag. Bodies are kept both plain and gzip-compressed.
+"""
+import gzip
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
+
+from .caching import LocalLRUCache, bump_version, get_version
+from .models import Municipio, Ubicacion
+
+CATALOG_VERSION_KEY = 'surveys:catalog:version'
+CATALOG_CACHE_TIMEOUT = getattr(settings, 'SURVEY_CATALOG_CACHE_TIMEOUT', 60 * 60 * 24)
+
+_local_payloads = LocalLRUCache(maxsize=getattr(settings, 'SURVEY_CATALOG_LOCAL_CACHE_SIZE', 256))
+_local_catalogs = LocalLRUCache(maxsize=2)
+
+
+def get_catalog_version():
+    return get_version(CATALOG_VERSION_KEY)
+
+
+def bump_catalog_version():
+    return bump_version(CATALOG_VERSION_KEY)
+
+
+class Catalog:
+    """In-memory snapshot of every municipio and its ubicaciones for one catalog version."""
+
+    def __init__(self, version, municipios, ubicaciones):
+        self.version = version
+        # ((id, nombre), ...) ordered by nombre
+        self.municipios = tuple(municipios)
+        # municipio id -> ((id, nombre, loc, zona), ...) ordered by nombre
+        self.ubicaciones_by_municipio = {}
+        for ubicacion in ubicaciones:
+            self.ubicaciones_by_municipio.setdefault(ubicacion[0], []).append(tuple(ubicacion[1:]))
+        self.ubicaciones_by_municipio = {k: tuple(v) for k, v in self.ubicaciones_by_municipio.items()}
+        self.ubicaciones_by_id = {u[0]: u for rows in self.ubicaciones_by_municipio.values() for u in rows}
+        self.municipio_by_ubicacion = {
+            u[0]: municipio_id for municipio_id, rows in self.ubicaciones_by_municipio.items() for u in rows
+        }
+
+    def ubicaciones(self, municipio_id):
+        try:
+            return self.ubicaciones_by_municipio.get(int(municipio_id), ())
+        except (TypeError, ValueError):
+            return ()
+
+    def ubicacion(self, ubicacion_id):
+        """``(id, nombre, loc, zona)`` or None."""
+        try:
+            return self.ubicaciones_by_id.get(int(ubicacion_id))
+        except (TypeError, ValueError):
+            return None
+
+    def municipio_of(self, ubicacion_id):
+        return self.municipio_by_ubicacion.get(ubicacion_id)
+
+    def as_bundle(self):
+        """JSON-ready bundle loaded once by the fill pages."""
+        return {
+            'version': self.version,
+            'municipios': [
+                {'id': pk, 'nombre': nombre, 'ubicaciones': [list(u) for u in self.ubicaciones_by_municipio.get(pk, ())]}
+                for pk, nombre in self.municipios
+            ],
+        }
+
+
+def build_catalog(version):
+    return Catalog(
+        version,
+        Municipio.objects.order_by('nombre').values_list('id', 'nombre'),
+        Ubicacion.objects.order_by('nombre', 'pk').values_list('municipio_id', 'id', 'nombre', 'loc', 'zona'),
+    )
+
+
+def get_catalog(version=None):
+    version = version or get_catalog_version()
+    catalog = _local_catalogs.get(version)
+    if catalog is not None:
+        return catalog
+    shared_key = f"surveys:catalog:{version}:snapshot"
+    catalog = cache.get(shared_key)
+    if catalog is None:
+        catalog = build_catalog(version)
+        cache.set(shared_key, catalog, timeout=CATALOG_CACHE_TIMEOUT)
+    _local_catalogs.set(version, catalog)
+    return catalog
+
+
+class CatalogPayload:
+    __slots__ = ('body', 'gzip_body')
+
+    def __init__(self, body):
+        self.body = body
+        self.gzip_body = gzip.compress(body, mtime=0)
+
+
+def _etag(version, name, gzipped=False):
+    # Each encoding is a different representation, so each gets its own strong validator
+    return f'"{version}-{name}-gz"' if gzipped else f'"{version}-{name}"'
+
+
+def accepts_gzip(request):
+    """Whether Accept-Encoding allows gzip, honouring ``q=0`` and ``*``."""
+    accepted = {}
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, *params = (part.strip() for part in coding.split(';'))
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            accepted[name.lower()] = quality
+    for name in ('gzip', 'x-gzip'):
+        if name in accepted:
+            return accepted[name] > 0
+    return accepted.get('*', 0) > 0
+
+
+def _etag_matches(request, etags):
+    # If-None-Match uses the weak comparison: a W/ added by a proxy still matches
+    candidates = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    return '*' in candidates or any(tag.removeprefix('W/') in etags for tag in candidates)
+
+
+def get_payload(name, build, version=None):
+    """Encoded ``build()`` result for ``name``, computed once per catalog version."""
+    version = version or get_catalog_version()
+    key = (name, version)
+    payload = _local_payloads.get(key)
+    if payload is not None:
+        return payload
+    shared_key = f"surveys:catalog:{version}:{name}"
+    payload = cache.get(shared_key)
+    if payload is None:
+        payload = CatalogPayload(json.dumps(build(version), ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+        cache.set(shared_key, payload, timeout=CATALOG_CACHE_TIMEOUT)
+    _local_payloads.set(key, payload)
+    return payload
+
+
+def catalog_response(request, name, build):
+    """
+    Serve a catalog payload with validators. A matching If-None-Match is answered
+    with 304 before touching any cache or the database. URLs that carry the current
+    version (``?v=``) never change, so browsers may keep them for a year.
+    """
+    version = get_catalog_version()
+    gzipped = accepts_gzip(request)
+    etag = _etag(version, name, gzipped)
+    # Either encoding's validator proves the client holds the current version
+    if _etag_matches(request, (_etag(version, name), _etag(version, name, True))):
+        response = HttpResponseNotModified()
+    else:
+        payload = get_payload(name, build, version)
+        response = HttpResponse(content_type='application/json')
+        if gzipped:
+            response.content = payload.gzip_body
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response.content = payload.body
+        response['Content-Length'] = len(response.content)
+    response['ETag'] = etag
+    response['Vary'] = 'Accept-Encoding'
+    if request.GET.get('v') == str(version):
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response['Cache-Control'] = 'public, max-age=0, must-revalidate'
+    return response
+
+
+def municipio_ubicaciones_response(request, municipio_id):
+    """``[{id, nombre}]`` of one municipio."""
+    return catalog_response(
+        request, f"municipio-{municipio_id}",
+        lambda version: [{'id': u[0], 'nombre': u[1]} for u in get_catalog(version).ubicaciones(municipio_id)],
+    )
+
+
+def catalog_bundle_response(request):
+    """Every municipio with its ubicaciones (id, nombre, loc, zona) in one document."""
+    return catalog_response(request, 'bundle', lambda version: get_catalog(version).as_bundle())
@@ -0,0 +1,429 @@
+"""
+Columnar, memory-mapped respondent × question matrix per survey.
+
+Each survey gets a directory with one raw NumPy file per column and a
+``manifest.json`` describing them; row ``i`` of every file is the ``i``-th ResponseSet
+by primary key:
+
+- ``responses``: ResponseSet ids (int64), ``created``: creation time in Unix seconds
+  (int64), ``live``: 1 until the response is deleted (uint8)
+- SINGLE/LIKERT: index of the selected option in the question's options (int8, or
+  int16 for long lists), -1 when unanswered
+- MULTI: selected options as a bit mask packed into ``width`` bytes per row
+- INTEGER/DECIMAL: float64, NaN when unanswered
+- BOOL: 1/0, -1 when unanswered (int8)
+- UBICACION: id of the selected Ubicacion, 0 when unanswered (int32)
+- DATE: days since 1970-01-01 as float64, NaN when unanswered
+
+Text questions are not stored. Readers map the files read-only and slice them
+without copies or ORM work. Submissions add their rows after commit (resubmissions and
+deletions rewrite their row in place); a response that committed after one with a higher
+pk is merged into its place. ``current_matrix`` only hands out a store whose layout
+matches the survey and whose live rows match the ResponseSet count, so readers fall
+back to the ORM otherwise. A survey whose questions or options changed keeps its stale
+store until ``build_columnar_store`` rebuilds it; submissions never rebuild. Surveys
+without a built store are left alone by the write path.
+"""
+import json
+import logging
+import os
+import shutil
+from contextlib import contextmanager
+from datetime import date
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Answer, QuestionType, ResponseSet
+from .locks import file_lock
+from .schema import get_survey_schema
+
+STORE_FORMAT = 1
+BUILD_CHUNK_SIZE = 5000
+
+OPTION_TYPES = (QuestionType.SINGLE, QuestionType.LIKERT)
+NUMERIC_TYPES = (QuestionType.INTEGER, QuestionType.DECIMAL)
+STORED_TYPES = OPTION_TYPES + NUMERIC_TYPES + (
+    QuestionType.MULTI, QuestionType.BOOL, QuestionType.UBICACION, QuestionType.DATE,
+)
+EPOCH = date(1970, 1, 1)
+
+# Missing value of each column kind
+MISSING = {'code': -1, 'mask': 0, 'number': np.nan, 'bool': -1, 'ubicacion': 0, 'date': np.nan}
+
+OptionThrough = Answer.options.through
+UbicacionThrough = Answer.selected_ubicaciones.through
+
+logger = logging.getLogger(__name__)
+
+
+def columnar_root():
+    return Path(getattr(settings, 'SURVEYS_COLUMNAR_DIR', Path(settings.BASE_DIR) / 'columnar'))
+
+
+def store_dir(survey_id):
+    return columnar_root() / str(survey_id)
+
+
+def _question_layout(question):
+    if question.qtype in OPTION_TYPES:
+        dtype = 'int8' if len(question.options) < 127 else 'int16'
+        return {'kind': 'code', 'dtype': dtype, 'width': 1, 'options': [o.id for o in question.options]}
+    if question.qtype == QuestionType.MULTI:
+        width = max(1, (len(question.options) + 7) // 8)
+        return {'kind': 'mask', 'dtype': 'uint8', 'width': width, 'options': [o.id for o in question.options]}
+    if question.qtype in NUMERIC_TYPES:
+        return {'kind': 'number', 'dtype': 'float64', 'width': 1}
+    if question.qtype == QuestionType.BOOL:
+        return {'kind': 'bool', 'dtype': 'int8', 'width': 1}
+    if question.qtype == QuestionType.DATE:
+        return {'kind': 'date', 'dtype': 'float64', 'width': 1}
+    return {'kind': 'ubicacion', 'dtype': 'int32', 'width': 1}
+
+
+def survey_layout(schema):
+    """``{question id (str): column description}`` for the stored questions of ``schema``."""
+    return {
+        str(q.id): {'type': q.qtype, 'file': f'q{q.id}.bin', **_question_layout(q)}
+        for q in schema.questions if q.qtype in STORED_TYPES
+    }
+
+
+BASE_COLUMNS = {
+    'responses': {'dtype': 'int64', 'width': 1, 'file': 'responses.bin'},
+    'created': {'dtype': 'int64', 'width': 1, 'file': 'created.bin'},
+    'live': {'dtype': 'uint8', 'width': 1, 'file': 'live.bin'},
+}
+
+
+class SurveyMatrix:
+    """Read-only view of a built store; every array is a memory map."""
+
+    def __init__(self, path, manifest):
+        self.path = Path(path)
+        self.manifest = manifest
+        self.rows = manifest['rows']
+        self.layout = manifest['columns']
+        self.response_ids = self._map(BASE_COLUMNS['responses'])
+        self.created = self._map(BASE_COLUMNS['created'])
+        self.live = self._map(BASE_COLUMNS['live'])
+
+    def _map(self, column, mode='r'):
+        shape = (self.rows, column['width']) if column['width'] > 1 or column.get('kind') == 'mask' else (self.rows,)
+        if not self.rows:
+            return np.zeros(shape, dtype=column['dtype'])
+        return np.memmap(self.path / column['file'], dtype=column['dtype'], mode=mode, shape=shape)
+
+    def has(self, question_id):
+        return str(question_id) in self.layout
+
+    def column(self, question_id):
+        return self._map(self.layout[str(question_id)])
+
+    def options(self, question_id):
+        """Option ids in code/bit order for an option question."""
+        return self.layout[str(question_id)]['options']
+
+    def selected(self, question_id):
+        """``(row, option index)`` pairs of a MULTI question."""
+        column = self.column(question_id)
+        n_options = len(self.options(question_id))
+        bits = np.unpackbits(np.asarray(column), axis=1, bitorder='little')[:, :n_options]
+        return np.nonzero(bits)
+
+    def rows_between(self, start=None, end=None):
+        """Boolean mask of the live rows created in ``[start, end)`` (aware datetimes or None)."""
+        mask = self.live.astype(bool)
+        if start is not None:
+            mask &= self.created >= int(start.timestamp())
+        if end is not None:
+            mask &= self.created < int(end.timestamp())
+        return mask
+
+
+def _read_manifest(path):
+    try:
+        with open(path / 'manifest.json', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get('format') == STORE_FORMAT else None
+
+
+def open_matrix(survey_id):
+    """The survey's matrix, or None when its store has not been built."""
+    path = store_dir(survey_id)
+    manifest = _read_manifest(path)
+    if manifest is None:
+        return None
+    return SurveyMatrix(path, manifest)
+
+
+def current_matrix(schema):
+    """
+    ``open_matrix`` of ``schema``, or None when its store is missing, predates a change of
+    questions or is missing responses.
+    """
+    matrix = open_matrix(schema.id)
+    if matrix is None or matrix.layout != survey_layout(schema):
+        return None
+    if np.count_nonzero(matrix.live) != ResponseSet.objects.filter(survey_id=schema.id).count():
+        return None
+    return matrix
+
+
+def _write_manifest(path, manifest):
+    tmp = path / 'manifest.json.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path / 'manifest.json')
+
+
+@contextmanager
+def _locked(survey_id):
+    """Serialize the writers of one survey store across processes."""
+    columnar_root().mkdir(parents=True, exist_ok=True)
+    with file_lock(columnar_root() / f'{survey_id}.lock'):
+        yield
+
+
+def encode_responses(schema, layout, response_ids):
+    """
+    ``{column name: array}`` with one row per id of ``response_ids`` (ascending), read with
+    four queries.
+    """
+    ids = np.asarray(response_ids, dtype=np.int64)
+    n = len(ids)
+    created = dict(ResponseSet.objects.filter(pk__in=response_ids).values_list('pk', 'created_at'))
+    arrays = {
+        'responses': ids,
+        'created': np.array([int(created[pk].timestamp()) if pk in created else 0 for pk in response_ids], dtype=np.int64),
+        'live': np.array([pk in created for pk in response_ids], dtype=np.uint8),
+    }
+    for key, column in layout.items():
+        shape = (n, column['width']) if column['kind'] == 'mask' else (n,)
+        arrays[key] = np.full(shape, MISSING[column['kind']], dtype=column['dtype'])
+    if not n:
+        return arrays
+
+    def rows_of(pks):
+        return np.searchsorted(ids, np.asarray(pks, dtype=np.int64))
+
+    value_questions = [int(key) for key, column in layout.items() if column['kind'] in ('number', 'bool', 'date')]
+    by_question = {}
+    for response_id, question_id, integer, decimal, boolean, day in (
+        Answer.objects.filter(response_id__in=response_ids, question_id__in=value_questions)
+        .values_list('response_id', 'question_id', 'integer_answer', 'decimal_answer', 'bool_answer', 'date_answer')
+    ):
+        column = layout[str(question_id)]
+        if column['kind'] == 'bool':
+            value = boolean
+        elif column['kind'] == 'date':
+            value = (day - EPOCH).days if day is not None else None
+        else:
+            value = integer if column['type'] == QuestionType.INTEGER else decimal
+        if value is not None:
+            pks, question_values = by_question.setdefault(question_id, ([], []))
+            pks.append(response_id)
+            question_values.append(float(value))
+    for question_id, (pks, question_values) in by_question.items():
+        arrays[str(question_id)][rows_of(pks)] = question_values
+
+    option_questions = [int(key) for key, column in layout.items() if column['kind'] in ('code', 'mask')]
+    pairs = np.array(
+        list(
+            OptionThrough.objects
+            .filter(answer__response_id__in=response_ids, answer__question_id__in=option_questions)
+            .values_list('answer__response_id', 'answer__question_id', 'option_id')
+        ),
+        dtype=np.int64,
+    ).reshape(-1, 3)
+    for question_id in option_questions:
+        column = layout[str(question_id)]
+        selected = pairs[pairs[:, 1] == question_id]
+        if not len(selected):
+            continue
+        codes_by_option = {option_id: code for code, option_id in enumerate(column['options'])}
+        codes = np.array([codes_by_option.get(option_id, -1) for option_id in selected[:, 2].tolist()], dtype=np.int64)
+        rows = rows_of(selected[:, 0])
+        known = codes >= 0
+        rows, codes = rows[known], codes[known]
+        target = arrays[str(question_id)]
+        if column['kind'] == 'code':
+            target[rows] = codes
+        else:
+            # Set bit ``code`` of each row, little-endian within each byte
+            np.bitwise_or.at(target, (rows, codes // 8), (1 << (codes % 8)).astype(np.uint8))
+
+    ubicacion_questions = [int(key) for key, column in layout.items() if column['kind'] == 'ubicacion']
+    if ubicacion_questions:
+        triples = np.array(
+            list(
+                UbicacionThrough.objects
+                .filter(answer__response_id__in=response_ids, answer__question_id__in=ubicacion_questions)
+                .values_list('answer__response_id', 'answer__question_id', 'ubicacion_id')
+            ),
+            dtype=np.int64,
+        ).reshape(-1, 3)
+        for question_id in ubicacion_questions:
+            selected = triples[triples[:, 1] == question_id]
+            arrays[str(question_id)][rows_of(selected[:, 0])] = selected[:, 2]
+    return arrays
+
+
+def _files(layout):
+    return {**BASE_COLUMNS, **layout}
+
+
+def _append(path, layout, arrays, rows):
+    """Write ``arrays`` after the first ``rows`` rows of every file (dropping any partial tail)."""
+    for key, column in _files(layout).items():
+        row_bytes = np.dtype(column['dtype']).itemsize * column['width']
+        with open(path / column['file'], 'ab') as f:
+            f.truncate(rows * row_bytes)
+            f.seek(rows * row_bytes)
+            np.ascontiguousarray(arrays[key]).tofile(f)
+
+
+def build_store(survey_id, chunk_size=BUILD_CHUNK_SIZE, progress=None):
+    """Build the survey's store from scratch, replacing the current one. Returns the row count."""
+    with _locked(survey_id):
+        return _build(survey_id, chunk_size, progress)
+
+
+def _build(survey_id, chunk_size=BUILD_CHUNK_SIZE, progress=None):
+    schema = get_survey_schema(survey_id)
+    layout = survey_layout(schema)
+    final = store_dir(survey_id)
+    path = final.with_name(f'{final.name}.building')
+    shutil.rmtree(path, ignore_errors=True)
+    path.mkdir(parents=True)
+    for column in _files(layout).values():
+        (path / column['file']).touch()
+
+    response_ids = list(ResponseSet.objects.filter(survey_id=survey_id).order_by('pk').values_list('pk', flat=True))
+    rows = 0
+    for offset in range(0, len(response_ids), chunk_size):
+        chunk = response_ids[offset:offset + chunk_size]
+        _append(path, layout, encode_responses(schema, layout, chunk), rows)
+        rows += len(chunk)
+        if progress:
+            progress(rows, len(response_ids))
+    _write_manifest(path, {
+        'format': STORE_FORMAT, 'survey_id': survey_id, 'rows': rows,
+        'last_response_id': response_ids[-1] if response_ids else 0,
+        'built_at': timezone.now().isoformat(), 'columns': layout,
+    })
+    _swap(path, final)
+    return rows
+
+
+def _swap(path, final):
+    """Replace the store directory ``final`` with the one built in ``path``."""
+    # Readers that already mapped the old files keep them until they let go
+    old = final.with_name(f'{final.name}.old')
+    shutil.rmtree(old, ignore_errors=True)
+    if final.exists():
+        os.replace(final, old)
+    os.replace(path, final)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def _merge(path, layout, matrix, manifest, arrays):
+    """
+    Rewrite the store at ``path`` with the rows of ``arrays`` inserted at their place in
+    pk order, for responses that committed after one with a higher pk was stored.
+    """
+    positions = np.searchsorted(matrix.response_ids, arrays['responses'])
+    building = path.with_name(f'{path.name}.building')
+    shutil.rmtree(building, ignore_errors=True)
+    building.mkdir(parents=True)
+    for key, column in _files(layout).items():
+        merged = np.insert(np.asarray(matrix._map(column)), positions, arrays[key], axis=0)
+        np.ascontiguousarray(merged, dtype=column['dtype']).tofile(building / column['file'])
+    _write_manifest(building, manifest)
+    _swap(building, path)
+
+
+def _rewrite(schema, layout, matrix, changed_ids):
+    """Re-encode in place the stored rows of ``changed_ids``."""
+    changed = sorted(set(changed_ids))
+    rows = np.searchsorted(matrix.response_ids, changed)
+    found = [(pk, row) for pk, row in zip(changed, rows.tolist()) if row < matrix.rows and matrix.response_ids[row] == pk]
+    if not found:
+        return
+    arrays = encode_responses(schema, layout, [pk for pk, _ in found])
+    row_indexes = [row for _, row in found]
+    for key, column in _files(layout).items():
+        if key == 'responses':
+            continue
+        target = matrix._map(column, mode='r+')
+        target[row_indexes] = arrays[key]
+        target.flush()
+
+
+def _missing_ids(survey_id, matrix, candidates):
+    """Ids of the survey's ResponseSets that are not stored in ``matrix``, ascending."""
+    responses = ResponseSet.objects.filter(survey_id=survey_id)
+    last = int(matrix.response_ids[-1]) if matrix.rows else 0
+    ids = np.fromiter(
+        responses.filter(Q(pk__gt=last) | Q(pk__in=list(candidates))).values_list('pk', flat=True), dtype=np.int64,
+    )
+    missing = ids[~np.isin(ids, matrix.response_ids)]
+    if np.count_nonzero(matrix.live) + len(missing) != responses.count():
+        # Rows lost earlier, e.g. by a failed sync: compare every id to catch up
+        ids = np.fromiter(responses.values_list('pk', flat=True), dtype=np.int64)
+        missing = ids[~np.isin(ids, matrix.response_ids)]
+    return sorted(missing.tolist())
+
+
+def sync_store(survey_id, changed_ids=()):
+    """
+    Rewrite the stored rows of ``changed_ids`` (resubmitted or deleted) and add the
+    survey's ResponseSets missing from its store: the ones of ``changed_ids`` created in
+    this transaction and any other. Does nothing when the store is not built or is stale.
+    """
+    if _read_manifest(store_dir(survey_id)) is None:
+        return
+    with _locked(survey_id):
+        path = store_dir(survey_id)
+        manifest = _read_manifest(path)
+        if manifest is None:
+            return
+        schema = get_survey_schema(survey_id)
+        layout = survey_layout(schema)
+        if layout != manifest['columns']:
+            # Questions or options changed: codes and bit positions moved. Readers use the
+            # ORM until build_columnar_store rebuilds it, outside of any request
+            return
+
+        matrix = SurveyMatrix(path, manifest)
+        _rewrite(schema, layout, matrix, changed_ids)
+        new_ids = _missing_ids(survey_id, matrix, changed_ids)
+        if not new_ids:
+            return
+        arrays = encode_responses(schema, layout, new_ids)
+        in_order = new_ids[0] > manifest['last_response_id']
+        manifest['rows'] += len(new_ids)
+        manifest['last_response_id'] = max(new_ids[-1], manifest['last_response_id'])
+        if in_order:
+            _append(path, layout, arrays, matrix.rows)
+            _write_manifest(path, manifest)
+        else:
+            _merge(path, layout, matrix, manifest, arrays)
+
+
+def schedule_sync(survey_id, changed_ids=()):
+    """Sync the survey's store once the current transaction commits."""
+    def sync():
+        try:
+            sync_store(survey_id, changed_ids)
+        except Exception:
+            # Runs after the commit: the submission is saved and must not turn into a 500.
+            # The store stays behind (and out of use) until the next sync or rebuild
+            logger.exception('Could not update the columnar store of survey %s', survey_id)
+    transaction.on_commit(sync)
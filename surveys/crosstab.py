@@ -0,0 +1,302 @@
+"""
+Cross-tabulation of two questions of a survey ("question A broken down by question B").
+
+Each question is read as one column of ``(response id, category code)`` pairs, with a
+single query or from the survey's columnar matrix (``surveys.columnar``) when it is
+built: selected options for SINGLE/MULTI/LIKERT, Sí/No for BOOL, equal-width bins for
+INTEGER/DECIMAL and zonas for UBICACION. The two columns are joined on the
+response with pandas and counted with ``numpy.bincount``; percentages and the
+chi-square test of independence are computed on the resulting matrix.
+
+A MULTI question puts a response in several cells, so no chi-square is reported for it.
+"""
+import math
+
+import numpy as np
+import pandas as pd
+
+from .catalog import get_catalog
+from .models import Answer, QuestionType
+
+OptionThrough = Answer.options.through
+UbicacionThrough = Answer.selected_ubicaciones.through
+
+CROSSTAB_TYPES = (
+    QuestionType.SINGLE, QuestionType.MULTI, QuestionType.LIKERT, QuestionType.BOOL,
+    QuestionType.INTEGER, QuestionType.DECIMAL, QuestionType.UBICACION,
+)
+DEFAULT_BINS = 5
+MAX_BINS = 20
+
+
+class Column:
+    """Answers of one question as parallel ``responses``/``codes`` arrays plus category labels."""
+
+    def __init__(self, responses, codes, labels):
+        self.responses = responses
+        self.codes = codes
+        self.labels = labels
+
+
+def _pairs(rows):
+    rows = list(rows)
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    responses, values = zip(*rows)
+    return np.array(responses, dtype=np.int64), np.array(values)
+
+
+def _coded(responses, keys, key_codes, labels):
+    """Column from raw ``keys``, mapped through ``{key: code}``; unknown keys are dropped."""
+    if not len(keys):
+        return Column(responses, np.empty(0, dtype=np.int64), labels)
+    # Map the distinct keys in Python and expand the result back to every row
+    unique, inverse = np.unique(keys, return_inverse=True)
+    codes = np.array([key_codes.get(key, -1) for key in unique.tolist()], dtype=np.int64)[inverse]
+    known = codes >= 0
+    return Column(responses[known], codes[known], labels)
+
+
+def _option_column(question, response_sets):
+    rows = (
+        OptionThrough.objects
+        .filter(answer__question_id=question.id, answer__response__in=response_sets)
+        .values_list('answer__response_id', 'option_id')
+    )
+    responses, option_ids = _pairs(rows)
+    labels = [option.label for option in question.options]
+    key_codes = {option.id: code for code, option in enumerate(question.options)}
+    return _coded(responses, option_ids.astype(np.int64), key_codes, labels)
+
+
+def _bool_column(question, response_sets):
+    rows = (
+        Answer.objects
+        .filter(question_id=question.id, response__in=response_sets, bool_answer__isnull=False)
+        .values_list('response_id', 'bool_answer')
+    )
+    responses, values = _pairs(rows)
+    # Sí first, like the stats page
+    return Column(responses, np.where(values.astype(bool), 0, 1).astype(np.int64), ['Sí', 'No'])
+
+
+def _ubicacion_column(question, response_sets):
+    rows = (
+        UbicacionThrough.objects
+        .filter(answer__question_id=question.id, answer__response__in=response_sets)
+        .values_list('answer__response_id', 'ubicacion_id')
+    )
+    responses, ubicacion_ids = _pairs(rows)
+    ubicacion_ids = ubicacion_ids.astype(np.int64)
+    key_codes, labels = _zona_codes(ubicacion_ids)
+    return _coded(responses, ubicacion_ids, key_codes, labels)
+
+
+def _bin_labels(edges, integer, label):
+    labels = []
+    for i, (low, high) in enumerate(zip(edges, edges[1:])):
+        last = i == len(edges) - 2
+        if integer:
+            high = int(high) if last else int(high) - 1
+            labels.append(label(int(low)) if high <= low else f'{label(int(low))}–{label(high)}')
+        else:
+            labels.append(f'{low:g}–{high:g}')
+    return labels
+
+
+def bin_values(values, integer, bins, label=str):
+    """
+    ``(codes, labels)`` of numeric ``values`` in equal-width bins, one per value for few
+    distinct integers; ``label`` formats the integer bounds.
+    """
+    if not len(values):
+        return np.empty(0, dtype=np.int64), []
+    distinct = np.unique(values)
+    if integer and len(distinct) <= bins:
+        # Few distinct values: one category each
+        codes = np.searchsorted(distinct, values)
+        return codes.astype(np.int64), [label(int(value)) for value in distinct]
+    edges = np.histogram_bin_edges(values, bins=bins)
+    if integer:
+        edges = np.unique(np.concatenate([np.floor(edges[:-1]), [edges[-1]]]))
+    edges = np.round(edges, 2)
+    # Half-open bins, the last one closed on the maximum
+    codes = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, len(edges) - 2)
+    return codes.astype(np.int64), _bin_labels(edges.tolist(), integer, label)
+
+
+def _binned(responses, values, integer, bins):
+    return Column(responses, *bin_values(values, integer, bins))
+
+
+def _numeric_column(question, response_sets, bins):
+    field = 'integer_answer' if question.qtype == QuestionType.INTEGER else 'decimal_answer'
+    rows = (
+        Answer.objects
+        .filter(question_id=question.id, response__in=response_sets, **{f'{field}__isnull': False})
+        .values_list('response_id', field)
+    )
+    responses, values = _pairs(rows)
+    return _binned(responses, values.astype(float), question.qtype == QuestionType.INTEGER, bins)
+
+
+def _zona_codes(ubicacion_ids):
+    """``({ubicacion id: zona code}, zona labels)`` for the distinct ``ubicacion_ids``."""
+    catalog = get_catalog()
+    zonas = {}
+    for ubicacion_id in np.unique(ubicacion_ids).tolist():
+        ubicacion = catalog.ubicacion(ubicacion_id)
+        zonas[ubicacion_id] = (ubicacion[3] if ubicacion else '').strip() or 'Sin zona'
+    labels = sorted(set(zonas.values()))
+    codes = {label: code for code, label in enumerate(labels)}
+    return {ubicacion_id: codes[zona] for ubicacion_id, zona in zonas.items()}, labels
+
+
+def question_column(question, response_sets, bins=DEFAULT_BINS):
+    if question.qtype in (QuestionType.SINGLE, QuestionType.MULTI, QuestionType.LIKERT):
+        return _option_column(question, response_sets)
+    if question.qtype == QuestionType.BOOL:
+        return _bool_column(question, response_sets)
+    if question.qtype in (QuestionType.INTEGER, QuestionType.DECIMAL):
+        return _numeric_column(question, response_sets, bins)
+    if question.qtype == QuestionType.UBICACION:
+        return _ubicacion_column(question, response_sets)
+    raise ValueError(f'Question type {question.qtype!r} cannot be cross-tabulated.')
+
+
+def _upper_gamma(a, x):
+    """Regularized upper incomplete gamma Q(a, x), by series or continued fraction."""
+    if x <= 0:
+        return 1.0
+    log_prefix = a * math.log(x) - x - math.lgamma(a)
+    if x < a + 1:
+        term = total = 1 / a
+        n = a
+        for _ in range(500):
+            n += 1
+            term *= x / n
+            total += term
+            if abs(term) < abs(total) * 1e-15:
+                break
+        return max(0.0, 1 - total * math.exp(log_prefix))
+    # Lentz's method
+    tiny = 1e-300
+    b = x + 1 - a
+    c = 1 / tiny
+    d = 1 / b
+    h = d
+    for i in range(1, 500):
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        d = tiny if abs(d) < tiny else d
+        c = b + an / c
+        c = tiny if abs(c) < tiny else c
+        d = 1 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1) < 1e-15:
+            break
+    return min(1.0, h * math.exp(log_prefix))
+
+
+def chi_square(counts):
+    """Chi-square test of independence on the non-empty rows and columns of ``counts``."""
+    counts = counts[counts.sum(axis=1) > 0][:, counts.sum(axis=0) > 0]
+    rows, cols = counts.shape
+    total = counts.sum()
+    if rows < 2 or cols < 2:
+        return None
+    expected = np.outer(counts.sum(axis=1), counts.sum(axis=0)) / total
+    statistic = float(((counts - expected) ** 2 / expected).sum())
+    dof = (rows - 1) * (cols - 1)
+    return {
+        'statistic': round(statistic, 4),
+        'dof': dof,
+        'p_value': _upper_gamma(dof / 2, statistic / 2),
+        'cramers_v': round(math.sqrt(statistic / (total * (min(rows, cols) - 1))), 4),
+        # The test is unreliable when many cells expect fewer than 5 responses
+        'low_expected_share': round(float((expected < 5).mean()), 4),
+    }
+
+
+def _percentages(counts, totals, axis):
+    totals = np.expand_dims(totals, axis)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shares = np.where(totals > 0, counts / totals * 100, 0)
+    return np.round(shares, 2).tolist()
+
+
+def _describe(question):
+    return {'id': question.id, 'text': question.text, 'type': question.qtype}
+
+
+def matrix_column(matrix, question, rows, bins=DEFAULT_BINS):
+    """
+    Column of ``question`` read from a columnar ``matrix`` for the rows selected by the
+    boolean mask ``rows``; responses are identified by their row number.
+    """
+    if question.qtype == QuestionType.MULTI:
+        selected_rows, codes = matrix.selected(question.id)
+        keep = rows[selected_rows]
+        return Column(selected_rows[keep], codes[keep].astype(np.int64), [o.label for o in question.options])
+    values = matrix.column(question.id)
+    if question.qtype in (QuestionType.SINGLE, QuestionType.LIKERT):
+        selected_rows = np.nonzero(rows & (values >= 0))[0]
+        return Column(selected_rows, values[selected_rows].astype(np.int64), [o.label for o in question.options])
+    if question.qtype == QuestionType.BOOL:
+        selected_rows = np.nonzero(rows & (values >= 0))[0]
+        return Column(selected_rows, np.where(values[selected_rows] == 1, 0, 1).astype(np.int64), ['Sí', 'No'])
+    if question.qtype in (QuestionType.INTEGER, QuestionType.DECIMAL):
+        selected_rows = np.nonzero(rows & ~np.isnan(values))[0]
+        return _binned(selected_rows, values[selected_rows], question.qtype == QuestionType.INTEGER, bins)
+    if question.qtype == QuestionType.UBICACION:
+        selected_rows = np.nonzero(rows & (values > 0))[0]
+        ubicacion_ids = values[selected_rows].astype(np.int64)
+        key_codes, labels = _zona_codes(ubicacion_ids)
+        return _coded(selected_rows, ubicacion_ids, key_codes, labels)
+    raise ValueError(f'Question type {question.qtype!r} cannot be cross-tabulated.')
+
+
+def crosstab(response_sets, row_question, col_question, bins=DEFAULT_BINS):
+    """Contingency table of ``row_question`` by ``col_question`` over ``response_sets``."""
+    return tabulate(
+        row_question, col_question,
+        question_column(row_question, response_sets, bins), question_column(col_question, response_sets, bins),
+    )
+
+
+def matrix_crosstab(matrix, rows, row_question, col_question, bins=DEFAULT_BINS):
+    """``crosstab`` over the rows of a columnar ``matrix`` selected by the mask ``rows``, without the ORM."""
+    return tabulate(
+        row_question, col_question,
+        matrix_column(matrix, row_question, rows, bins), matrix_column(matrix, col_question, rows, bins),
+    )
+
+
+def tabulate(row_question, col_question, row, col):
+    """Counts, percentages and chi-square of two ``Column``s joined on the response."""
+    joined = pd.DataFrame({'response': row.responses, 'row': row.codes}).merge(
+        pd.DataFrame({'response': col.responses, 'col': col.codes}), on='response',
+    )
+    n_rows, n_cols = len(row.labels), len(col.labels)
+    counts = np.bincount(
+        joined['row'].to_numpy() * n_cols + joined['col'].to_numpy(), minlength=n_rows * n_cols,
+    ).reshape(n_rows, n_cols)
+    row_totals = counts.sum(axis=1)
+    col_totals = counts.sum(axis=0)
+    single_valued = QuestionType.MULTI not in (row_question.qtype, col_question.qtype)
+    return {
+        'row': _describe(row_question),
+        'column': _describe(col_question),
+        'rows': row.labels,
+        'columns': col.labels,
+        'counts': counts.tolist(),
+        'row_totals': row_totals.tolist(),
+        'column_totals': col_totals.tolist(),
+        'total': int(counts.sum()),
+        'responses': int(joined['response'].nunique()),
+        'row_percentages': _percentages(counts, row_totals, 1),
+        'column_percentages': _percentages(counts, col_totals, 0),
+        'chi_square': chi_square(counts) if single_valued and counts.size else None,
+    }
@@ -0,0 +1,157 @@
+"""
+Server-side evaluation of question visibility (``depends_on`` rules).
+
+The rules are the same ones the wizard applies in JavaScript: a question that depends
+on an option is shown when that option is selected, one that depends on a value range
+is shown when the parent's number falls inside it. In addition a question is only
+active when its parent is active, so hiding a question hides its whole subtree.
+
+Answers are passed around as a "state": ``{question_id: [str values]}``, the same shape
+the wizard builds from FormData (option values are ``"<pk>__<code>"``).
+"""
+import re
+from collections import deque
+
+from .caching import LocalLRUCache
+
+QUESTION_FIELD_RE = re.compile(r'^question_(\d+)(?:_(ubicacion))?$')
+
+_evaluators = LocalLRUCache(maxsize=64)
+
+
+class DependencyCycleError(ValueError):
+    pass
+
+
+class DependencyEvaluator:
+    """Dependency graph of one schema version, in topological order."""
+
+    def __init__(self, schema):
+        questions = schema.questions
+        known = {q.id for q in questions}
+        children = {}
+        indegree = {}
+        self.rules = {}
+        for q in questions:
+            indegree.setdefault(q.id, 0)
+            if q.depends_on_id is None:
+                continue
+            self.rules[q.id] = (
+                q.depends_on_id,
+                q.depends_on_option_id,
+                float(q.depends_on_value_min) if q.depends_on_value_min is not None else None,
+                float(q.depends_on_value_max) if q.depends_on_value_max is not None else None,
+            )
+            # Parents outside the survey never have an answer, so they are not graph nodes
+            if q.depends_on_id in known:
+                children.setdefault(q.depends_on_id, []).append(q.id)
+                indegree[q.id] = indegree.get(q.id, 0) + 1
+
+        # Kahn's algorithm, seeded in survey order so the result is stable
+        order = []
+        queue = deque(q.id for q in questions if indegree[q.id] == 0)
+        while queue:
+            question_id = queue.popleft()
+            order.append(question_id)
+            for child_id in children.get(question_id, ()):
+                indegree[child_id] -= 1
+                if indegree[child_id] == 0:
+                    queue.append(child_id)
+        if len(order) != len(questions):
+            codes = sorted(q.code for q in questions if indegree[q.id] > 0)
+            raise DependencyCycleError(
+                f"Dependencias circulares en la encuesta '{schema.code}': {', '.join(codes)}"
+            )
+        self.order = tuple(order)
+        self.parent_ids = frozenset(rule[0] for rule in self.rules.values())
+
+    def has_dependencies(self, question_ids):
+        return any(question_id in self.rules for question_id in question_ids)
+
+    def active_questions(self, state):
+        """Ids of the questions that apply given ``state``, in one pass over the graph."""
+        active = set()
+        for question_id in self.order:
+            rule = self.rules.get(question_id)
+            if rule is None:
+                active.add(question_id)
+                continue
+            parent_id, option_id, value_min, value_max = rule
+            if parent_id in active and _rule_met(state.get(parent_id), option_id, value_min, value_max):
+                active.add(question_id)
+        return active
+
+
+def _rule_met(values, option_id, value_min, value_max):
+    if not values:
+        return False
+    if option_id is not None:
+        prefix = f"{option_id}__"
+        return any(value.startswith(prefix) or value == str(option_id) for value in values)
+    if value_min is None and value_max is None:
+        return False
+    try:
+        number = float(values[0])
+    except (TypeError, ValueError):
+        return False
+    if value_min is not None and number < value_min:
+        return False
+    if value_max is not None and number > value_max:
+        return False
+    return True
+
+
+def get_dependency_evaluator(schema):
+    key = (schema.id, schema.version)
+    evaluator = _evaluators.get(key)
+    if evaluator is None:
+        evaluator = DependencyEvaluator(schema)
+        _evaluators.set(key, evaluator)
+    return evaluator
+
+
+def state_from_data(data):
+    """State from form-like data: request.POST, a wizard section dict or a submission."""
+    state = {}
+    getlist = getattr(data, 'getlist', None)
+    for name in data.keys():
+        match = QUESTION_FIELD_RE.match(name)
+        if not match:
+            continue
+        values = getlist(name) if getlist else data[name]
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        state.setdefault(int(match.group(1)), []).extend(
+            str(value) for value in values if value is not None and value != ''
+        )
+    return state
+
+
+def state_from_survey_answers(survey_answers):
+    """State from ``{section_id: section answers}`` as kept by the wizard drafts."""
+    state = {}
+    for section_answers in survey_answers.values():
+        state.update(state_from_data(section_answers))
+    return state
+
+
+def state_from_answers(answers):
+    """State from saved ``Answer`` rows (with ``options`` prefetched)."""
+    state = {}
+    for answer in answers:
+        options = list(answer.options.all())
+        if options:
+            values = [f"{option.pk}__{option.code}" for option in options]
+        else:
+            value = next((
+                v for v in (answer.integer_answer, answer.decimal_answer, answer.bool_answer, answer.date_answer)
+                if v is not None
+            ), answer.text_answer)
+            values = [str(value)] if value not in (None, '') else []
+        state[answer.question_id] = values
+    return state
+
+
+def inactive_questions(evaluator, schema, state):
+    active = evaluator.active_questions(state)
+    return {q.id for q in schema.questions if q.id not in active}
@@ -0,0 +1,110 @@
+"""
+Draft store for the step-by-step wizard.
+
+The respondent data lives in a ``ResponseDraft`` row and every section in its own
+``ResponseDraftSection`` row, so a step writes one small row instead of rewriting the
+whole session. The browser only keeps a signed cookie with the draft token; nothing is
+stored until the respondent step is submitted.
+"""
+import secrets
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .models import ResponseDraft, ResponseDraftSection
+
+# Drafts not touched for this long are treated as abandoned
+DRAFT_TTL = timedelta(seconds=getattr(settings, 'SURVEYS_DRAFT_TTL', 60 * 60 * 24 * 2))
+DRAFT_COOKIE_SALT = 'surveys.drafts'
+
+
+def _cookie_name(survey):
+    return f"survey_draft_{survey.id}"
+
+
+def _expiry():
+    return timezone.now() + DRAFT_TTL
+
+
+def get_draft(request, survey):
+    """Active draft referenced by the request's cookie, or None."""
+    token = request.get_signed_cookie(_cookie_name(survey), default=None, salt=DRAFT_COOKIE_SALT)
+    if not token:
+        return None
+    return ResponseDraft.objects.filter(
+        token=token, survey_id=survey.id, expires_at__gt=timezone.now()
+    ).first()
+
+
+def start_draft(survey, respondent_data, draft=None):
+    """Create a draft for ``respondent_data`` or update the respondent data of ``draft``."""
+    if draft is not None:
+        draft.respondent_data = respondent_data
+        draft.expires_at = _expiry()
+        draft.save(update_fields=['respondent_data', 'expires_at'])
+        return draft
+    return ResponseDraft.objects.create(
+        token=secrets.token_urlsafe(32),
+        survey_id=survey.id,
+        respondent_data=respondent_data,
+        expires_at=_expiry(),
+    )
+
+
+def save_draft_section(draft, section_id, answers):
+    """Store the answers of one section and push the draft's expiry forward."""
+    kwargs = {'update_conflicts': True, 'update_fields': ['answers', 'updated_at']}
+    if connection.features.supports_update_conflicts_with_target:
+        kwargs['unique_fields'] = ['draft', 'section']
+    ResponseDraftSection.objects.bulk_create(
+        [ResponseDraftSection(draft=draft, section_id=section_id, answers=answers, updated_at=timezone.now())],
+        **kwargs,
+    )
+    ResponseDraft.objects.filter(pk=draft.pk).update(expires_at=_expiry())
+
+
+def draft_answers(draft):
+    """``{str(section_id): answers}``, the same shape the wizard used to keep in the session."""
+    if draft is None:
+        return {}
+    return {
+        str(section_id): answers
+        for section_id, answers in ResponseDraftSection.objects.filter(draft=draft).values_list('section_id', 'answers')
+    }
+
+
+def discard_draft(draft):
+    if draft is not None:
+        draft.delete()
+
+
+def set_draft_cookie(response, survey, draft):
+    response.set_signed_cookie(
+        _cookie_name(survey), draft.token, salt=DRAFT_COOKIE_SALT,
+        max_age=int(DRAFT_TTL.total_seconds()), httponly=True, samesite='Lax',
+        secure=settings.SESSION_COOKIE_SECURE,
+    )
+    return response
+
+
+def clear_draft_cookie(response, survey):
+    response.delete_cookie(_cookie_name(survey), samesite='Lax')
+    return response
+
+
+def purge_expired_drafts(chunk_size=1000, now=None):
+    """
+    Delete expired drafts in chunks of ``chunk_size`` so no statement holds locks for
+    long. Returns ``(drafts, sections)`` deleted.
+    """
+    now = now or timezone.now()
+    drafts_deleted = sections_deleted = 0
+    while True:
+        pks = list(ResponseDraft.objects.filter(expires_at__lte=now).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+        if not pks:
+            break
+        sections_deleted += ResponseDraftSection.objects.filter(draft_id__in=pks).delete()[0]
+        drafts_deleted += ResponseDraft.objects.filter(pk__in=pks).delete()[0]
+    return drafts_deleted, sections_deleted
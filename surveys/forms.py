@@ -1,6 +1,8 @@
 from django import forms
 from .models import ResponseSet, Answer, DOCUMENT_TYPES, Question, QuestionType, Interviewer, SingleChoiceDisplayType, Municipio, Ubicacion, Option
 from django.contrib.auth.models import User
+from .caching import LocalLRUCache
+from .catalog import get_catalog
 
 class SurveyUploadForm(forms.Form):
     excel_file = forms.FileField(
@@ -109,10 +111,27 @@ class AnswersForm(forms.Form):
                 # Styling for these is handled in the template
                 pass
 
+# Generated form classes, keyed by (section id, schema version)
+_answers_form_classes = LocalLRUCache(maxsize=256)
+
+ANSWER_INPUT_CLASSES = 'mt-1 block w-full px-3 py-2 bg-white border border-gray-300 rounded-md text-sm shadow-sm placeholder-gray-400 focus:outline-none focus:ring-1 focus:ring-blue-500 focus:border-blue-500'
+
+
 def build_answers_form_for_section(section):
+    # `section` is a compiled SectionSchema (see surveys.schema). The class only changes when
+    # the schema version does, so it is built once and reused; Django deep-copies
+    # base_fields for every form instance, which keeps per-request changes isolated.
+    key = (section.id, section.version)
+    form_class = _answers_form_classes.get(key)
+    if form_class is None:
+        form_class = _build_answers_form_class(section)
+        _answers_form_classes.set(key, form_class)
+    return form_class
+
+
+def _build_answers_form_class(section):
     fields = {}
-    questions = section.questions.prefetch_related('options', 'depends_on').all()
-    for q in questions:
+    for q in section.questions:
         field_name = f"question_{q.pk}"
         field_kwargs = {
             'label': q.text,
@@ -120,8 +139,7 @@ def build_answers_form_for_section(section):
             'required': q.required,
         }
 
-        trigger_option = q.options.filter(is_other_trigger=True).first()
-        trigger_code = trigger_option.code if trigger_option else None
+        trigger_code = q.trigger_option.code if q.trigger_option else None
 
         if q.qtype == QuestionType.TEXT:
             field = forms.CharField(
@@ -146,10 +164,7 @@ def build_answers_form_for_section(section):
         elif q.qtype == QuestionType.DATE:
             field = forms.DateField(**field_kwargs, widget=forms.DateInput(attrs={'type': 'date'}))
         elif q.qtype in [QuestionType.SINGLE, QuestionType.MULTI, QuestionType.LIKERT]:
-            choices = [(f"{option.pk}__{option.code}", option.label) for option in q.options.all()]
-            # Find trigger code for the data attribute
-            trigger_option = q.options.filter(is_other_trigger=True).first()
-            trigger_code = trigger_option.code if trigger_option else None
+            choices = [(option.value, option.label) for option in q.options]
 
             if q.qtype == QuestionType.SINGLE or q.qtype == QuestionType.LIKERT:
                 if q.qtype == QuestionType.SINGLE and q.single_choice_display == SingleChoiceDisplayType.SELECT:
@@ -173,11 +188,13 @@ def build_answers_form_for_section(section):
                 )
         elif q.qtype == QuestionType.UBICACION:
             # For UBICACION, we create multiple fields. We will attach the question object to the main one.
-            fields[f"{field_name}_municipio"] = forms.ModelChoiceField(
-                queryset=Municipio.objects.all(),
+            # Choices come from the in-memory location catalog (see DynamicAnswersForm)
+            fields[f"{field_name}_municipio"] = forms.TypedChoiceField(
                 label="Municipio",
                 required=q.required,
-                empty_label="Selecciona un municipio",
+                choices=[],
+                coerce=int,
+                empty_value=None,
             )
             ubicacion_field = forms.ChoiceField(
                 label="Barrio/Localidad",
@@ -205,42 +222,56 @@ def build_answers_form_for_section(section):
         field.trigger_code = trigger_code
         fields[field_name] = field
 
+    # Widget styling is static, so apply it once to the shared base fields
+    for field in fields.values():
+        if isinstance(field.widget, (forms.TextInput, forms.Textarea, forms.DateInput, forms.EmailInput, forms.NumberInput, forms.URLInput, forms.Select)):
+            attrs = field.widget.attrs
+            attrs['class'] = ANSWER_INPUT_CLASSES
+            if isinstance(field.widget, forms.Textarea):
+                attrs['rows'] = 2
+        # Styling for RadioSelect/CheckboxSelectMultiple is handled in the template
+
+    ubicacion_field_names = tuple(
+        (f"question_{q.pk}_municipio", f"question_{q.pk}_ubicacion")
+        for q in section.questions
+        if q.qtype == QuestionType.UBICACION
+    )
+
+    # Form fields that belong to each question (UBICACION questions have several)
+    question_field_names = {
+        q.id: tuple(name for name in fields if name == f"question_{q.pk}" or name.startswith(f"question_{q.pk}_"))
+        for q in section.questions
+    }
+
     class DynamicAnswersForm(forms.Form):
         def __init__(self, *args, **kwargs):
+            # Questions hidden by their dependencies (see surveys.dependencies) are not required
+            inactive_questions = kwargs.pop('inactive_questions', ())
             super().__init__(*args, **kwargs)
-            text_input_classes = 'mt-1 block w-full px-3 py-2 bg-white border border-gray-300 rounded-md text-sm shadow-sm placeholder-gray-400 focus:outline-none focus:ring-1 focus:ring-blue-500 focus:border-blue-500'
-            for field_name, field in self.fields.items():
-                if isinstance(field.widget, (forms.TextInput, forms.Textarea, forms.DateInput, forms.EmailInput, forms.NumberInput, forms.URLInput, forms.Select)):
-                    attrs = field.widget.attrs
-                    attrs['class'] = text_input_classes
-                    if isinstance(field.widget, forms.Textarea):
-                        attrs['rows'] = 2
-                elif isinstance(field.widget, (forms.RadioSelect, forms.CheckboxSelectMultiple)):
-                    # Styling for these is handled in the template
-                    pass
+
+            for question_id in inactive_questions:
+                for name in question_field_names.get(question_id, ()):
+                    self.fields[name].required = False
+
+            if not ubicacion_field_names:
+                return
+            catalog = get_catalog()
+            municipio_choices = [('', 'Selecciona un municipio'), *catalog.municipios]
 
             # Dynamic choices for ubicacion fields
-            for q in section.questions.all():
-                if q.qtype == QuestionType.UBICACION:
-                    field_name = f"question_{q.pk}"
-                    municipio_field_name = f"{field_name}_municipio"
-                    ubicacion_field_name = f"{field_name}_ubicacion"
-
-                    if municipio_field_name in self.fields and ubicacion_field_name in self.fields:
-                        municipio_id = None
-                        # If form is bound (POST), get municipio from data
-                        if self.is_bound and self.data.get(municipio_field_name):
-                            municipio_id = self.data.get(municipio_field_name)
-                        # If form is not bound but has initial data (GET), get municipio from initial
-                        elif not self.is_bound and self.initial.get(municipio_field_name):
-                            municipio_id = self.initial.get(municipio_field_name)
-
-                        if municipio_id:
-                            try:
-                                ubicaciones = Ubicacion.objects.filter(municipio_id=int(municipio_id)).order_by('nombre')
-                                self.fields[ubicacion_field_name].choices = [(u.pk, u.nombre) for u in ubicaciones]
-                            except (ValueError, TypeError):
-                                pass # Handle cases where municipio_id is not a valid integer
+            for municipio_field_name, ubicacion_field_name in ubicacion_field_names:
+                self.fields[municipio_field_name].choices = municipio_choices
+                municipio_id = None
+                # If form is bound (POST), get municipio from data
+                if self.is_bound and self.data.get(municipio_field_name):
+                    municipio_id = self.data.get(municipio_field_name)
+                # If form is not bound but has initial data (GET), get municipio from initial
+                elif not self.is_bound and self.initial.get(municipio_field_name):
+                    municipio_id = self.initial.get(municipio_field_name)
+
+                if municipio_id:
+                    self.fields[ubicacion_field_name].choices = [(u[0], u[1]) for u in catalog.ubicaciones(municipio_id)]
 
     DynamicAnswersForm.base_fields = fields
+    DynamicAnswersForm.question_field_names = question_field_names
     return DynamicAnswersForm
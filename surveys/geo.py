@@ -0,0 +1,284 @@
+"""
+GPS -> Ubicacion lookup over the barrio polygons stored in ``Ubicacion.geometry``.
+
+The polygons are loaded once per process and catalog version (the same rows
+build_map_topology draws, see load_geojson) into a uniform grid: each cell lists the
+polygons whose bounding box touches it, so a lookup tests the handful of polygons around
+the point instead of every barrio.
+"""
+import json
+import math
+import threading
+
+from .caching import LocalLRUCache
+from .catalog import get_catalog_version
+from .models import Ubicacion
+
+MAX_GRID_SIDE = 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+UBICACION_VALUES = ('id', 'municipio_id', 'codigo', 'nombre', 'loc', 'zona', 'municipio__nombre')
+
+_index_lock = threading.Lock()
+_indexes = LocalLRUCache(maxsize=2)
+
+
+class _FeatureStream:
+    """Incremental reader over a text stream using ``raw_decode`` on a sliding buffer."""
+
+    def __init__(self, fileobj, chunk_size):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read(self, size):
+        if self.pos > self.chunk_size:
+            # Drop what was already consumed so the buffer stays around one feature long
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        data = self.fileobj.read(size)
+        if not data:
+            self.eof = True
+        self.buffer += data
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                raise ValueError('GeoJSON truncado.')
+            self._read(self.chunk_size)
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"GeoJSON inválido: se esperaba '{char}' en la posición {self.pos}.")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise ValueError('GeoJSON inválido.')
+            else:
+                # A number at the very end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            self._read(size)
+            size *= 2  # large features are re-parsed a logarithmic number of times
+
+
+def iter_features(fileobj, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yield the features of a GeoJSON FeatureCollection one at a time, reading ``fileobj``
+    in chunks, so memory stays proportional to the largest feature and not to the file.
+    """
+    stream = _FeatureStream(fileobj, chunk_size)
+    stream.expect('{')
+    while stream.peek() != '}':
+        key = stream.value()
+        stream.expect(':')
+        if key == 'features':
+            stream.expect('[')
+            while stream.peek() != ']':
+                yield stream.value()
+                if stream.peek() == ',':
+                    stream.pos += 1
+            stream.pos += 1
+        else:
+            stream.value()
+        if stream.peek() == ',':
+            stream.pos += 1
+
+
+def simplify_line(points, tolerance):
+    """Douglas-Peucker over a polyline of (x, y); both ends are always kept."""
+    if len(points) <= 2:
+        return list(points)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    tolerance_sq = tolerance * tolerance
+    while stack:
+        first, last = stack.pop()
+        (x1, y1), (x2, y2) = points[first], points[last]
+        dx, dy = x2 - x1, y2 - y1
+        length_sq = dx * dx + dy * dy
+        farthest, farthest_sq = None, tolerance_sq
+        for i in range(first + 1, last):
+            px, py = points[i]
+            if length_sq:
+                t = max(0.0, min(1.0, ((px - x1) * dx + (py - y1) * dy) / length_sq))
+                ex, ey = px - (x1 + t * dx), py - (y1 + t * dy)
+            else:
+                ex, ey = px - x1, py - y1
+            distance_sq = ex * ex + ey * ey
+            if distance_sq > farthest_sq:
+                farthest, farthest_sq = i, distance_sq
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def _simplify_ring(ring, tolerance):
+    """``simplify_line`` over a closed ring; keeps at least a triangle."""
+    if len(ring) <= 4:
+        return ring
+    simplified = simplify_line(ring, tolerance)
+    return simplified if len(simplified) >= 4 else ring
+
+
+def simplify_geometry(geometry, tolerance, precision=6):
+    """
+    (Multi)polygon ``geometry`` simplified with Douglas-Peucker (``tolerance`` in degrees)
+    and rounded to ``precision`` decimals. Other geometry types yield None.
+    """
+    geometry = geometry or {}
+    if geometry.get('type') == 'Polygon':
+        polygons = [geometry['coordinates']]
+    elif geometry.get('type') == 'MultiPolygon':
+        polygons = geometry['coordinates']
+    else:
+        return None
+    simplified = [
+        [
+            [[round(x, precision), round(y, precision)] for x, y in _simplify_ring([(float(p[0]), float(p[1])) for p in ring], tolerance)]
+            for ring in polygon
+        ]
+        for polygon in polygons
+    ]
+    if geometry['type'] == 'Polygon':
+        return {'type': 'Polygon', 'coordinates': simplified[0]}
+    return {'type': 'MultiPolygon', 'coordinates': simplified}
+
+
+def merge_geometries(first, second):
+    """One MultiPolygon with the polygons of both (multi)polygons."""
+    polygons = []
+    for geometry in (first, second):
+        if not geometry:
+            continue
+        if geometry['type'] == 'Polygon':
+            polygons.append(geometry['coordinates'])
+        else:
+            polygons.extend(geometry['coordinates'])
+    return {'type': 'MultiPolygon', 'coordinates': polygons}
+
+
+def _ring_contains(ring, x, y):
+    """Even-odd ray casting; ``ring`` is a sequence of (x, y)."""
+    inside = False
+    x1, y1 = ring[-1]
+    for x2, y2 in ring:
+        if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+            inside = not inside
+        x1, y1 = x2, y2
+    return inside
+
+
+def _polygon_contains(polygon, x, y):
+    exterior, *holes = polygon
+    return _ring_contains(exterior, x, y) and not any(_ring_contains(hole, x, y) for hole in holes)
+
+
+class PolygonIndex:
+    """Uniform grid over the bounding boxes of GeoJSON-like features' (multi)polygons."""
+
+    def __init__(self, features):
+        self.features = []  # (properties, polygons, bbox)
+        for feature in features:
+            geometry = feature.get('geometry') or {}
+            if geometry.get('type') == 'Polygon':
+                polygons = [geometry['coordinates']]
+            elif geometry.get('type') == 'MultiPolygon':
+                polygons = geometry['coordinates']
+            else:
+                continue
+            polygons = [[[(float(p[0]), float(p[1])) for p in ring] for ring in polygon] for polygon in polygons]
+            xs = [p[0] for polygon in polygons for p in polygon[0]]
+            ys = [p[1] for polygon in polygons for p in polygon[0]]
+            self.features.append((feature.get('properties') or {}, polygons, (min(xs), min(ys), max(xs), max(ys))))
+
+        if not self.features:
+            self.bbox = None
+            self.cells = {}
+            return
+        self.bbox = (
+            min(f[2][0] for f in self.features), min(f[2][1] for f in self.features),
+            max(f[2][2] for f in self.features), max(f[2][3] for f in self.features),
+        )
+        # Cells the size of a typical polygon keep a few candidates per cell even when a
+        # handful of outlying features stretch the overall bounding box. The grid is a
+        # sparse dict, so empty cells cost nothing.
+        widths = sorted(f[2][2] - f[2][0] for f in self.features)
+        heights = sorted(f[2][3] - f[2][1] for f in self.features)
+        span_x, span_y = self.bbox[2] - self.bbox[0], self.bbox[3] - self.bbox[1]
+        self.cell_width = max(widths[len(widths) // 2], span_x / MAX_GRID_SIDE) or 1.0
+        self.cell_height = max(heights[len(heights) // 2], span_y / MAX_GRID_SIDE) or 1.0
+        self.cols = max(1, math.ceil(span_x / self.cell_width))
+        self.rows = max(1, math.ceil(span_y / self.cell_height))
+        self.cells = {}
+        for position, (_, _, (min_x, min_y, max_x, max_y)) in enumerate(self.features):
+            col_min, row_min = self._cell(min_x, min_y)
+            col_max, row_max = self._cell(max_x, max_y)
+            for col in range(col_min, col_max + 1):
+                for row in range(row_min, row_max + 1):
+                    self.cells.setdefault((col, row), []).append(position)
+
+    def _cell(self, x, y):
+        col = min(int((x - self.bbox[0]) / self.cell_width), self.cols - 1)
+        row = min(int((y - self.bbox[1]) / self.cell_height), self.rows - 1)
+        return col, row
+
+    def locate(self, lon, lat):
+        """Properties of the feature containing (lon, lat), or None."""
+        if self.bbox is None or not (self.bbox[0] <= lon <= self.bbox[2] and self.bbox[1] <= lat <= self.bbox[3]):
+            return None
+        for position in self.cells.get(self._cell(lon, lat), ()):
+            properties, polygons, (min_x, min_y, max_x, max_y) = self.features[position]
+            if not (min_x <= lon <= max_x and min_y <= lat <= max_y):
+                continue
+            if any(_polygon_contains(polygon, lon, lat) for polygon in polygons):
+                return properties
+        return None
+
+
+def _ubicacion_features():
+    rows = Ubicacion.objects.exclude(geometry=None).order_by('pk').values_list(*UBICACION_VALUES, 'geometry')
+    for *values, geometry in rows.iterator(chunk_size=500):
+        yield {'properties': dict(zip(UBICACION_VALUES, values)), 'geometry': geometry}
+
+
+def get_polygon_index(version=None):
+    """Index of the stored ubicacion polygons, built once per catalog version."""
+    version = version or get_catalog_version()
+    index = _indexes.get(version)
+    if index is None:
+        with _index_lock:
+            index = _indexes.get(version)
+            if index is None:
+                index = PolygonIndex(_ubicacion_features())
+                _indexes.set(version, index)
+    return index
+
+
+def locate_ubicacion(lat, lon):
+    """``Ubicacion`` values for the barrio polygon containing (lat, lon), or None."""
+    properties = get_polygon_index().locate(lon, lat)
+    if properties is None:
+        return None
+    return {
+        'id': properties['id'], 'municipio_id': properties['municipio_id'], 'codigo': properties['codigo'],
+        'nombre': properties['nombre'], 'loc': properties['loc'], 'zona': properties['zona'],
+        'municipio': properties['municipio__nombre'],
+    }
@@ -0,0 +1,117 @@
+"""
+Batched Municipio/Ubicacion upserts shared by the catalog loading commands.
+
+Rows are buffered and written with one ``bulk_create(update_conflicts=True)`` per batch
+on ``(municipio, codigo)``. Codes are matched to the ones already stored after
+normalization (``'0150'`` from a GeoJSON is the same barrio as ``'150.0'`` from Excel),
+so reloading a catalog from another source updates rows instead of duplicating them.
+Bulk writes skip the model signals, so ``close()`` bumps the catalog version itself.
+"""
+from django.db import connection, transaction
+
+from .catalog import bump_catalog_version
+from .models import Municipio, Ubicacion
+from .search import normalize_code
+
+UBICACION_FIELDS = ('nombre', 'loc', 'zona', 'geometry')
+
+
+class UbicacionWriter:
+
+    def __init__(self, batch_size=1000, dry_run=False, update_fields=('nombre', 'loc', 'zona'), merge=None):
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.update_fields = list(update_fields)
+        # {field: function(old, new)} for fields whose repeated rows are combined, not replaced
+        self.merge = merge or {}
+        self._seen = set()
+        self.municipios = dict(Municipio.objects.values_list('nombre', 'id'))
+        self.municipios_created = 0
+        # municipio id -> {normalized code: (stored codigo, {field: value})}
+        self._existing = {}
+        self._pending = {}
+        self.created = 0
+        self.updated = 0
+
+    def municipio_id(self, nombre):
+        municipio_id = self.municipios.get(nombre)
+        if municipio_id is None:
+            if self.dry_run:
+                municipio_id, created = ('new', nombre), True
+            else:
+                # Another load may have created it since the municipios were read
+                municipio, created = Municipio.objects.get_or_create(nombre=nombre)
+                municipio_id = municipio.pk
+            self.municipios[nombre] = municipio_id
+            if created:
+                self.municipios_created += 1
+        return municipio_id
+
+    def _existing_codes(self, municipio_id):
+        existing = self._existing.get(municipio_id)
+        if existing is None:
+            existing = {}
+            if not isinstance(municipio_id, tuple):
+                rows = Ubicacion.objects.filter(municipio_id=municipio_id).values_list('codigo', *UBICACION_FIELDS[:3])
+                for codigo, *values in rows:
+                    existing[normalize_code(codigo)] = (codigo, dict(zip(UBICACION_FIELDS[:3], values)))
+            self._existing[municipio_id] = existing
+        return existing
+
+    def add(self, municipio, codigo, **values):
+        """
+        Queue one ubicacion. Fields left out of ``values`` keep the stored value, or
+        default to '' for new rows.
+        """
+        municipio_id = self.municipio_id(municipio)
+        existing = self._existing_codes(municipio_id)
+        code = normalize_code(codigo)
+        stored = existing.get(code)
+        if stored is None:
+            stored = (str(codigo), {})
+            existing[code] = stored
+            self.created += 1
+        else:
+            self.updated += 1
+        row = {field: stored[1].get(field, '') for field in ('nombre', 'loc', 'zona')}
+        row.update(values)
+        key = (municipio_id, stored[0])
+        if key in self._seen:
+            for field, merge in self.merge.items():
+                if field in row:
+                    row[field] = merge(self._previous(key, field), row[field])
+        self._seen.add(key)
+        # Otherwise the last row for a code wins; one batch never touches a row twice
+        self._pending[key] = row
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def _previous(self, key, field):
+        """Value of ``field`` already queued or written for ``key`` in this run."""
+        if key in self._pending:
+            return self._pending[key].get(field)
+        if self.dry_run:
+            return None
+        return Ubicacion.objects.filter(municipio_id=key[0], codigo=key[1]).values_list(field, flat=True).first()
+
+    def flush(self):
+        if not self._pending:
+            return 0
+        count = len(self._pending)
+        if not self.dry_run:
+            kwargs = {'update_conflicts': True, 'update_fields': self.update_fields}
+            if connection.features.supports_update_conflicts_with_target:
+                kwargs['unique_fields'] = ['municipio', 'codigo']
+            with transaction.atomic():
+                Ubicacion.objects.bulk_create(
+                    [Ubicacion(municipio_id=municipio_id, codigo=codigo, **row)
+                     for (municipio_id, codigo), row in self._pending.items()],
+                    **kwargs,
+                )
+        self._pending = {}
+        return count
+
+    def close(self):
+        self.flush()
+        if not self.dry_run and (self.created or self.updated or self.municipios_created):
+            transaction.on_commit(bump_catalog_version)
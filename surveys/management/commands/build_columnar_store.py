@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from surveys.columnar import BUILD_CHUNK_SIZE, build_store, store_dir
+from surveys.models import Survey
+
+
+class Command(BaseCommand):
+    help = (
+        'Builds (or rebuilds) the columnar, memory-mapped answer matrix of each survey. '
+        'Run it again after changing the questions or options of a survey.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--survey', type=str, default=None,
+                            help='Only build the store of the survey with this code.')
+        parser.add_argument('--chunk-size', type=int, default=BUILD_CHUNK_SIZE,
+                            help='Responses encoded per batch.')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive.')
+        surveys = Survey.objects.order_by('pk')
+        if options['survey']:
+            surveys = surveys.filter(code=options['survey'])
+            if not surveys.exists():
+                raise CommandError(f"Survey '{options['survey']}' does not exist.")
+
+        for survey in surveys:
+            def progress(done, total):
+                self.stdout.write(f'  {done}/{total} responses')
+
+            rows = build_store(survey.pk, chunk_size=options['chunk_size'], progress=progress)
+            self.stdout.write(self.style.SUCCESS(f'{survey.code}: {rows} rows in {store_dir(survey.pk)}.'))
@@ -0,0 +1,88 @@
+import gzip
+import hashlib
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from surveys.catalog import get_catalog_version
+from surveys.models import Ubicacion
+from surveys.topology import DEFAULT_ZOOMS, MAP_ARTIFACTS_SUBDIR, Topology, map_artifacts_dir, map_manifest_path
+
+ARTIFACT_PREFIX = 'ubicaciones-z'
+
+
+def _write_atomic(path, data):
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class Command(BaseCommand):
+    help = ('Builds the per-zoom, simplified and quantized topology of the Ubicacion polygons '
+            'used by the map picker, as content-hashed files under MEDIA_ROOT/map/.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--zooms', type=str, default=','.join(map(str, DEFAULT_ZOOMS)),
+                            help='Comma-separated zoom levels to build.')
+        parser.add_argument('--municipio', type=str, default=None,
+                            help='Only include the ubicaciones of this municipio.')
+        parser.add_argument('--keep-old', action='store_true',
+                            help='Do not delete the payloads of previous builds.')
+
+    def handle(self, *args, **options):
+        try:
+            zooms = sorted({int(zoom) for zoom in options['zooms'].split(',') if zoom.strip()})
+        except ValueError:
+            raise CommandError('--zooms must be a comma-separated list of integers.')
+        if not zooms or any(not 0 <= zoom <= 22 for zoom in zooms):
+            raise CommandError('Zoom levels must be between 0 and 22.')
+
+        catalog_version = get_catalog_version()
+        ubicaciones = Ubicacion.objects.exclude(geometry=None).order_by('pk')
+        if options['municipio']:
+            ubicaciones = ubicaciones.filter(municipio__nombre=options['municipio'])
+        rows = ubicaciones.values_list('id', 'nombre', 'zona', 'municipio_id', 'geometry')
+        topology = Topology(
+            (pk, {'nombre': nombre, 'zona': zona, 'municipio_id': municipio_id}, geometry)
+            for pk, nombre, zona, municipio_id, geometry in rows.iterator(chunk_size=500)
+        )
+        if not topology.objects:
+            raise CommandError('No ubicaciones with geometry. Load them first with load_geojson.')
+        self.stdout.write(f'{len(topology.objects)} ubicaciones, {len(topology.arcs)} shared arcs.')
+
+        output_dir = map_artifacts_dir()
+        output_dir.mkdir(parents=True, exist_ok=True)
+        manifest = {
+            'catalog_version': catalog_version,
+            'built_at': timezone.now().isoformat(),
+            'bbox': list(topology.bbox),
+            'object': 'ubicaciones',
+            'zooms': {},
+        }
+        for zoom in zooms:
+            body = json.dumps(topology.encode(zoom), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            gzip_body = gzip.compress(body, mtime=0)
+            filename = f'{ARTIFACT_PREFIX}{zoom}.{hashlib.sha256(body).hexdigest()[:12]}.json'
+            _write_atomic(output_dir / filename, body)
+            # Served as-is by web servers with precompressed-file support (gzip_static)
+            _write_atomic(output_dir / f'{filename}.gz', gzip_body)
+            manifest['zooms'][str(zoom)] = {
+                'url': f'{settings.MEDIA_URL}{MAP_ARTIFACTS_SUBDIR}/{filename}',
+                'bytes': len(body),
+                'gzip_bytes': len(gzip_body),
+            }
+            self.stdout.write(f'  z{zoom}: {filename} ({len(body) / 1024:.1f} KiB, {len(gzip_body) / 1024:.1f} KiB gzip)')
+
+        _write_atomic(map_manifest_path(), json.dumps(manifest, indent=2).encode('utf-8'))
+
+        if not options['keep_old']:
+            current = {entry['url'].rsplit('/', 1)[1] for entry in manifest['zooms'].values()}
+            for path in output_dir.glob(f'{ARTIFACT_PREFIX}*.json*'):
+                if (path.name[:-3] if path.name.endswith('.gz') else path.name) not in current:
+                    path.unlink()
+
+        self.stdout.write(self.style.SUCCESS(f'Map topology written to {output_dir}.'))
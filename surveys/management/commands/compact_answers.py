@@ -0,0 +1,97 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection, transaction
+
+from surveys.models import Answer, Survey
+from surveys.persistence import ANSWER_HAS_VALUE
+
+
+def _table_bytes(table):
+    """On-disk size of ``table`` (data plus indexes) when the backend can report it."""
+    with connection.cursor() as cursor:
+        try:
+            if connection.vendor == 'postgresql':
+                cursor.execute("SELECT pg_total_relation_size(%s)", [table])
+            elif connection.vendor == 'mysql':
+                cursor.execute(
+                    "SELECT data_length + index_length FROM information_schema.tables "
+                    "WHERE table_schema = DATABASE() AND table_name = %s", [table]
+                )
+            elif connection.vendor == 'sqlite':
+                # Needs SQLite built with the dbstat virtual table
+                cursor.execute("SELECT SUM(pgsize) FROM dbstat WHERE name = %s", [table])
+            else:
+                return None
+        except DatabaseError:
+            return None
+        row = cursor.fetchone()
+    return int(row[0]) if row and row[0] is not None else None
+
+
+def _tables_bytes(tables):
+    sizes = [_table_bytes(table) for table in tables]
+    return None if any(size is None for size in sizes) else sum(sizes)
+
+
+class Command(BaseCommand):
+    help = 'Deletes Answer rows that hold no value, in small batches, and reports what was reclaimed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--survey', type=str, default=None,
+                            help='Only compact the answers of the survey with this code.')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='Range of Answer ids scanned per batch.')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to pause between batches to let other writers through.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the empty answers.')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        if chunk_size < 1:
+            raise CommandError('--chunk-size must be positive.')
+
+        answers = Answer.objects.all()
+        if options['survey']:
+            try:
+                survey = Survey.objects.get(code=options['survey'])
+            except Survey.DoesNotExist:
+                raise CommandError(f"Survey '{options['survey']}' does not exist.")
+            answers = answers.filter(response__survey=survey)
+
+        empty_answers = answers.exclude(ANSWER_HAS_VALUE)
+        if options['dry_run']:
+            self.stdout.write(f'{empty_answers.count()} empty answers of {answers.count()} would be deleted.')
+            return
+
+        tables = [Answer._meta.db_table, Answer.options.through._meta.db_table,
+                  Answer.selected_ubicaciones.through._meta.db_table]
+        size_before = _tables_bytes(tables)
+
+        first = answers.order_by('pk').values_list('pk', flat=True).first()
+        last = answers.order_by('-pk').values_list('pk', flat=True).first()
+        deleted = 0
+        if first is not None:
+            # Walk the primary key in fixed windows so every statement stays short
+            for low in range(first, last + 1, chunk_size):
+                with transaction.atomic():
+                    pks = list(empty_answers.filter(pk__gte=low, pk__lt=low + chunk_size).values_list('pk', flat=True))
+                    if pks:
+                        deleted += Answer.objects.filter(pk__in=pks).delete()[1].get(Answer._meta.label, 0)
+                if pks:
+                    self.stdout.write(f'  ids {low}-{low + chunk_size - 1}: {len(pks)} deleted')
+                    if options['sleep']:
+                        time.sleep(options['sleep'])
+
+        size_after = _tables_bytes(tables)
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} empty answers.'))
+        if size_before is not None and size_after is not None:
+            self.stdout.write(
+                f'Answer tables: {size_before / 1024:.1f} KiB -> {size_after / 1024:.1f} KiB '
+                f'({(size_before - size_after) / 1024:.1f} KiB reclaimed).'
+            )
+            if connection.vendor in ('mysql', 'sqlite'):
+                self.stdout.write('Run OPTIMIZE TABLE (MySQL) or VACUUM (SQLite) to return the space to the filesystem.')
+        else:
+            self.stdout.write('This database does not report table sizes.')
@@ -1,77 +1,95 @@
-import json
 from django.core.management.base import BaseCommand, CommandError
-from surveys.models import GeoJSONFile, Barrio
+
+from surveys.geo import iter_features, merge_geometries, simplify_geometry
+from surveys.loaders import UbicacionWriter
+
 
 class Command(BaseCommand):
-    help = 'Loads GeoJSON data from an uploaded GeoJSONFile into the Barrio model.'
+    help = ('Streams the features of a GeoJSON FeatureCollection into Municipio/Ubicacion, '
+            'storing a simplified geometry with each ubicacion.')
 
     def add_arguments(self, parser):
-        parser.add_argument('geojson_file_id', type=int,
-                            help='The ID of the GeoJSONFile instance to load.')
+        parser.add_argument('geojson_file', type=str,
+                            help='Path to the GeoJSON file (e.g. media/geojson_files/barrios_cartagena.geojson).')
+        parser.add_argument('--municipio', type=str, default=None,
+                            help='Municipio every feature belongs to, when the features do not carry one.')
+        parser.add_argument('--municipio_property', type=str, default='MUNICIPIO',
+                            help='The name of the property in GeoJSON features with the municipio name.')
         parser.add_argument('--name_property', type=str, default='NOMBRE',
-                            help='The name of the property in GeoJSON features to use for the Barrio name.')
+                            help='The name of the property in GeoJSON features to use for the Ubicacion name.')
         parser.add_argument('--code_property', type=str, default='CODIGO',
-                            help='The name of the property in GeoJSON features to use for the Barrio code.')
+                            help='The name of the property in GeoJSON features to use for the Ubicacion code.')
+        parser.add_argument('--loc_property', type=str, default='LOC',
+                            help='The name of the property in GeoJSON features to use for the Ubicacion LOC.')
+        parser.add_argument('--zona_property', type=str, default='ZONA',
+                            help='The name of the property in GeoJSON features to use for the Ubicacion ZONA.')
+        parser.add_argument('--tolerance', type=float, default=0.00002,
+                            help='Simplification tolerance in degrees (0.00002 is about 2 m).')
+        parser.add_argument('--precision', type=int, default=6,
+                            help='Decimals kept in the stored coordinates.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Ubicaciones written per statement.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Read and simplify the features without writing anything.')
 
     def handle(self, *args, **options):
-        geojson_file_id = options['geojson_file_id']
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive.')
         name_property = options['name_property']
         code_property = options['code_property']
 
+        writer = UbicacionWriter(
+            batch_size=options['batch_size'], dry_run=options['dry_run'],
+            update_fields=('nombre', 'loc', 'zona', 'geometry'),
+            # Barrios split in several features share a code: keep every polygon
+            merge={'geometry': merge_geometries},
+        )
+        skipped = 0
+        points_in = points_out = 0
         try:
-            geojson_file_instance = GeoJSONFile.objects.get(pk=geojson_file_id)
-        except GeoJSONFile.DoesNotExist:
-            raise CommandError(f'GeoJSONFile with ID {geojson_file_id} does not exist.')
+            with open(options['geojson_file'], encoding='utf-8') as f:
+                for number, feature in enumerate(iter_features(f), start=1):
+                    properties = feature.get('properties') or {}
+                    municipio = properties.get(options['municipio_property']) or options['municipio']
+                    code = properties.get(code_property)
+                    name = properties.get(name_property)
+                    geometry = simplify_geometry(feature.get('geometry'), options['tolerance'], options['precision'])
+                    if not (municipio and code not in (None, '') and name and geometry):
+                        skipped += 1
+                        self.stdout.write(self.style.WARNING(
+                            f'Skipping feature {number}: missing municipio, "{code_property}", '
+                            f'"{name_property}" or polygon geometry.'
+                        ))
+                        continue
 
-        self.stdout.write(self.style.SUCCESS(f'Loading data from {geojson_file_instance.name}...'))
+                    values = {'nombre': str(name).strip(), 'geometry': geometry}
+                    for field in ('loc', 'zona'):
+                        value = properties.get(options[f'{field}_property'])
+                        if value not in (None, ''):
+                            values[field] = str(value)
+                    writer.add(str(municipio).strip(), str(code).strip(), **values)
 
-        try:
-            with geojson_file_instance.file.open('r') as f:
-                geojson_data = json.load(f)
-        except json.JSONDecodeError:
-            raise CommandError(f'Invalid GeoJSON file: {geojson_file_instance.file.name}')
-        except Exception as e:
+                    points_in += _count_points(feature.get('geometry'))
+                    points_out += _count_points(geometry)
+                    if number % 1000 == 0:
+                        self.stdout.write(f'  {number} features read...')
+        except OSError as e:
             raise CommandError(f'Error reading GeoJSON file: {e}')
+        except ValueError as e:
+            raise CommandError(f'Invalid GeoJSON file: {e}')
+        writer.close()
 
-        if geojson_data.get('type') != 'FeatureCollection':
-            raise CommandError('GeoJSON file must be a FeatureCollection.')
-
-        features = geojson_data.get('features', [])
-        if not features:
-            self.stdout.write(self.style.WARNING('No features found in the GeoJSON file.'))
-            return
-
-        created_count = 0
-        updated_count = 0
-
-        for feature in features:
-            properties = feature.get('properties', {})
-            geometry = feature.get('geometry', {})
-
-            barrio_name = properties.get(name_property)
-            barrio_code = properties.get(code_property)
-
-            if not barrio_name:
-                self.stdout.write(self.style.WARNING(
-                    f'Skipping feature with no "{name_property}" property: {properties}'
-                ))
-                continue
-
-            barrio, created = Barrio.objects.update_or_create(
-                name=barrio_name,
-                defaults={
-                    'geometry': geometry,
-                    'code': barrio_code,
-                }
-            )
-
-            if created:
-                created_count += 1
-                self.stdout.write(self.style.SUCCESS(f'Created Barrio: {barrio.name}'))
-            else:
-                updated_count += 1
-                self.stdout.write(self.style.SUCCESS(f'Updated Barrio: {barrio.name}'))
-
+        prefix = '[dry-run] ' if options['dry_run'] else ''
         self.stdout.write(self.style.SUCCESS(
-            f'Successfully loaded GeoJSON data. Created {created_count} barrios, updated {updated_count} barrios.'
+            f'{prefix}Loaded GeoJSON data. Created {writer.created} ubicaciones, updated {writer.updated}, '
+            f'skipped {skipped}; {writer.municipios_created} new municipios.'
         ))
+        if points_in:
+            self.stdout.write(f'Geometry simplified from {points_in} to {points_out} points.')
+
+
+def _count_points(geometry):
+    geometry = geometry or {}
+    coordinates = geometry.get('coordinates') or []
+    polygons = [coordinates] if geometry.get('type') == 'Polygon' else coordinates
+    return sum(len(ring) for polygon in polygons for ring in polygon)
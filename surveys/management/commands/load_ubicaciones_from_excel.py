@@ -1,6 +1,7 @@
 import openpyxl
 from django.core.management.base import BaseCommand, CommandError
-from surveys.models import Municipio, Ubicacion, UbicacionListFile
+from surveys.loaders import UbicacionWriter
+from surveys.models import UbicacionListFile
 
 class Command(BaseCommand):
     help = 'Loads ubicacion data from an uploaded Excel (.xlsx) file into the Municipio and Ubicacion models.'
@@ -18,14 +19,17 @@ class Command(BaseCommand):
                             help='The name of the column for the Ubicacion LOC.')
         parser.add_argument('--zona_column', type=str, default='ZONA',
                             help='The name of the column for the Ubicacion ZONA.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Ubicaciones written per statement.')
+        parser.add_argument('--progress-every', type=int, default=5000,
+                            help='Print a progress line every this many rows (0 disables it).')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Read and validate the file without writing anything.')
 
     def handle(self, *args, **options):
         ubicacion_list_file_id = options['ubicacion_list_file_id']
-        municipio_column = options['municipio_column']
-        code_column = options['code_column']
-        name_column = options['name_column']
-        loc_column = options['loc_column']
-        zona_column = options['zona_column']
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive.')
 
         try:
             ubicacion_list_file_instance = UbicacionListFile.objects.get(pk=ubicacion_list_file_id)
@@ -35,54 +39,45 @@ class Command(BaseCommand):
         self.stdout.write(self.style.SUCCESS(f'Loading data from {ubicacion_list_file_instance.name}...'))
 
         try:
-            workbook = openpyxl.load_workbook(ubicacion_list_file_instance.file.path)
+            # Read-only mode streams the sheet row by row instead of loading every cell
+            workbook = openpyxl.load_workbook(ubicacion_list_file_instance.file.path, read_only=True, data_only=True)
             sheet = workbook.active
         except Exception as e:
             raise CommandError(f'Error reading Excel file: {e}')
 
-        header = [cell.value for cell in sheet[1]]
         try:
-            municipio_col_idx = header.index(municipio_column)
-            code_col_idx = header.index(code_column)
-            name_col_idx = header.index(name_column)
-            loc_col_idx = header.index(loc_column)
-            zona_col_idx = header.index(zona_column)
-        except ValueError as e:
-            raise CommandError(f'Column not found in Excel file: {e}. Available columns: {", ".join(header)}')
+            rows = sheet.iter_rows(values_only=True)
+            header = list(next(rows, ()))
+            try:
+                columns = [header.index(options[f'{name}_column']) for name in ('municipio', 'code', 'name', 'loc', 'zona')]
+            except ValueError as e:
+                available = ", ".join(str(column) for column in header if column is not None)
+                raise CommandError(f'Column not found in Excel file: {e}. Available columns: {available}')
 
-        created_count = 0
-        updated_count = 0
+            writer = UbicacionWriter(batch_size=options['batch_size'], dry_run=options['dry_run'])
+            skipped = 0
+            for row_idx, row_values in enumerate(rows, start=2):
+                municipio_name, ubicacion_code, ubicacion_name, ubicacion_loc, ubicacion_zona = (
+                    row_values[index] if index < len(row_values) else None for index in columns
+                )
 
-        for row_idx in range(2, sheet.max_row + 1):
-            row_values = [cell.value for cell in sheet[row_idx]]
-            
-            municipio_name = row_values[municipio_col_idx]
-            ubicacion_code = row_values[code_col_idx]
-            ubicacion_name = row_values[name_col_idx]
-            ubicacion_loc = row_values[loc_col_idx]
-            ubicacion_zona = row_values[zona_col_idx]
+                if not all([municipio_name, ubicacion_code, ubicacion_name, ubicacion_loc]):
+                    skipped += 1
+                    self.stdout.write(self.style.WARNING(f'Skipping row {row_idx} due to missing data in required columns.'))
+                    continue
 
-            if not all([municipio_name, ubicacion_code, ubicacion_name, ubicacion_loc]):
-                self.stdout.write(self.style.WARNING(f'Skipping row {row_idx} due to missing data in required columns.'))
-                continue
-
-            municipio, _ = Municipio.objects.get_or_create(nombre=municipio_name)
-
-            ubicacion, created = Ubicacion.objects.update_or_create(
-                municipio=municipio,
-                codigo=ubicacion_code,
-                defaults={
-                    'nombre': ubicacion_name,
-                    'loc': ubicacion_loc,
-                    'zona': ubicacion_zona or '',
-                }
-            )
-
-            if created:
-                created_count += 1
-            else:
-                updated_count += 1
+                writer.add(
+                    str(municipio_name), str(ubicacion_code),
+                    nombre=str(ubicacion_name), loc=str(ubicacion_loc), zona=str(ubicacion_zona or ''),
+                )
+                if options['progress_every'] and (row_idx - 1) % options['progress_every'] == 0:
+                    self.stdout.write(f'  {row_idx - 1} rows read...')
+            writer.close()
+        finally:
+            workbook.close()
 
+        prefix = '[dry-run] ' if options['dry_run'] else ''
         self.stdout.write(self.style.SUCCESS(
-            f'Successfully loaded ubicacion data. Created {created_count} ubicaciones, updated {updated_count} ubicaciones.'
+            f'{prefix}Successfully loaded ubicacion data. Created {writer.created} ubicaciones, '
+            f'updated {writer.updated} ubicaciones, skipped {skipped} rows; {writer.municipios_created} new municipios.'
         ))
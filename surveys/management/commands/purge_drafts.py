@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from surveys.drafts import purge_expired_drafts
+from surveys.models import ResponseDraft
+
+
+class Command(BaseCommand):
+    help = 'Deletes expired wizard drafts (ResponseDraft) in small chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of drafts deleted per statement.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many drafts have expired.')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        if options['dry_run']:
+            expired = ResponseDraft.objects.filter(expires_at__lte=now).count()
+            self.stdout.write(f'{expired} expired drafts would be deleted.')
+            return
+
+        drafts, sections = purge_expired_drafts(chunk_size=options['chunk_size'], now=now)
+        self.stdout.write(self.style.SUCCESS(f'Deleted {drafts} expired drafts ({sections} saved sections).'))
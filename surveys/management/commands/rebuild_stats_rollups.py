@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from surveys.models import Survey
+from surveys.rollups import rebuild
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the statistics rollups from the stored answers (backfill or repair).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--survey', type=str, default=None,
+                            help='Only rebuild the rollups of the survey with this code.')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Responses read per batch.')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive.')
+        surveys = Survey.objects.order_by('pk')
+        if options['survey']:
+            surveys = surveys.filter(code=options['survey'])
+            if not surveys.exists():
+                raise CommandError(f"Survey '{options['survey']}' does not exist.")
+
+        for survey in surveys:
+            def progress(done, total):
+                self.stdout.write(f'  {done}/{total} responses')
+
+            # One transaction per survey so readers never see it half rebuilt
+            with transaction.atomic():
+                total = rebuild(survey.pk, chunk_size=options['chunk_size'], progress=progress)
+            self.stdout.write(self.style.SUCCESS(f'{survey.code}: rebuilt from {total} responses.'))
@@ -0,0 +1,322 @@
+"""
+Per-view request metrics (latency, DB queries, repeated SQL) in Prometheus text format.
+
+Metrics are aggregated in memory by each worker process. Recording a request costs a
+couple of dict updates under a lock, so the middleware can stay enabled in production.
+When ``SURVEYS_METRICS_DIR`` is set, a background thread writes each worker's totals to
+its own file there every few seconds and the endpoint adds up the files of every worker,
+so a scrape sees the whole server and not just the worker that happened to answer it.
+Like prometheus_client's multiprocess mode, the files of workers that exited are folded
+into an archive, so recycled workers neither vanish from the counters nor pile up.
+"""
+import bisect
+import hashlib
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connection
+
+from .locks import file_lock
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+# A statement executed this many times in one request is reported as a likely N+1
+REPEATED_QUERY_THRESHOLD = getattr(settings, 'SURVEYS_METRICS_REPEATED_QUERY_THRESHOLD', 5)
+# Bound the number of distinct repeated statements kept per view
+MAX_REPEATED_SIGNATURES = 20
+UNRESOLVED_VIEW = '<unresolved>'
+# Seconds between writes of a worker's totals to its file
+FLUSH_INTERVAL = 5.0
+ARCHIVE_FILE = 'archive.json'
+
+logger = logging.getLogger(__name__)
+
+
+def metrics_dir():
+    """Directory shared by the workers, or None to keep the metrics per process."""
+    directory = getattr(settings, 'SURVEYS_METRICS_DIR', None)
+    return Path(directory) if directory else None
+
+
+def _pid_alive(pid):
+    if os.name != 'posix':
+        # Signal 0 is CTRL_C_EVENT on Windows: keep every file there
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read(path):
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        # Removed or being replaced meanwhile
+        return {}
+
+
+def _write(path, views):
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps(views))
+    os.replace(tmp, path)
+
+
+class _ViewStats:
+    __slots__ = ('count', 'latency_sum', 'latency_buckets', 'query_sum', 'query_buckets', 'db_time_sum', 'repeated')
+
+    def __init__(self):
+        self.count = 0
+        self.latency_sum = 0.0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.query_sum = 0
+        self.query_buckets = [0] * (len(QUERY_COUNT_BUCKETS) + 1)
+        self.db_time_sum = 0.0
+        # sql hash -> [requests in which it repeated, total executions in those requests]
+        self.repeated = {}
+
+
+def _merge(into, values):
+    count, latency_sum, latency_buckets, query_sum, query_buckets, db_time_sum, repeated = values
+    if into is None:
+        return [count, latency_sum, list(latency_buckets), query_sum, list(query_buckets), db_time_sum,
+                {k: list(v) for k, v in repeated.items()}]
+    into[0] += count
+    into[1] += latency_sum
+    into[2] = [a + b for a, b in zip(into[2], latency_buckets)]
+    into[3] += query_sum
+    into[4] = [a + b for a, b in zip(into[4], query_buckets)]
+    into[5] += db_time_sum
+    for signature, (requests, executions) in repeated.items():
+        entry = into[6].setdefault(signature, [0, 0])
+        entry[0] += requests
+        entry[1] += executions
+    return into
+
+
+class MetricsRegistry:
+    def __init__(self, directory=None):
+        self._lock = threading.Lock()
+        # The flusher thread and a scrape may write the file at the same time
+        self._file_lock = threading.Lock()
+        self._views = {}
+        self.directory = directory
+        self._pid = None
+        self._file_name = None
+        self._dirty = False
+
+    def _start_flusher(self):
+        # Started lazily in each worker (under the lock): a thread of the master does not survive the fork
+        if self._pid is not None:
+            # Forked after recording: the parent's totals are in the parent's file
+            self._views.clear()
+        self._pid = os.getpid()
+        # A reused pid never overwrites the file of the worker that had it before
+        self._file_name = f'{self._pid}-{secrets.token_hex(4)}.json'
+        threading.Thread(target=self._flush_loop, name='surveys-metrics', daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            if self._dirty:
+                self.flush()
+
+    def flush(self):
+        """Write this worker's totals to its file in the shared directory."""
+        if self.directory is None or self._pid != os.getpid():
+            # Nothing recorded in this process yet
+            return
+        with self._lock:
+            self._dirty = False
+        snapshot = self._snapshot()
+        try:
+            with self._file_lock:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                _write(self.directory / self._file_name, snapshot)
+        except OSError:
+            logger.exception('Could not write the request metrics to %s', self.directory)
+
+    def record(self, view_name, latency, query_count, db_time, repeated):
+        with self._lock:
+            if self.directory is not None and self._pid != os.getpid():
+                self._start_flusher()
+            self._dirty = True
+            stats = self._views.get(view_name)
+            if stats is None:
+                stats = self._views[view_name] = _ViewStats()
+            stats.count += 1
+            stats.latency_sum += latency
+            stats.latency_buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+            stats.query_sum += query_count
+            stats.query_buckets[bisect.bisect_left(QUERY_COUNT_BUCKETS, query_count)] += 1
+            stats.db_time_sum += db_time
+            for sql, executions in repeated:
+                signature = sql_signature(sql)
+                entry = stats.repeated.get(signature)
+                if entry is None:
+                    if len(stats.repeated) >= MAX_REPEATED_SIGNATURES:
+                        continue
+                    entry = stats.repeated[signature] = [0, 0]
+                    # The label only carries the hash: log the statement it stands for once
+                    logger.info('Repeated SQL %s in %s: %s', signature, view_name, sql)
+                entry[0] += 1
+                entry[1] += executions
+
+    def reset(self):
+        with self._lock:
+            self._views.clear()
+
+    def _snapshot(self):
+        with self._lock:
+            return {
+                name: [s.count, s.latency_sum, list(s.latency_buckets), s.query_sum,
+                       list(s.query_buckets), s.db_time_sum, {k: list(v) for k, v in s.repeated.items()}]
+                for name, s in self._views.items()
+            }
+
+    def collect(self):
+        """Totals per view of every worker that ever wrote its file, this one included."""
+        if self.directory is None:
+            return self._snapshot()
+        self.flush()
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # One scrape at a time, so a dead worker's file is archived exactly once
+            with file_lock(self.directory / '.lock'):
+                return self._collect_files()
+        except OSError:
+            logger.exception('Could not read the request metrics in %s', self.directory)
+            return self._snapshot()
+
+    def _collect_files(self):
+        archive_path = self.directory / ARCHIVE_FILE
+        archive = _read(archive_path)
+        live = []
+        dead = []
+        for path in self.directory.glob('*.json'):
+            if path.name == ARCHIVE_FILE:
+                continue
+            pid = path.stem.split('-', 1)[0]
+            (dead if pid.isdigit() and not _pid_alive(int(pid)) else live).append(path)
+        if dead:
+            for path in dead:
+                for name, values in _read(path).items():
+                    archive[name] = _merge(archive.get(name), values)
+            _write(archive_path, archive)
+            for path in dead:
+                path.unlink(missing_ok=True)
+
+        totals = {}
+        for views in (archive, *(_read(path) for path in live)):
+            for name, values in views.items():
+                totals[name] = _merge(totals.get(name), values)
+        return totals
+
+    def render(self):
+        snapshot = self.collect()
+
+        lines = []
+
+        def histogram(metric, help_text, buckets, index):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            for name, values in sorted(snapshot.items()):
+                view = _label(name)
+                cumulative = 0
+                for bound, value in zip(buckets, values[index + 1]):
+                    cumulative += value
+                    lines.append(f'{metric}_bucket{{view="{view}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{view="{view}",le="+Inf"}} {values[0]}')
+                lines.append(f'{metric}_sum{{view="{view}"}} {values[index]}')
+                lines.append(f'{metric}_count{{view="{view}"}} {values[0]}')
+
+        histogram('surveys_request_duration_seconds', 'Request latency per URL name.', LATENCY_BUCKETS, 1)
+        histogram('surveys_request_db_queries', 'Database queries per request per URL name.', QUERY_COUNT_BUCKETS, 3)
+
+        lines.append('# HELP surveys_db_query_duration_seconds_total Time spent in database queries per URL name.')
+        lines.append('# TYPE surveys_db_query_duration_seconds_total counter')
+        for name, values in sorted(snapshot.items()):
+            lines.append(f'surveys_db_query_duration_seconds_total{{view="{_label(name)}"}} {values[5]:.6f}')
+
+        lines.append(f'# HELP surveys_repeated_query_requests_total Requests that ran the same SQL at least {REPEATED_QUERY_THRESHOLD} times (likely N+1).')
+        lines.append('# TYPE surveys_repeated_query_requests_total counter')
+        for name, values in sorted(snapshot.items()):
+            for signature, (requests, _) in sorted(values[6].items()):
+                lines.append(f'surveys_repeated_query_requests_total{{view="{_label(name)}",sql="{signature}"}} {requests}')
+
+        lines.append('# HELP surveys_repeated_query_executions_total Executions of repeated SQL statements.')
+        lines.append('# TYPE surveys_repeated_query_executions_total counter')
+        for name, values in sorted(snapshot.items()):
+            for signature, (_, executions) in sorted(values[6].items()):
+                lines.append(f'surveys_repeated_query_executions_total{{view="{_label(name)}",sql="{signature}"}} {executions}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _label(value):
+    return ' '.join(str(value).split()).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def sql_signature(sql):
+    """Short stable label for a statement; the text itself is logged when first seen."""
+    return hashlib.sha1(sql.encode('utf-8')).hexdigest()[:12]
+
+
+registry = MetricsRegistry(metrics_dir())
+
+
+class _QueryRecorder:
+    __slots__ = ('count', 'time', 'statements')
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.time += time.perf_counter() - start
+            self.count += 1
+            # Statements are parameterized, so identical text means the same query shape
+            self.statements[sql] += 1
+
+
+class RequestMetricsMiddleware:
+    """Record latency, query count, DB time and repeated SQL for every request."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = getattr(settings, 'SURVEYS_METRICS_ENABLED', True)
+
+    def __call__(self, request):
+        if not self.enabled:
+            return self.get_response(request)
+
+        recorder = _QueryRecorder()
+        start = time.perf_counter()
+        with connection.execute_wrapper(recorder):
+            response = self.get_response(request)
+        latency = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        view_name = match.view_name if match is not None else UNRESOLVED_VIEW
+        repeated = [
+            (sql, executions)
+            for sql, executions in recorder.statements.items()
+            if executions >= REPEATED_QUERY_THRESHOLD
+        ]
+        registry.record(view_name, latency, recorder.count, recorder.time, repeated)
+        return response
@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-17 02:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0018_responsedraft'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ubicacion',
+            name='geometry',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
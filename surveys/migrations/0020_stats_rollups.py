@@ -0,0 +1,87 @@
+# Generated by Django 4.2 on 2026-10-17 00:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0019_ubicacion_geometry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UbicacionDayRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('count', models.IntegerField(default=0)),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='surveys.question')),
+                ('survey', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='surveys.survey')),
+                ('ubicacion', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='surveys.ubicacion')),
+            ],
+            options={
+                'unique_together': {('survey', 'question', 'ubicacion', 'day')},
+            },
+        ),
+        migrations.CreateModel(
+            name='ResponseDayRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('responses', models.IntegerField(default=0)),
+                ('last_response_at', models.DateTimeField(blank=True, null=True)),
+                ('survey', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='surveys.survey')),
+            ],
+            options={
+                'unique_together': {('survey', 'day')},
+            },
+        ),
+        migrations.CreateModel(
+            name='QuestionDayRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('answered', models.IntegerField(default=0)),
+                ('not_applicable', models.IntegerField(default=0)),
+                ('value_count', models.IntegerField(default=0)),
+                ('value_sum', models.FloatField(default=0)),
+                ('value_sum_sq', models.FloatField(default=0)),
+                ('value_min', models.DecimalField(blank=True, decimal_places=2, max_digits=14, null=True)),
+                ('value_max', models.DecimalField(blank=True, decimal_places=2, max_digits=14, null=True)),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='surveys.question')),
+                ('survey', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='surveys.survey')),
+            ],
+            options={
+                'unique_together': {('survey', 'question', 'day')},
+            },
+        ),
+        migrations.CreateModel(
+            name='OptionDayRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('count', models.IntegerField(default=0)),
+                ('option', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='surveys.option')),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='surveys.question')),
+                ('survey', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='surveys.survey')),
+            ],
+            options={
+                'unique_together': {('survey', 'question', 'option', 'day')},
+            },
+        ),
+        migrations.CreateModel(
+            name='InterviewerDayRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('responses', models.IntegerField(default=0)),
+                ('interviewer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='surveys.interviewer')),
+                ('survey', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='surveys.survey')),
+            ],
+            options={
+                'unique_together': {('survey', 'interviewer', 'day')},
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-17 00:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0020_stats_rollups'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='responseset',
+            index=models.Index(fields=['survey', 'created_at'], name='surveys_res_survey__f8a66c_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations
+
+
+def backfill_rollups(apps, schema_editor):
+    # The rollups are derived data: build them with the same code the
+    # rebuild_stats_rollups command uses so existing surveys keep their stats.
+    from surveys.rollups import rebuild
+
+    ResponseSet = apps.get_model('surveys', 'ResponseSet')
+    survey_ids = ResponseSet.objects.order_by().values_list('survey_id', flat=True).distinct()
+    for survey_id in list(survey_ids):
+        rebuild(survey_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0021_responseset_survey_created_at_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
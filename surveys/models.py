@@ -62,6 +62,8 @@ class Ubicacion(models.Model):
     nombre = models.CharField(max_length=255)
     loc = models.CharField(max_length=255)
     zona = models.CharField(max_length=255)
+    # Simplified (multi)polygon loaded by load_geojson, for the map and GPS lookup
+    geometry = models.JSONField(null=True, blank=True)
 
     def __str__(self):
         return f"{self.municipio.nombre} - {self.nombre}"
@@ -129,7 +131,20 @@ class Question(models.Model):
         if self.pk and self.options.filter(is_other_trigger=True).count() > 1:
             from django.core.exceptions import ValidationError
             raise ValidationError("Solo una opción por pregunta puede ser marcada como la opción 'Otro'.")
+        if self.has_dependency_cycle():
+            from django.core.exceptions import ValidationError
+            raise ValidationError({'depends_on': "Esta dependencia crea un ciclo entre preguntas."})
 
+    def has_dependency_cycle(self):
+        """Whether the (possibly unsaved) dependency chain leads back to a question already in it."""
+        seen = {self.pk} if self.pk else set()
+        parent_id = self.depends_on_id
+        while parent_id is not None:
+            if parent_id in seen:
+                return True
+            seen.add(parent_id)
+            parent_id = Question.objects.filter(pk=parent_id).values_list('depends_on_id', flat=True).first()
+        return False
 
     class Meta:
         unique_together = ("section", "code")
@@ -183,7 +198,11 @@ class ResponseSet(models.Model):
     data_protection_accepted = models.BooleanField(default=False) # New field for data protection consent
     class Meta:
         unique_together = ("survey", "identificacion", "document_type")
-        indexes = [models.Index(fields=["survey", "identificacion", "document_type"])]
+        indexes = [
+            models.Index(fields=["survey", "identificacion", "document_type"]),
+            # Date range scans of one survey (stats filters, hourly time series)
+            models.Index(fields=["survey", "created_at"]),
+        ]
     def __str__(self): return f"{self.survey.code} · {self.identificacion} · {self.created_at:%Y-%m-%d}"
 
 class Answer(models.Model):
@@ -233,6 +252,85 @@ class Answer(models.Model):
                 raise ValidationError(f"'{q.code}' admite máximo {q.max_choices} selecciones de ubicaciones.")
 
 
+# In-progress answers of the step-by-step wizard, one row per completed section so each
+# step writes only the section that changed. Expired drafts are removed by purge_drafts.
+class ResponseDraft(models.Model):
+    token = models.CharField(max_length=64, unique=True)
+    survey = models.ForeignKey(Survey, on_delete=models.CASCADE, related_name="drafts")
+    respondent_data = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+    def __str__(self): return f"{self.survey_id} · {self.respondent_data.get('identificacion', '')} · {self.expires_at:%Y-%m-%d %H:%M}"
+
+class ResponseDraftSection(models.Model):
+    draft = models.ForeignKey(ResponseDraft, on_delete=models.CASCADE, related_name="sections")
+    section = models.ForeignKey(Section, on_delete=models.CASCADE, related_name="+")
+    answers = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+    class Meta:
+        unique_together = ("draft", "section")
+    def __str__(self): return f"{self.draft_id} · {self.section_id}"
+
+
+# Statistics rollups: per-day totals of the submitted answers, kept up to date by
+# surveys.rollups inside the submission transaction and rebuilt by rebuild_stats_rollups.
+# The stats page and the dashboard read these instead of scanning Answer.
+class ResponseDayRollup(models.Model):
+    survey = models.ForeignKey(Survey, on_delete=models.CASCADE, related_name="+")
+    day = models.DateField()
+    responses = models.IntegerField(default=0)
+    last_response_at = models.DateTimeField(null=True, blank=True)
+    class Meta:
+        unique_together = ("survey", "day")
+    def __str__(self): return f"{self.survey_id} · {self.day} · {self.responses}"
+
+# Only responses with an interviewer; the rest are the difference with ResponseDayRollup
+class InterviewerDayRollup(models.Model):
+    survey = models.ForeignKey(Survey, on_delete=models.CASCADE, related_name="+")
+    interviewer = models.ForeignKey(Interviewer, on_delete=models.CASCADE, related_name="+")
+    day = models.DateField()
+    responses = models.IntegerField(default=0)
+    class Meta:
+        unique_together = ("survey", "interviewer", "day")
+    def __str__(self): return f"{self.survey_id} · {self.interviewer_id} · {self.day} · {self.responses}"
+
+class QuestionDayRollup(models.Model):
+    survey = models.ForeignKey(Survey, on_delete=models.CASCADE, related_name="+")
+    question = models.ForeignKey(Question, on_delete=models.CASCADE, related_name="+")
+    day = models.DateField()
+    answered = models.IntegerField(default=0)
+    not_applicable = models.IntegerField(default=0)
+    # Integer, decimal and boolean (as 0/1) answers
+    value_count = models.IntegerField(default=0)
+    value_sum = models.FloatField(default=0)
+    value_sum_sq = models.FloatField(default=0)
+    value_min = models.DecimalField(max_digits=14, decimal_places=2, null=True, blank=True)
+    value_max = models.DecimalField(max_digits=14, decimal_places=2, null=True, blank=True)
+    class Meta:
+        unique_together = ("survey", "question", "day")
+    def __str__(self): return f"{self.question_id} · {self.day} · {self.answered}"
+
+class OptionDayRollup(models.Model):
+    survey = models.ForeignKey(Survey, on_delete=models.CASCADE, related_name="+")
+    question = models.ForeignKey(Question, on_delete=models.CASCADE, related_name="+")
+    option = models.ForeignKey(Option, on_delete=models.CASCADE, related_name="+")
+    day = models.DateField()
+    count = models.IntegerField(default=0)
+    class Meta:
+        unique_together = ("survey", "question", "option", "day")
+    def __str__(self): return f"{self.option_id} · {self.day} · {self.count}"
+
+class UbicacionDayRollup(models.Model):
+    survey = models.ForeignKey(Survey, on_delete=models.CASCADE, related_name="+")
+    question = models.ForeignKey(Question, on_delete=models.CASCADE, related_name="+")
+    ubicacion = models.ForeignKey(Ubicacion, on_delete=models.CASCADE, related_name="+")
+    day = models.DateField()
+    count = models.IntegerField(default=0)
+    class Meta:
+        unique_together = ("survey", "question", "ubicacion", "day")
+    def __str__(self): return f"{self.question_id} · {self.ubicacion_id} · {self.day} · {self.count}"
+
+
 # New model for .xlsx file handling
 class UbicacionListFile(models.Model):
     name = models.CharField(max_length=255, unique=True)
@@ -0,0 +1,264 @@
+import threading
+
+from django.db import connection, transaction
+from django.db.models import Q
+
+from .columnar import schedule_sync
+from .dependencies import get_dependency_evaluator, state_from_survey_answers
+from .models import Answer, QuestionType, ResponseSet
+from .rollups import collect, forget_responses, record_responses, refresh_bounds, replace_response
+from .stats import bump_responses_version
+
+OPTION_QUESTION_TYPES = (QuestionType.SINGLE, QuestionType.MULTI, QuestionType.LIKERT)
+
+# An Answer row that actually holds a value; rows without one are never written
+ANSWER_HAS_VALUE = (
+    Q(text_answer__gt='') | Q(integer_answer__isnull=False) | Q(decimal_answer__isnull=False)
+    | Q(bool_answer__isnull=False) | Q(date_answer__isnull=False)
+    | Q(options__isnull=False) | Q(selected_ubicaciones__isnull=False)
+)
+
+# Set while delete_responses runs so the per-instance delete signals stay out of the way
+_batch_delete = threading.local()
+
+
+def answer_field_name(question):
+    if question.qtype == QuestionType.UBICACION:
+        return f"question_{question.pk}_ubicacion"
+    return f"question_{question.pk}"
+
+
+def _selected_option_ids(answer_value):
+    if not answer_value:
+        return []
+    if not isinstance(answer_value, list):
+        answer_value = [answer_value]
+    return [int(val.split('__')[0]) for val in answer_value if '__' in val]
+
+
+def build_answers(schema, response_set, survey_answers):
+    """
+    Turn the per-section answers of the wizard into unsaved ``Answer`` rows.
+
+    Returns ``(answers, option_ids, ubicacion_ids)`` where the last two map a
+    question id to the primary keys that belong in the M2M tables. Questions hidden
+    by their dependencies and empty answers get no row.
+    """
+    active = get_dependency_evaluator(schema).active_questions(state_from_survey_answers(survey_answers))
+    answers = []
+    option_ids = {}
+    ubicacion_ids = {}
+    for section_pk, section_answers in survey_answers.items():
+        for question in schema.section(section_pk).questions:
+            if question.id not in active:
+                continue
+            answer_value = section_answers.get(answer_field_name(question))
+            other_text = section_answers.get(f"question_{question.pk}_other_text")
+
+            # Determine the value for text_answer
+            final_text_answer = ''
+            if other_text:
+                final_text_answer = other_text
+            elif question.qtype == QuestionType.TEXT:
+                final_text_answer = answer_value or ''
+
+            if not final_text_answer and answer_value in (None, '', []):
+                continue
+
+            answers.append(Answer(
+                response=response_set,
+                question_id=question.id,
+                text_answer=final_text_answer,
+                integer_answer=answer_value if question.qtype == QuestionType.INTEGER else None,
+                decimal_answer=answer_value if question.qtype == QuestionType.DECIMAL else None,
+                bool_answer=answer_value if question.qtype == QuestionType.BOOL else None,
+                date_answer=answer_value if question.qtype == QuestionType.DATE else None,
+            ))
+            if question.qtype in OPTION_QUESTION_TYPES:
+                option_ids[question.id] = _selected_option_ids(answer_value)
+            elif question.qtype == QuestionType.UBICACION:
+                ubicacion_ids[question.id] = [int(answer_value)] if answer_value else []
+    return answers, option_ids, ubicacion_ids
+
+
+def _upsert_answers(answers):
+    kwargs = {
+        'update_conflicts': True,
+        'update_fields': ['text_answer', 'integer_answer', 'decimal_answer', 'bool_answer', 'date_answer'],
+    }
+    # MySQL's ON DUPLICATE KEY UPDATE does not accept an explicit conflict target
+    if connection.features.supports_update_conflicts_with_target:
+        kwargs['unique_fields'] = ['response', 'question']
+    Answer.objects.bulk_create(answers, **kwargs)
+
+
+def save_answers(response_set, answers, option_ids, ubicacion_ids, replace=True):
+    """
+    Write ``answers`` and their M2M rows with a fixed number of queries.
+
+    ``replace`` clears the existing option/ubicacion rows first; it can be skipped
+    for a ResponseSet that was just created.
+    """
+    if replace:
+        # Questions left empty this time must not keep their previous answer
+        Answer.objects.filter(response=response_set).exclude(
+            question_id__in=[a.question_id for a in answers]
+        ).delete()
+    if not answers:
+        return
+    _upsert_answers(answers)
+
+    # Upserts do not return primary keys on every backend, so read them back once
+    answer_ids = dict(
+        Answer.objects.filter(response=response_set, question_id__in=[a.question_id for a in answers])
+        .values_list('question_id', 'pk')
+    )
+
+    if replace:
+        Answer.options.through.objects.filter(answer_id__in=answer_ids.values()).delete()
+        Answer.selected_ubicaciones.through.objects.filter(answer_id__in=answer_ids.values()).delete()
+    _insert_m2m_rows(answer_ids, option_ids, ubicacion_ids)
+
+
+def _insert_m2m_rows(answer_ids, option_ids, ubicacion_ids):
+    # The three dicts share their keys (a question id, or a (response id, question id) pair)
+    OptionThrough = Answer.options.through
+    UbicacionThrough = Answer.selected_ubicaciones.through
+    OptionThrough.objects.bulk_create([
+        OptionThrough(answer_id=answer_ids[key], option_id=option_id)
+        for key, pks in option_ids.items()
+        for option_id in pks
+    ])
+    UbicacionThrough.objects.bulk_create([
+        UbicacionThrough(answer_id=answer_ids[key], ubicacion_id=ubicacion_id)
+        for key, pks in ubicacion_ids.items()
+        for ubicacion_id in pks
+    ])
+
+
+def save_survey_response(schema, respondent_data, survey_answers, user=None, data_protection_accepted=False):
+    """
+    Persist a completed submission: the ResponseSet plus every Answer, in bulk, and its
+    contribution to the statistics rollups. ``data_protection_accepted`` records the
+    consent the caller already enforced.
+    """
+    with transaction.atomic():
+        response_set, created = ResponseSet.objects.get_or_create(
+            survey_id=schema.id,
+            identificacion=respondent_data.get('identificacion'),
+            document_type=respondent_data.get('document_type'),
+            defaults={
+                'full_name': respondent_data.get('full_name'),
+                'email': respondent_data.get('email'),
+                'phone': respondent_data.get('phone'),
+                'user': user if user is not None and user.is_authenticated else None,
+                'interviewer_id': respondent_data.get('interviewer') or None,
+                'data_protection_accepted': data_protection_accepted,
+            }
+        )
+        if not created and data_protection_accepted and not response_set.data_protection_accepted:
+            response_set.data_protection_accepted = True
+            response_set.save(update_fields=['data_protection_accepted'])
+        # A resubmission replaces the answers, so take their rollup contribution back out
+        previous = None if created else collect([response_set.pk])
+        answers, option_ids, ubicacion_ids = build_answers(schema, response_set, survey_answers)
+        save_answers(response_set, answers, option_ids, ubicacion_ids, replace=not created)
+        if created:
+            record_responses([response_set.pk])
+        else:
+            replace_response(response_set.pk, previous)
+        schedule_sync(schema.id, (response_set.pk,))
+        transaction.on_commit(lambda: bump_responses_version(schema.id))
+    return response_set
+
+
+def save_survey_responses(entries, user=None):
+    """
+    Persist many validated submissions at once, as sent by the offline sync.
+
+    ``entries`` is a list of ``(schema, respondent_data, survey_answers)`` whose
+    ResponseSets do not exist yet. Runs a fixed number of queries regardless of the
+    batch size and returns the new ResponseSet ids in the same order.
+    """
+    if not entries:
+        return []
+    user = user if user is not None and user.is_authenticated else None
+    keys = [
+        (schema.id, respondent_data.get('identificacion'), respondent_data.get('document_type'))
+        for schema, respondent_data, _ in entries
+    ]
+    with transaction.atomic():
+        ResponseSet.objects.bulk_create([
+            ResponseSet(
+                survey_id=schema.id,
+                identificacion=respondent_data.get('identificacion'),
+                document_type=respondent_data.get('document_type'),
+                full_name=respondent_data.get('full_name'),
+                email=respondent_data.get('email'),
+                phone=respondent_data.get('phone'),
+                user=user,
+                interviewer_id=respondent_data.get('interviewer') or None,
+                data_protection_accepted=True,
+            )
+            for schema, respondent_data, _ in entries
+        ])
+        # bulk_create does not set primary keys on MySQL, so read them back by natural key
+        response_ids = {
+            (survey_id, identificacion, document_type): pk
+            for survey_id, identificacion, document_type, pk in ResponseSet.objects.filter(
+                survey_id__in={key[0] for key in keys},
+                identificacion__in={key[1] for key in keys},
+            ).values_list('survey_id', 'identificacion', 'document_type', 'pk')
+        }
+
+        answers = []
+        option_ids = {}
+        ubicacion_ids = {}
+        for (schema, _, survey_answers), key in zip(entries, keys):
+            response_set = ResponseSet(pk=response_ids[key], survey_id=schema.id)
+            rows, options, ubicaciones = build_answers(schema, response_set, survey_answers)
+            answers.extend(rows)
+            option_ids.update(((response_set.pk, question_id), pks) for question_id, pks in options.items())
+            ubicacion_ids.update(((response_set.pk, question_id), pks) for question_id, pks in ubicaciones.items())
+        Answer.objects.bulk_create(answers)
+
+        answer_ids = {
+            (response_id, question_id): pk
+            for response_id, question_id, pk in Answer.objects.filter(
+                response_id__in=[response_ids[key] for key in keys]
+            ).values_list('response_id', 'question_id', 'pk')
+        }
+        _insert_m2m_rows(answer_ids, option_ids, ubicacion_ids)
+        record_responses([response_ids[key] for key in keys])
+        for survey_id in {key[0] for key in keys}:
+            schedule_sync(survey_id, [response_ids[key] for key in keys if key[0] == survey_id])
+            transaction.on_commit(lambda survey_id=survey_id: bump_responses_version(survey_id))
+    return [response_ids[key] for key in keys]
+
+
+def deleting_in_batch():
+    return getattr(_batch_delete, 'active', False)
+
+
+def delete_responses(queryset):
+    """
+    Delete the ResponseSets of ``queryset`` with their answers.
+
+    The rollups, the columnar stores and the stats versions are updated once for the
+    whole batch instead of once per response by the delete signals.
+    """
+    rows = list(queryset.order_by().values_list('pk', 'survey_id'))
+    response_ids = [pk for pk, _ in rows]
+    with transaction.atomic():
+        contribution = forget_responses(response_ids)
+        _batch_delete.active = True
+        try:
+            deleted = ResponseSet.objects.filter(pk__in=response_ids).delete()
+        finally:
+            _batch_delete.active = False
+        if contribution:
+            refresh_bounds(contribution)
+        for survey_id in {survey_id for _, survey_id in rows}:
+            schedule_sync(survey_id, [pk for pk, owner in rows if owner == survey_id])
+            transaction.on_commit(lambda survey_id=survey_id: bump_responses_version(survey_id))
+    return deleted
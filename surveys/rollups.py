@@ -0,0 +1,305 @@
+"""
+Per-day statistics rollups of the submitted answers.
+
+Every submission adds its contribution (responses, answered/not applicable questions,
+numeric sums, option and ubicacion counts for the day it was created) to the rollup
+tables in the same transaction that writes the answers, with one upsert per table that
+increments the stored totals. Editing a response subtracts its old contribution first,
+deleting one subtracts it. Minimums and maximums cannot be decremented, so the buckets a
+removed value touched are recomputed from that day's answers.
+
+Anything written around these functions (raw SQL, ``Answer`` edits in the admin) leaves
+the rollups stale until ``rebuild_stats_rollups`` is run.
+"""
+from collections import Counter
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db import connection
+from django.db.models import Max, Min, Prefetch
+from django.utils import timezone
+
+from .dependencies import get_dependency_evaluator, state_from_answers
+from .models import (
+    Answer, InterviewerDayRollup, OptionDayRollup, QuestionDayRollup, QuestionType, ResponseDayRollup, ResponseSet,
+    Ubicacion, UbicacionDayRollup,
+)
+from .schema import get_survey_schema
+
+NUMERIC_TYPES = (QuestionType.INTEGER, QuestionType.DECIMAL, QuestionType.BOOL)
+
+
+def response_day(created_at):
+    """Day a response counts for, in the local time zone like the stats filters."""
+    return timezone.localdate(created_at) if timezone.is_aware(created_at) else created_at.date()
+
+
+def _day_bounds(day):
+    start = datetime.combine(day, time.min)
+    end = start + timedelta(days=1)
+    if timezone.is_naive(timezone.now()):
+        return start, end
+    return timezone.make_aware(start), timezone.make_aware(end)
+
+
+def _numeric_value(question, answer):
+    if question.qtype == QuestionType.INTEGER:
+        return answer.integer_answer
+    if question.qtype == QuestionType.DECIMAL:
+        return answer.decimal_answer
+    if answer.bool_answer is None:
+        return None
+    return int(answer.bool_answer)
+
+
+def _has_value(answer):
+    # Same test as persistence.ANSWER_HAS_VALUE, on prefetched rows
+    return bool(
+        answer.text_answer
+        or any(v is not None for v in (answer.integer_answer, answer.decimal_answer, answer.bool_answer, answer.date_answer))
+        or answer.options.all() or answer.selected_ubicaciones.all()
+    )
+
+
+class Contribution:
+    """What a set of responses adds to each rollup row."""
+
+    def __init__(self):
+        # (survey_id, day) -> [responses, last_response_at]
+        self.responses = {}
+        # (survey_id, interviewer_id, day) -> responses
+        self.interviewers = Counter()
+        # (survey_id, question_id, day) -> [answered, not_applicable, count, sum, sum_sq, min, max]
+        self.questions = {}
+        # (survey_id, question_id, option_id, day) -> count
+        self.options = Counter()
+        # (survey_id, question_id, ubicacion_id, day) -> count
+        self.ubicaciones = Counter()
+
+    def __bool__(self):
+        return bool(self.responses)
+
+    def _question(self, key):
+        bucket = self.questions.get(key)
+        if bucket is None:
+            bucket = self.questions[key] = [0, 0, 0, 0.0, 0.0, None, None]
+        return bucket
+
+    def add_response(self, schema, response, answers):
+        day = response_day(response.created_at)
+        bucket = self.responses.setdefault((schema.id, day), [0, None])
+        bucket[0] += 1
+        if bucket[1] is None or response.created_at > bucket[1]:
+            bucket[1] = response.created_at
+        if response.interviewer_id:
+            self.interviewers[(schema.id, response.interviewer_id, day)] += 1
+
+        evaluator = get_dependency_evaluator(schema)
+        if evaluator.rules:
+            active = evaluator.active_questions(state_from_answers(answers))
+            for question_id in evaluator.rules:
+                if question_id not in active:
+                    self._question((schema.id, question_id, day))[1] += 1
+
+        for answer in answers:
+            try:
+                question = schema.question(answer.question_id)
+            except KeyError:
+                # Question no longer part of the survey
+                continue
+            if not _has_value(answer):
+                continue
+            bucket = self._question((schema.id, question.id, day))
+            bucket[0] += 1
+            if question.qtype in NUMERIC_TYPES:
+                value = _numeric_value(question, answer)
+                if value is not None:
+                    bucket[2] += 1
+                    bucket[3] += float(value)
+                    bucket[4] += float(value) ** 2
+                    value = Decimal(value)
+                    bucket[5] = value if bucket[5] is None else min(bucket[5], value)
+                    bucket[6] = value if bucket[6] is None else max(bucket[6], value)
+            for option in answer.options.all():
+                self.options[(schema.id, question.id, option.pk, day)] += 1
+            for ubicacion in answer.selected_ubicaciones.all():
+                self.ubicaciones[(schema.id, question.id, ubicacion.pk, day)] += 1
+
+
+def collect(response_ids):
+    """Contribution of the ResponseSets ``response_ids`` as stored right now (four queries)."""
+    contribution = Contribution()
+    if not response_ids:
+        return contribution
+    responses = ResponseSet.objects.filter(pk__in=response_ids).only('pk', 'survey_id', 'interviewer_id', 'created_at')
+    answers_by_response = {}
+    answers = Answer.objects.filter(response_id__in=response_ids).prefetch_related(
+        'options', Prefetch('selected_ubicaciones', queryset=Ubicacion.objects.only('pk')),
+    )
+    for answer in answers:
+        answers_by_response.setdefault(answer.response_id, []).append(answer)
+    schemas = {}
+    for response in responses:
+        schema = schemas.get(response.survey_id)
+        if schema is None:
+            schema = schemas[response.survey_id] = get_survey_schema(response.survey_id)
+        contribution.add_response(schema, response, answers_by_response.get(response.pk, []))
+    return contribution
+
+
+def _column(model, name):
+    return connection.ops.quote_name(model._meta.get_field(name).column)
+
+
+def _increment(model, key_fields, rows, add_fields=(), min_fields=(), max_fields=()):
+    """
+    Insert ``rows`` (tuples of key values followed by the other fields in order) adding
+    to, or keeping the smallest/largest of, the values of rows that already exist.
+    """
+    if not rows:
+        return
+    table = connection.ops.quote_name(model._meta.db_table)
+    keys = [_column(model, name) for name in key_fields]
+    adds = [_column(model, name) for name in add_fields]
+    mins = [_column(model, name) for name in min_fields]
+    maxs = [_column(model, name) for name in max_fields]
+    columns = keys + adds + mins + maxs
+    if connection.vendor == 'mysql':
+        new = 'VALUES({})'.format
+        least, greatest = 'LEAST', 'GREATEST'
+    else:
+        new = 'excluded.{}'.format
+        # SQLite's two-argument min()/max() are its LEAST/GREATEST
+        least, greatest = ('MIN', 'MAX') if connection.vendor == 'sqlite' else ('LEAST', 'GREATEST')
+    old = f'{table}.{{}}'.format if connection.vendor != 'mysql' else '{}'.format
+    updates = [f'{c} = {old(c)} + {new(c)}' for c in adds]
+    # COALESCE both sides: NULL is "no value yet", not a bound
+    updates += [f'{c} = {least}(COALESCE({old(c)}, {new(c)}), COALESCE({new(c)}, {old(c)}))' for c in mins]
+    updates += [f'{c} = {greatest}(COALESCE({old(c)}, {new(c)}), COALESCE({new(c)}, {old(c)}))' for c in maxs]
+
+    placeholders = '({})'.format(', '.join(['%s'] * len(columns)))
+    sql = f'INSERT INTO {table} ({", ".join(columns)}) VALUES {", ".join([placeholders] * len(rows))} '
+    if connection.vendor == 'mysql':
+        sql += 'ON DUPLICATE KEY UPDATE ' + ', '.join(updates)
+    else:
+        sql += f'ON CONFLICT ({", ".join(keys)}) DO UPDATE SET ' + ', '.join(updates)
+    fields = [model._meta.get_field(name) for name in (*key_fields, *add_fields, *min_fields, *max_fields)]
+    params = [
+        field.get_db_prep_save(value, connection)
+        for row in rows
+        for field, value in zip(fields, row)
+    ]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def apply(contribution, sign=1):
+    """Add (``sign=1``) or subtract (``sign=-1``) ``contribution`` to the rollup tables."""
+    _increment(
+        ResponseDayRollup, ('survey', 'day'),
+        [(survey_id, day, sign * responses, last if sign > 0 else None)
+         for (survey_id, day), (responses, last) in contribution.responses.items()],
+        add_fields=('responses',), max_fields=('last_response_at',),
+    )
+    _increment(
+        InterviewerDayRollup, ('survey', 'interviewer', 'day'),
+        [(*key, sign * count) for key, count in contribution.interviewers.items()],
+        add_fields=('responses',),
+    )
+    _increment(
+        QuestionDayRollup, ('survey', 'question', 'day'),
+        [(*key, sign * answered, sign * not_applicable, sign * count, sign * total, sign * total_sq,
+          *((low, high) if sign > 0 else (None, None)))
+         for key, (answered, not_applicable, count, total, total_sq, low, high) in contribution.questions.items()],
+        add_fields=('answered', 'not_applicable', 'value_count', 'value_sum', 'value_sum_sq'),
+        min_fields=('value_min',), max_fields=('value_max',),
+    )
+    _increment(
+        OptionDayRollup, ('survey', 'question', 'option', 'day'),
+        [(*key, sign * count) for key, count in contribution.options.items()],
+        add_fields=('count',),
+    )
+    _increment(
+        UbicacionDayRollup, ('survey', 'question', 'ubicacion', 'day'),
+        [(*key, sign * count) for key, count in contribution.ubicaciones.items()],
+        add_fields=('count',),
+    )
+
+
+def refresh_bounds(contribution):
+    """
+    Recompute from the answers the minimums, maximums and last response times that the
+    (already subtracted) ``contribution`` may have held.
+    """
+    for (survey_id, day), (_, last) in contribution.responses.items():
+        start, end = _day_bounds(day)
+        latest = ResponseSet.objects.filter(
+            survey_id=survey_id, created_at__gte=start, created_at__lt=end,
+        ).aggregate(latest=Max('created_at'))['latest']
+        ResponseDayRollup.objects.filter(survey_id=survey_id, day=day).update(last_response_at=latest)
+
+    touched = {}
+    for (survey_id, question_id, day), bucket in contribution.questions.items():
+        if bucket[2]:
+            touched.setdefault((survey_id, day), []).append(question_id)
+    for (survey_id, day), question_ids in touched.items():
+        schema = get_survey_schema(survey_id)
+        start, end = _day_bounds(day)
+        answers = Answer.objects.filter(
+            question_id__in=question_ids, response__survey_id=survey_id,
+            response__created_at__gte=start, response__created_at__lt=end,
+        ).values('question_id')
+        bounds = {
+            row['question_id']: row
+            for row in answers.annotate(
+                integer_min=Min('integer_answer'), integer_max=Max('integer_answer'),
+                decimal_min=Min('decimal_answer'), decimal_max=Max('decimal_answer'),
+                bool_min=Min('bool_answer'), bool_max=Max('bool_answer'),
+            )
+        }
+        for question_id in question_ids:
+            prefix = {QuestionType.INTEGER: 'integer', QuestionType.DECIMAL: 'decimal'}.get(
+                schema.question(question_id).qtype, 'bool')
+            row = bounds.get(question_id, {})
+            low, high = row.get(f'{prefix}_min'), row.get(f'{prefix}_max')
+            QuestionDayRollup.objects.filter(question_id=question_id, day=day).update(
+                value_min=None if low is None else Decimal(int(low) if prefix == 'bool' else low),
+                value_max=None if high is None else Decimal(int(high) if prefix == 'bool' else high),
+            )
+
+
+def record_responses(response_ids):
+    """Add the stored answers of the new ResponseSets ``response_ids`` to the rollups."""
+    apply(collect(response_ids))
+
+
+def replace_response(response_id, previous):
+    """Swap the ``previous`` contribution of an edited response for its stored answers."""
+    if previous:
+        apply(previous, sign=-1)
+    apply(collect([response_id]))
+    if previous:
+        refresh_bounds(previous)
+
+
+def forget_responses(response_ids):
+    """Subtract ResponseSets about to be deleted from the rollups."""
+    contribution = collect(response_ids)
+    if contribution:
+        apply(contribution, sign=-1)
+    return contribution
+
+
+ROLLUP_MODELS = (ResponseDayRollup, InterviewerDayRollup, QuestionDayRollup, OptionDayRollup, UbicacionDayRollup)
+
+
+def rebuild(survey_id, chunk_size=500, progress=None):
+    """Recompute every rollup row of ``survey_id`` from its answers, ``chunk_size`` responses at a time."""
+    for model in ROLLUP_MODELS:
+        model.objects.filter(survey_id=survey_id).delete()
+    response_ids = list(ResponseSet.objects.filter(survey_id=survey_id).order_by('pk').values_list('pk', flat=True))
+    for offset in range(0, len(response_ids), chunk_size):
+        apply(collect(response_ids[offset:offset + chunk_size]))
+        if progress:
+            progress(min(offset + chunk_size, len(response_ids)), len(response_ids))
+    return len(response_ids)
@@ -0,0 +1,331 @@
+import json
+from dataclasses import dataclass, field
+from decimal import Decimal
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404
+
+from .caching import LocalLRUCache, bump_version, get_version
+from .models import Option, Question, Section, Survey
+
+# Bump when the layout of the compiled classes changes so old pickles are ignored
+SCHEMA_FORMAT = 2
+SCHEMA_CACHE_TIMEOUT = getattr(settings, 'SURVEY_SCHEMA_CACHE_TIMEOUT', 60 * 60 * 24)
+
+_local_schemas = LocalLRUCache(maxsize=getattr(settings, 'SURVEY_SCHEMA_LOCAL_CACHE_SIZE', 32))
+_local_schema_json = LocalLRUCache(maxsize=getattr(settings, 'SURVEY_SCHEMA_LOCAL_CACHE_SIZE', 32))
+
+
+@dataclass(frozen=True, eq=False)
+class OptionSchema:
+    id: int
+    code: str
+    label: str
+    order: int
+    numeric_value: Optional[int]
+    is_other_trigger: bool
+
+    @property
+    def pk(self):
+        return self.id
+
+    @property
+    def value(self):
+        # Value used by the answer forms for this option ("<pk>__<code>")
+        return f"{self.id}__{self.code}"
+
+
+@dataclass(frozen=True, eq=False)
+class QuestionSchema:
+    id: int
+    section_id: int
+    code: str
+    text: str
+    help_text: str
+    qtype: str
+    required: bool
+    order: int
+    max_choices: int
+    single_choice_display: str
+    depends_on_id: Optional[int]
+    depends_on_option_id: Optional[int]
+    depends_on_value_min: Optional[Decimal]
+    depends_on_value_max: Optional[Decimal]
+    copy_from: str
+    copy_text_from: bool
+    min_value: Optional[int]
+    max_value: Optional[int]
+    other_text_label: str
+    options: tuple = ()
+    trigger_option: Optional[OptionSchema] = None
+
+    @property
+    def pk(self):
+        return self.id
+
+
+@dataclass(frozen=True, eq=False)
+class SectionSchema:
+    id: int
+    survey_id: int
+    title: str
+    order: int
+    version: int
+    questions: tuple = ()
+
+    @property
+    def pk(self):
+        return self.id
+
+
+@dataclass(frozen=True, eq=False)
+class SurveySchema:
+    """Immutable snapshot of a survey and its sections, questions and options."""
+    id: int
+    code: str
+    name: str
+    description: str
+    is_active: bool
+    require_token: bool
+    version: int
+    sections: tuple = ()
+    questions: tuple = ()
+    # Navigation index: section ids in order and the number of questions before each
+    # section (with the grand total as the last item)
+    section_ids: tuple = ()
+    question_offsets: tuple = (0,)
+    _sections_by_id: dict = field(default_factory=dict, repr=False)
+    _questions_by_id: dict = field(default_factory=dict, repr=False)
+
+    @property
+    def pk(self):
+        return self.id
+
+    @property
+    def total_sections(self):
+        return len(self.section_ids)
+
+    @property
+    def total_questions(self):
+        return self.question_offsets[-1]
+
+    def section_at(self, index):
+        """Section at position ``index``, or None when it is out of range."""
+        if 0 <= index < len(self.sections):
+            return self.sections[index]
+        return None
+
+    def questions_before(self, index):
+        return self.question_offsets[index]
+
+    def section(self, section_id):
+        return self._sections_by_id[int(section_id)]
+
+    def question(self, question_id):
+        return self._questions_by_id[int(question_id)]
+
+
+def _version_key(survey_id):
+    return f"surveys:schema:{survey_id}:version"
+
+
+def _code_key(code):
+    return f"surveys:schema:code:{code}"
+
+
+def _schema_key(survey_id, version):
+    return f"surveys:schema:{SCHEMA_FORMAT}:{survey_id}:{version}"
+
+
+def get_schema_version(survey_id):
+    return get_version(_version_key(survey_id))
+
+
+def bump_schema_version(survey_id):
+    return bump_version(_version_key(survey_id))
+
+
+def forget_survey_code(code):
+    cache.delete(_code_key(code))
+
+
+def compile_survey_schema(survey_id, version):
+    """Build the schema of a survey with a fixed number of queries."""
+    survey = Survey.objects.get(pk=survey_id)
+
+    options_by_question = {}
+    for o in Option.objects.filter(question__section__survey_id=survey_id).order_by('question_id', 'order', 'pk'):
+        options_by_question.setdefault(o.question_id, []).append(OptionSchema(
+            id=o.pk,
+            code=o.code,
+            label=o.label,
+            order=o.order,
+            numeric_value=o.numeric_value,
+            is_other_trigger=o.is_other_trigger,
+        ))
+
+    questions_by_section = {}
+    for q in Question.objects.filter(section__survey_id=survey_id).order_by('section__order', 'order', 'pk'):
+        options = tuple(options_by_question.get(q.pk, ()))
+        questions_by_section.setdefault(q.section_id, []).append(QuestionSchema(
+            id=q.pk,
+            section_id=q.section_id,
+            code=q.code,
+            text=q.text,
+            help_text=q.help_text,
+            qtype=q.qtype,
+            required=q.required,
+            order=q.order,
+            max_choices=q.max_choices,
+            single_choice_display=q.single_choice_display,
+            depends_on_id=q.depends_on_id,
+            depends_on_option_id=q.depends_on_option_id,
+            depends_on_value_min=q.depends_on_value_min,
+            depends_on_value_max=q.depends_on_value_max,
+            copy_from=q.copy_from,
+            copy_text_from=q.copy_text_from,
+            min_value=q.min_value,
+            max_value=q.max_value,
+            other_text_label=q.other_text_label,
+            options=options,
+            trigger_option=next((o for o in options if o.is_other_trigger), None),
+        ))
+
+    sections = tuple(
+        SectionSchema(
+            id=s.pk,
+            survey_id=survey_id,
+            title=s.title,
+            order=s.order,
+            version=version,
+            questions=tuple(questions_by_section.get(s.pk, ())),
+        )
+        for s in Section.objects.filter(survey_id=survey_id).order_by('order')
+    )
+    questions = tuple(q for s in sections for q in s.questions)
+    question_offsets = [0]
+    for s in sections:
+        question_offsets.append(question_offsets[-1] + len(s.questions))
+
+    return SurveySchema(
+        id=survey.pk,
+        code=survey.code,
+        name=survey.name,
+        description=survey.description,
+        is_active=survey.is_active,
+        require_token=survey.require_token,
+        version=version,
+        sections=sections,
+        questions=questions,
+        section_ids=tuple(s.id for s in sections),
+        question_offsets=tuple(question_offsets),
+        _sections_by_id={s.id: s for s in sections},
+        _questions_by_id={q.id: q for q in questions},
+    )
+
+
+def get_survey_schema(survey_id):
+    """Compiled schema for ``survey_id``, raising ``Survey.DoesNotExist`` if it is gone."""
+    version = get_schema_version(survey_id)
+    local_key = (survey_id, version)
+    schema = _local_schemas.get(local_key)
+    if schema is not None:
+        return schema
+
+    shared_key = _schema_key(survey_id, version)
+    schema = cache.get(shared_key)
+    if schema is None:
+        schema = compile_survey_schema(survey_id, version)
+        cache.set(shared_key, schema, timeout=SCHEMA_CACHE_TIMEOUT)
+    _local_schemas.set(local_key, schema)
+    return schema
+
+
+def get_survey_schema_by_code(code):
+    """Resolve a survey code to its schema without touching the database when warm."""
+    survey_id = cache.get(_code_key(code))
+    if survey_id is not None:
+        try:
+            schema = get_survey_schema(survey_id)
+        except Survey.DoesNotExist:
+            schema = None
+        # A renamed survey leaves its old code pointing to the wrong id
+        if schema is not None and schema.code == code:
+            return schema
+
+    survey_id = Survey.objects.filter(code=code).values_list('pk', flat=True).first()
+    if survey_id is None:
+        return None
+    cache.set(_code_key(code), survey_id, timeout=SCHEMA_CACHE_TIMEOUT)
+    return get_survey_schema(survey_id)
+
+
+def get_schema_or_404(code, active_only=False):
+    schema = get_survey_schema_by_code(code)
+    if schema is None or (active_only and not schema.is_active):
+        raise Http404("No se encontró la encuesta.")
+    return schema
+
+
+def _number(value):
+    return float(value) if value is not None else None
+
+
+def schema_as_dict(schema):
+    """JSON-ready representation of a compiled schema, used by the single-page fill mode."""
+    return {
+        'id': schema.id,
+        'code': schema.code,
+        'name': schema.name,
+        'description': schema.description,
+        'version': schema.version,
+        'total_questions': schema.total_questions,
+        'sections': [
+            {
+                'id': section.id,
+                'title': section.title,
+                'order': section.order,
+                'question_offset': schema.questions_before(index),
+                'questions': [
+                    {
+                        'id': q.id,
+                        'code': q.code,
+                        'text': q.text,
+                        'help_text': q.help_text,
+                        'qtype': q.qtype,
+                        'required': q.required,
+                        'max_choices': q.max_choices,
+                        'single_choice_display': q.single_choice_display,
+                        'depends_on': q.depends_on_id,
+                        'depends_on_option': q.depends_on_option_id,
+                        'depends_on_value_min': _number(q.depends_on_value_min),
+                        'depends_on_value_max': _number(q.depends_on_value_max),
+                        'copy_from': q.copy_from,
+                        'copy_text_from': q.copy_text_from,
+                        'min_value': q.min_value,
+                        'max_value': q.max_value,
+                        'other_text_label': q.other_text_label,
+                        'other_trigger': q.trigger_option.code if q.trigger_option else None,
+                        'options': [
+                            {'id': o.id, 'code': o.code, 'label': o.label, 'value': o.value}
+                            for o in q.options
+                        ],
+                    }
+                    for q in section.questions
+                ],
+            }
+            for index, section in enumerate(schema.sections)
+        ],
+    }
+
+
+def schema_json(schema):
+    """Serialized ``schema_as_dict`` document, encoded once per schema version."""
+    key = (schema.id, schema.version)
+    body = _local_schema_json.get(key)
+    if body is None:
+        body = json.dumps(schema_as_dict(schema), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        _local_schema_json.set(key, body)
+    return body
@@ -0,0 +1,142 @@
+"""
+Typeahead search over Ubicacion ``nombre`` and ``codigo``.
+
+Names are normalized once (accents stripped, case folded, spaces collapsed) and indexed
+by trigram, so a query only verifies the rows that contain all of its trigrams instead
+of scanning the whole catalog. Queries shorter than a trigram use a prefix search over
+the sorted normalized names and codes. The index is built per catalog version and kept
+in process memory; any Municipio/Ubicacion change bumps the version (see catalog.py).
+"""
+import heapq
+import re
+import unicodedata
+from array import array
+from bisect import bisect_left
+
+from .caching import LocalLRUCache
+from .catalog import get_catalog_version
+from .models import Ubicacion
+
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 50
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+_indexes = LocalLRUCache(maxsize=2)
+
+
+def normalize(text):
+    """Lower-case ``text`` without accents: ``'Bocagrande  Sector Ñ'`` -> ``'bocagrande sector n'``."""
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return _WHITESPACE_RE.sub(' ', stripped.casefold()).strip()
+
+
+def normalize_code(code):
+    """``'0150'``, ``'150'`` and ``'150.0'`` (as read from Excel) are the same code."""
+    code = normalize(str(code or ''))
+    if code.endswith('.0'):
+        code = code[:-2]
+    return code.lstrip('0') or code
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class UbicacionSearchIndex:
+    """Trigram index over the normalized names and codes of every ubicacion."""
+
+    def __init__(self, rows):
+        # rows: (id, municipio_id, codigo, nombre, loc, zona, municipio_nombre)
+        self.rows = tuple(rows)
+        self.names = tuple(normalize(row[3]) for row in self.rows)
+        self.codes = tuple(normalize(row[2]) for row in self.rows)
+
+        postings = {}
+        for position, (name, code) in enumerate(zip(self.names, self.codes)):
+            for trigram in _trigrams(name) | _trigrams(code):
+                postings.setdefault(trigram, array('I')).append(position)
+        self.postings = postings
+
+        # Sorted (key, position) pairs for the prefix search of very short queries
+        self.prefixes = sorted(
+            [(name, position) for position, name in enumerate(self.names)]
+            + [(code, position) for position, code in enumerate(self.codes) if code]
+        )
+
+    def _candidates(self, query):
+        if len(query) < 3:
+            start = bisect_left(self.prefixes, (query,))
+            positions = set()
+            for key, position in self.prefixes[start:]:
+                if not key.startswith(query):
+                    break
+                positions.add(position)
+            return positions
+        lists = []
+        for trigram in _trigrams(query):
+            posting = self.postings.get(trigram)
+            if posting is None:
+                return set()
+            lists.append(posting)
+        lists.sort(key=len)
+        positions = set(lists[0])
+        for posting in lists[1:]:
+            positions.intersection_update(posting)
+            if not positions:
+                break
+        return positions
+
+    def _rank(self, query, position):
+        """Lower is better: exact, prefix, word prefix, substring; None when it does not match."""
+        name, code = self.names[position], self.codes[position]
+        if query == code or query == name:
+            return 0
+        if code.startswith(query) or name.startswith(query):
+            return 1
+        if f" {query}" in name:
+            return 2
+        if query in name or query in code:
+            return 3
+        return None
+
+    def search(self, query, municipio_id=None, limit=SEARCH_DEFAULT_LIMIT):
+        query = normalize(query)
+        if not query:
+            return []
+        ranked = []
+        for position in self._candidates(query):
+            row = self.rows[position]
+            if municipio_id is not None and row[1] != municipio_id:
+                continue
+            rank = self._rank(query, position)
+            if rank is not None:
+                ranked.append((rank, len(self.names[position]), self.names[position], position))
+        return [self.rows[item[3]] for item in heapq.nsmallest(limit, ranked)]
+
+
+def build_search_index():
+    return UbicacionSearchIndex(
+        Ubicacion.objects.order_by('pk').values_list(
+            'id', 'municipio_id', 'codigo', 'nombre', 'loc', 'zona', 'municipio__nombre'
+        )
+    )
+
+
+def get_search_index(version=None):
+    version = version or get_catalog_version()
+    index = _indexes.get(version)
+    if index is None:
+        index = build_search_index()
+        _indexes.set(version, index)
+    return index
+
+
+def search_ubicaciones(query, municipio_id=None, limit=SEARCH_DEFAULT_LIMIT):
+    """Best ``limit`` matches for ``query`` as JSON-ready dicts."""
+    return [
+        {'id': row[0], 'municipio_id': row[1], 'codigo': row[2], 'nombre': row[3],
+         'loc': row[4], 'zona': row[5], 'municipio': row[6]}
+        for row in get_search_index().search(query, municipio_id, limit)
+    ]
@@ -0,0 +1,70 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .catalog import bump_catalog_version
+from .columnar import schedule_sync
+from .models import Municipio, Option, Question, ResponseSet, Section, Survey, Ubicacion
+from .persistence import deleting_in_batch
+from .rollups import forget_responses, refresh_bounds
+from .schema import bump_schema_version, forget_survey_code
+from .stats import bump_responses_version
+
+
+def _survey_id_for(instance):
+    if isinstance(instance, Survey):
+        return instance.pk
+    if isinstance(instance, Section):
+        return instance.survey_id
+    if isinstance(instance, Question):
+        return Section.objects.filter(pk=instance.section_id).values_list('survey_id', flat=True).first()
+    if isinstance(instance, Option):
+        return Question.objects.filter(pk=instance.question_id).values_list('section__survey_id', flat=True).first()
+    return None
+
+
+@receiver(post_save, sender=Survey)
+@receiver(post_delete, sender=Survey)
+@receiver(post_save, sender=Section)
+@receiver(post_delete, sender=Section)
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+@receiver(post_save, sender=Option)
+@receiver(post_delete, sender=Option)
+def invalidate_survey_schema(sender, instance, **kwargs):
+    survey_id = _survey_id_for(instance)
+    if survey_id is None:
+        # Parent already gone in a cascade: the survey-level signal takes care of it
+        return
+    if isinstance(instance, Survey):
+        forget_survey_code(instance.code)
+    # Bump after commit so no reader compiles the old rows under the new version
+    transaction.on_commit(lambda: bump_schema_version(survey_id))
+
+
+@receiver(post_save, sender=Municipio)
+@receiver(post_delete, sender=Municipio)
+@receiver(post_save, sender=Ubicacion)
+@receiver(post_delete, sender=Ubicacion)
+def invalidate_catalog(sender, instance, **kwargs):
+    transaction.on_commit(bump_catalog_version)
+
+
+@receiver(pre_delete, sender=ResponseSet)
+def forget_response_rollups(sender, instance, **kwargs):
+    if deleting_in_batch():
+        # delete_responses updates the rollups once for the whole batch
+        return
+    # Before the cascade removes the answers the contribution is read from
+    instance._rollup_contribution = forget_responses([instance.pk])
+
+
+@receiver(post_delete, sender=ResponseSet)
+def refresh_response_rollups(sender, instance, **kwargs):
+    if deleting_in_batch():
+        return
+    contribution = getattr(instance, '_rollup_contribution', None)
+    if contribution:
+        refresh_bounds(contribution)
+    schedule_sync(instance.survey_id, (instance.pk,))
+    transaction.on_commit(lambda: bump_responses_version(instance.survey_id))
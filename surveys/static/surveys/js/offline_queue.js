@@ -0,0 +1,99 @@
+// Queue of completed responses stored in IndexedDB while the device has no coverage.
+// Items are sent in batches to the sync endpoint as soon as the connection comes back.
+(function () {
+    'use strict';
+
+    const DB_NAME = 'surveys-offline';
+    const STORE = 'responses';
+    const BATCH_SIZE = 50;
+
+    function openDb() {
+        return new Promise((resolve, reject) => {
+            const request = indexedDB.open(DB_NAME, 1);
+            request.onupgradeneeded = () => {
+                const store = request.result.createObjectStore(STORE, { keyPath: 'client_id' });
+                store.createIndex('status', 'status');
+            };
+            request.onsuccess = () => resolve(request.result);
+            request.onerror = () => reject(request.error);
+        });
+    }
+
+    function withStore(mode, callback) {
+        return openDb().then(db => new Promise((resolve, reject) => {
+            const tx = db.transaction(STORE, mode);
+            const result = callback(tx.objectStore(STORE));
+            tx.oncomplete = () => resolve(result && 'result' in result ? result.result : result);
+            tx.onerror = () => reject(tx.error);
+        }));
+    }
+
+    function newClientId() {
+        if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+        return `${Date.now()}-${Math.random().toString(16).slice(2)}`;
+    }
+
+    // payload: {survey, data_protection_accepted, respondent, answers}
+    function add(payload) {
+        const item = Object.assign({}, payload, { client_id: newClientId(), status: 'pending', queued_at: new Date().toISOString() });
+        return withStore('readwrite', store => store.put(item)).then(() => item);
+    }
+
+    function byStatus(status) {
+        return withStore('readonly', store => store.index('status').getAll(status));
+    }
+
+    function pendingCount() {
+        return withStore('readonly', store => store.index('status').count('pending'));
+    }
+
+    function applyResults(results) {
+        return withStore('readwrite', store => {
+            results.forEach(result => {
+                if (!result || !result.client_id) return;
+                if (result.status === 'created') {
+                    store.delete(result.client_id);
+                    return;
+                }
+                // Duplicates and invalid responses are kept aside so nothing collected is lost
+                const request = store.get(result.client_id);
+                request.onsuccess = () => {
+                    if (!request.result) return;
+                    store.put(Object.assign(request.result, { status: result.status, result: result }));
+                };
+            });
+        });
+    }
+
+    function sync(syncUrl, csrfToken) {
+        return byStatus('pending').then(items => {
+            let synced = 0;
+            let chain = Promise.resolve();
+            for (let start = 0; start < items.length; start += BATCH_SIZE) {
+                const batch = items.slice(start, start + BATCH_SIZE).map(item => ({
+                    client_id: item.client_id,
+                    survey: item.survey,
+                    data_protection_accepted: item.data_protection_accepted,
+                    respondent: item.respondent,
+                    answers: item.answers,
+                }));
+                chain = chain
+                    .then(() => fetch(syncUrl, {
+                        method: 'POST',
+                        credentials: 'same-origin',
+                        headers: { 'Content-Type': 'application/json', 'X-CSRFToken': csrfToken },
+                        body: JSON.stringify({ responses: batch }),
+                    }))
+                    .then(response => {
+                        if (!response.ok) throw new Error('sync ' + response.status);
+                        return response.json();
+                    })
+                    .then(data => applyResults(data.results))
+                    .then(() => { synced += batch.length; });
+            }
+            return chain.then(() => synced);
+        });
+    }
+
+    window.SurveyOfflineQueue = { add, pendingCount, byStatus, sync };
+})();
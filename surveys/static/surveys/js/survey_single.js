@@ -0,0 +1,530 @@
+// Single-page fill mode: downloads the survey schema once, renders every section in the
+// browser and sends the complete response in one request to the submit endpoint.
+(function () {
+    'use strict';
+
+    const form = document.getElementById('singleSurveyForm');
+    if (!form) return;
+
+    const INPUT_CLASSES = 'mt-1 block w-full px-3 py-2 bg-white border border-gray-300 rounded-md text-sm shadow-sm placeholder-gray-400 focus:outline-none focus:ring-1 focus:ring-blue-500 focus:border-blue-500';
+    const csrfToken = form.querySelector('input[name="csrfmiddlewaretoken"]').value;
+    const offlineStatus = document.getElementById('offlineStatus');
+
+    const respondentStep = document.getElementById('respondentStep');
+    const sectionStep = document.getElementById('sectionStep');
+    const sectionTitle = document.getElementById('sectionTitle');
+    const sectionQuestions = document.getElementById('sectionQuestions');
+    const completeStep = document.getElementById('completeStep');
+    const formError = document.getElementById('formError');
+    const prevBtn = document.getElementById('prevBtn');
+    const nextBtn = document.getElementById('nextBtn');
+    const submitBtn = document.getElementById('submitBtn');
+
+    const state = {
+        schema: null,
+        step: -1,           // -1 = respondent step, otherwise the section index
+        respondent: {},
+        answers: {},        // field name -> array of string values, like FormData
+    };
+
+    // --- Consent ---
+    const acceptYes = document.getElementById('acceptDataProtectionYes');
+    const acceptNo = document.getElementById('acceptDataProtectionNo');
+    const continueButton = document.getElementById('continueToSurvey');
+    function updateConsent() {
+        if (acceptYes.checked) continueButton.removeAttribute('disabled');
+        else continueButton.setAttribute('disabled', 'disabled');
+    }
+    acceptYes.addEventListener('change', updateConsent);
+    acceptNo.addEventListener('change', updateConsent);
+    continueButton.addEventListener('click', () => {
+        if (!acceptYes.checked) return;
+        document.getElementById('dataProtectionSection').style.display = 'none';
+        document.getElementById('surveyContentWrapper').style.display = 'block';
+        window.scrollTo({ top: 0, behavior: 'smooth' });
+    });
+    updateConsent();
+
+    // --- Schema ---
+    const schemaReady = fetch(form.dataset.schemaUrl, { credentials: 'same-origin' })
+        .then(response => {
+            if (!response.ok) throw new Error('schema ' + response.status);
+            return response.json();
+        })
+        .then(schema => {
+            state.schema = schema;
+            return schema;
+        })
+        .catch(() => showFormError('No se pudo cargar la encuesta. Verifica tu conexión e inténtalo de nuevo.'));
+
+    // Location catalog bundle, loaded once so the location questions also work offline.
+    // Each municipio carries its ubicaciones as [id, nombre, loc, zona].
+    const catalog = { municipios: [], ubicacionesByMunicipio: {}, ubicaciones: {} };
+    const catalogReady = fetch(form.dataset.catalogUrl, { credentials: 'same-origin' })
+        .then(response => response.json())
+        .then(data => {
+            data.municipios.forEach(m => {
+                catalog.municipios.push({ id: m.id, nombre: m.nombre });
+                catalog.ubicacionesByMunicipio[m.id] = m.ubicaciones.map(([id, nombre, loc, zona]) => {
+                    const u = { id: id, municipio_id: m.id, nombre: nombre, loc: loc, zona: zona };
+                    catalog.ubicaciones[id] = u;
+                    return u;
+                });
+            });
+        })
+        .catch(() => {});
+
+    // --- Helpers ---
+    function el(tag, attrs, text) {
+        const node = document.createElement(tag);
+        Object.entries(attrs || {}).forEach(([key, value]) => {
+            if (value !== null && value !== undefined && value !== false) node.setAttribute(key, value === true ? '' : value);
+        });
+        if (text !== undefined) node.textContent = text;
+        return node;
+    }
+
+    function showFormError(message) {
+        formError.textContent = message || '';
+        formError.classList.toggle('hidden', !message);
+    }
+
+    function setFieldError(fieldWrapper, message) {
+        if (!fieldWrapper) return;
+        fieldWrapper.classList.add('border', 'border-red-300', 'bg-red-50');
+        const err = fieldWrapper.querySelector('.client-error');
+        if (err) { err.textContent = message; err.classList.remove('hidden'); }
+    }
+
+    function clearErrors(container) {
+        container.querySelectorAll('.field').forEach(fieldWrapper => {
+            fieldWrapper.classList.remove('border', 'border-red-300', 'bg-red-50');
+            const err = fieldWrapper.querySelector('.client-error');
+            if (err) { err.textContent = ''; err.classList.add('hidden'); }
+        });
+    }
+
+    function answerValues(name) {
+        return state.answers[name] || [];
+    }
+
+    // --- Dependencies (same rules as the step-by-step wizard) ---
+    function isQuestionVisible(question) {
+        if (!question.depends_on) return true;
+        const parentState = answerValues(`question_${question.depends_on}`);
+        if (question.depends_on_option) {
+            return parentState.some(value => value.startsWith(question.depends_on_option + '__') || value === String(question.depends_on_option));
+        }
+        if (question.depends_on_value_min !== null || question.depends_on_value_max !== null) {
+            if (!parentState.length) return false;
+            const parentValue = parseFloat(parentState[0]);
+            if (isNaN(parentValue)) return false;
+            if (question.depends_on_value_min !== null && parentValue < question.depends_on_value_min) return false;
+            if (question.depends_on_value_max !== null && parentValue > question.depends_on_value_max) return false;
+            return true;
+        }
+        return false;
+    }
+
+    // --- Rendering ---
+    function renderChoices(question, name, type) {
+        const container = el('div', { class: type === 'radio' ? 'radio-options-inline' : 'checkbox-options-inline' });
+        const list = el('div');
+        question.options.forEach((option, idx) => {
+            const id = `${name}_${idx}`;
+            const label = el('label', { for: id });
+            const input = el('input', { type: type, name: name, id: id, value: option.value });
+            label.appendChild(input);
+            label.appendChild(document.createTextNode(option.label));
+            list.appendChild(label);
+        });
+        container.appendChild(list);
+        return container;
+    }
+
+    function renderSelect(name, choices, emptyLabel) {
+        const select = el('select', { name: name, class: INPUT_CLASSES });
+        select.appendChild(el('option', { value: '' }, emptyLabel));
+        choices.forEach(([value, label]) => select.appendChild(el('option', { value: value }, label)));
+        return select;
+    }
+
+    function renderUbicacion(question, name) {
+        const container = el('div', { class: 'space-y-3' });
+        const municipioSelect = renderSelect(`${name}_municipio`, catalog.municipios.map(m => [m.id, m.nombre]), 'Selecciona un municipio');
+        const ubicacionSelect = renderSelect(`${name}_ubicacion`, [], 'Selecciona un municipio primero');
+        const locInput = el('input', { type: 'text', name: `${name}_loc`, readonly: true, class: INPUT_CLASSES, placeholder: 'LOC' });
+        const zonaInput = el('input', { type: 'text', name: `${name}_zona`, readonly: true, class: INPUT_CLASSES, placeholder: 'ZONA' });
+        [['Municipio', municipioSelect], ['Barrio/Localidad', ubicacionSelect], ['LOC', locInput], ['ZONA', zonaInput]].forEach(([text, input]) => {
+            const wrapper = el('div', { class: 'field', 'data-name': input.name });
+            wrapper.appendChild(el('label', { class: 'block text-sm font-medium text-gray-700 mb-1' }, text));
+            wrapper.appendChild(input);
+            wrapper.appendChild(el('p', { class: 'client-error text-xs text-red-600 mt-1 hidden' }));
+            container.appendChild(wrapper);
+        });
+
+        function loadUbicaciones(municipioId, selected) {
+            ubicacionSelect.innerHTML = '';
+            if (!municipioId) {
+                ubicacionSelect.appendChild(el('option', { value: '' }, 'Selecciona un municipio primero'));
+                return Promise.resolve();
+            }
+            ubicacionSelect.appendChild(el('option', { value: '' }, 'Selecciona una ubicación'));
+            (catalog.ubicacionesByMunicipio[municipioId] || []).forEach(u => ubicacionSelect.appendChild(el('option', { value: u.id }, u.nombre)));
+            if (selected) ubicacionSelect.value = selected;
+        }
+
+        municipioSelect.addEventListener('change', () => {
+            locInput.value = '';
+            zonaInput.value = '';
+            loadUbicaciones(municipioSelect.value);
+        });
+        ubicacionSelect.addEventListener('change', () => {
+            locInput.value = '';
+            zonaInput.value = '';
+            const ubicacion = catalog.ubicaciones[ubicacionSelect.value];
+            if (!ubicacion) return;
+            locInput.value = ubicacion.loc;
+            zonaInput.value = ubicacion.zona;
+            collectSection();
+        });
+
+        const savedMunicipio = answerValues(`${name}_municipio`)[0];
+        if (savedMunicipio) {
+            municipioSelect.value = savedMunicipio;
+            loadUbicaciones(savedMunicipio, answerValues(`${name}_ubicacion`)[0]);
+        }
+        return container;
+    }
+
+    function renderControl(question, name) {
+        switch (question.qtype) {
+            case 'text':
+                return question.max_choices === 0
+                    ? el('textarea', { name: name, rows: 2, class: INPUT_CLASSES })
+                    : el('input', { type: 'text', name: name, class: INPUT_CLASSES });
+            case 'int':
+                return el('input', { type: 'number', step: 1, name: name, min: question.min_value, max: question.max_value, class: INPUT_CLASSES });
+            case 'dec':
+                return el('input', { type: 'number', step: 'any', name: name, class: INPUT_CLASSES });
+            case 'bool':
+                return el('input', { type: 'checkbox', name: name, value: 'on' });
+            case 'date':
+                return el('input', { type: 'date', name: name, class: INPUT_CLASSES });
+            case 'single':
+                if (question.single_choice_display === 'select') {
+                    return renderSelect(name, question.options.map(o => [o.value, o.label]), 'Seleccione una respuesta');
+                }
+                return renderChoices(question, name, 'radio');
+            case 'likert':
+                return renderChoices(question, name, 'radio');
+            case 'multi':
+                return renderChoices(question, name, 'checkbox');
+            case 'ubicacion':
+                return renderUbicacion(question, name);
+        }
+        return null;
+    }
+
+    function restoreValue(container, name) {
+        const values = answerValues(name);
+        container.querySelectorAll(`[name="${CSS.escape(name)}"]`).forEach(input => {
+            if (input.type === 'radio' || input.type === 'checkbox') {
+                input.checked = values.includes(input.value);
+                input.closest('label')?.classList.toggle('selected', input.checked);
+            } else if (values.length) {
+                input.value = values[0];
+            }
+        });
+    }
+
+    function copyInitialValue(question, name) {
+        if (!question.copy_from || state.answers[name]) return;
+        let copied = state.respondent[question.copy_from];
+        if (copied === undefined) copied = answerValues(question.copy_from)[0];
+        if (copied !== undefined && copied !== '') state.answers[name] = [String(copied)];
+    }
+
+    function renderSection(index) {
+        const section = state.schema.sections[index];
+        sectionTitle.textContent = `Sección ${index + 1}: ${section.title}`;
+        sectionQuestions.innerHTML = '';
+
+        section.questions.forEach((question, idx) => {
+            const name = `question_${question.id}`;
+            copyInitialValue(question, name);
+            const control = renderControl(question, name);
+            if (!control) return;
+
+            const wrapper = el('div', { class: 'question-wrapper', 'data-question-id': question.id });
+            const field = el('div', { class: 'field', 'data-required': question.required ? '1' : '0', 'data-name': name });
+            const label = el('label', { class: 'block text-base font-medium text-gray-800 mb-3' }, `${section.question_offset + idx + 1}. ${question.text}`);
+            if (question.required) label.appendChild(el('span', { class: 'text-red-500' }, ' *'));
+            field.appendChild(label);
+            if (question.help_text) field.appendChild(el('p', { class: 'text-xs text-gray-500 mb-2' }, question.help_text));
+            field.appendChild(control);
+
+            if (question.other_trigger) {
+                const otherName = `${name}_other_text`;
+                const otherWrapper = el('div', { class: 'other-text-wrapper mt-3', style: 'display: none;' });
+                otherWrapper.appendChild(el('label', { class: 'block text-sm font-medium text-gray-700 mb-1' }, question.other_text_label));
+                otherWrapper.appendChild(el('input', { type: 'text', name: otherName, class: INPUT_CLASSES }));
+                field.appendChild(otherWrapper);
+            }
+            field.appendChild(el('p', { class: 'client-error text-xs text-red-600 mt-2 hidden' }));
+            wrapper.appendChild(field);
+            sectionQuestions.appendChild(wrapper);
+
+            if (question.qtype !== 'ubicacion') {
+                restoreValue(wrapper, name);
+                restoreValue(wrapper, `${name}_other_text`);
+            }
+        });
+        refreshVisibility();
+    }
+
+    function currentSection() {
+        return state.step >= 0 ? state.schema.sections[state.step] : null;
+    }
+
+    function refreshVisibility() {
+        const section = currentSection();
+        if (!section) return;
+        section.questions.forEach(question => {
+            const wrapper = sectionQuestions.querySelector(`.question-wrapper[data-question-id="${question.id}"]`);
+            if (!wrapper) return;
+            wrapper.style.display = isQuestionVisible(question) ? '' : 'none';
+
+            const otherWrapper = wrapper.querySelector('.other-text-wrapper');
+            if (otherWrapper) {
+                const triggerSelected = answerValues(`question_${question.id}`).some(value => value.split('__')[1] === question.other_trigger);
+                otherWrapper.style.display = triggerSelected ? 'block' : 'none';
+            }
+        });
+    }
+
+    // Read the inputs of the visible section back into state.answers
+    function collectSection() {
+        const section = currentSection();
+        if (!section) return;
+        const prefixes = section.questions.map(q => `question_${q.id}`);
+        Object.keys(state.answers).forEach(name => {
+            if (prefixes.some(prefix => name === prefix || name.startsWith(prefix + '_'))) delete state.answers[name];
+        });
+        new FormData(form).forEach((value, name) => {
+            if (!name.startsWith('question_') || value === '') return;
+            (state.answers[name] = state.answers[name] || []).push(value);
+        });
+    }
+
+    function collectRespondent() {
+        state.respondent = {};
+        respondentStep.querySelectorAll('input, select, textarea').forEach(input => {
+            if (input.name) state.respondent[input.name] = input.value.trim();
+        });
+    }
+
+    function validateRespondent() {
+        clearErrors(respondentStep);
+        let valid = true;
+        respondentStep.querySelectorAll('.field[data-required="1"]').forEach(fieldWrapper => {
+            const input = fieldWrapper.querySelector('input, select, textarea');
+            if (input && (!input.checkValidity() || !input.value.trim())) {
+                setFieldError(fieldWrapper, 'Este campo es obligatorio o no es válido.');
+                valid = false;
+            }
+        });
+        return valid;
+    }
+
+    function validateSection() {
+        clearErrors(sectionQuestions);
+        let valid = true;
+        currentSection().questions.forEach(question => {
+            if (!question.required || !isQuestionVisible(question)) return;
+            const name = `question_${question.id}`;
+            const key = question.qtype === 'ubicacion' ? `${name}_ubicacion` : name;
+            if (!answerValues(key).length) {
+                setFieldError(sectionQuestions.querySelector(`.field[data-name="${key}"]`), 'Esta pregunta es obligatoria.');
+                valid = false;
+            }
+        });
+        return valid;
+    }
+
+    // Answers of hidden questions are not sent, exactly like the wizard never shows them
+    function visibleAnswers() {
+        const visible = {};
+        state.schema.sections.forEach(section => section.questions.forEach(question => {
+            if (!isQuestionVisible(question)) return;
+            const prefix = `question_${question.id}`;
+            Object.entries(state.answers).forEach(([name, values]) => {
+                if (name === prefix || name.startsWith(prefix + '_')) visible[name] = values;
+            });
+        }));
+        return visible;
+    }
+
+    // --- Navigation ---
+    function showStep(step) {
+        state.step = step;
+        showFormError('');
+        const total = state.schema ? state.schema.sections.length : 0;
+        respondentStep.classList.toggle('hidden', step !== -1);
+        sectionStep.classList.toggle('hidden', step === -1);
+        prevBtn.classList.toggle('hidden', step === -1);
+        nextBtn.classList.toggle('hidden', step === total - 1);
+        submitBtn.classList.toggle('hidden', step !== total - 1);
+
+        const progressWrapper = document.getElementById('progressWrapper');
+        progressWrapper.classList.toggle('hidden', step === -1);
+        if (step >= 0) {
+            renderSection(step);
+            const percentage = Math.round(((step + 1) / total) * 100);
+            document.getElementById('stepText').textContent = `Sección ${step + 1} de ${total}: ${state.schema.sections[step].title}`;
+            document.getElementById('progressBar').style.width = `${percentage}%`;
+            document.getElementById('percentText').textContent = `${percentage}%`;
+        }
+        window.scrollTo({ top: 0, behavior: 'smooth' });
+    }
+
+    function checkRespondent() {
+        const body = new FormData();
+        body.append('identificacion', state.respondent.identificacion || '');
+        body.append('document_type', state.respondent.document_type || '');
+        body.append('csrfmiddlewaretoken', csrfToken);
+        return fetch(form.dataset.checkUrl, { method: 'POST', body: body, credentials: 'same-origin' })
+            .then(response => response.json());
+    }
+
+    nextBtn.addEventListener('click', () => {
+        if (state.step === -1) {
+            if (!validateRespondent()) return;
+            collectRespondent();
+            Promise.all([schemaReady, catalogReady])
+                .then(() => checkRespondent())
+                .then(result => {
+                    if (!state.schema) return;
+                    if (result.valid === false) {
+                        showFormError(result.message);
+                        return;
+                    }
+                    showStep(0);
+                })
+                .catch(() => { if (state.schema) showStep(0); });
+            return;
+        }
+        collectSection();
+        if (!validateSection()) return;
+        showStep(state.step + 1);
+    });
+
+    prevBtn.addEventListener('click', () => {
+        if (state.step >= 0) collectSection();
+        showStep(state.step - 1);
+    });
+
+    sectionQuestions.addEventListener('change', event => {
+        const input = event.target;
+        if (input.type === 'radio') {
+            sectionQuestions.querySelectorAll(`input[name="${CSS.escape(input.name)}"]`).forEach(radio => radio.closest('label')?.classList.remove('selected'));
+        }
+        if (input.type === 'radio' || input.type === 'checkbox') input.closest('label')?.classList.toggle('selected', input.checked);
+        collectSection();
+        refreshVisibility();
+    });
+
+    function showServerErrors(errors) {
+        if (errors.respondent) {
+            showStep(-1);
+            Object.entries(errors.respondent).forEach(([name, messages]) => {
+                setFieldError(respondentStep.querySelector(`.field[data-name="${name}"]`), messages.map(m => m.message).join(' '));
+            });
+            return;
+        }
+        const sectionErrors = errors.sections || {};
+        const index = state.schema.sections.findIndex(section => sectionErrors[String(section.id)]);
+        if (index === -1) return;
+        showStep(index);
+        Object.entries(sectionErrors[String(state.schema.sections[index].id)]).forEach(([name, messages]) => {
+            setFieldError(sectionQuestions.querySelector(`.field[data-name="${name}"]`), messages.map(m => m.message).join(' '));
+        });
+    }
+
+    function buildPayload() {
+        return {
+            data_protection_accepted: acceptYes.checked,
+            respondent: state.respondent,
+            answers: visibleAnswers(),
+        };
+    }
+
+    function onSubmitted(data) {
+        form.querySelectorAll('.step, #navButtons, #progressWrapper').forEach(node => node.classList.add('hidden'));
+        document.getElementById('completeMessage').textContent = data.message;
+        completeStep.classList.remove('hidden');
+    }
+
+    // --- Offline mode ---
+    const offlineQueue = window.SurveyOfflineQueue;
+
+    function queueSubmission(payload) {
+        if (!offlineQueue) {
+            showFormError('No se pudo enviar la encuesta. Verifica tu conexión e inténtalo de nuevo.');
+            return Promise.resolve();
+        }
+        return offlineQueue.add(Object.assign({ survey: state.schema.code }, payload))
+            .then(() => {
+                onSubmitted({ message: 'Sin conexión: la encuesta quedó guardada en este dispositivo y se enviará automáticamente cuando vuelva la conexión.' });
+                refreshOfflineStatus();
+            })
+            .catch(() => showFormError('No se pudo guardar la encuesta en el dispositivo.'));
+    }
+
+    function refreshOfflineStatus() {
+        if (!offlineQueue || !offlineStatus) return;
+        offlineQueue.pendingCount().then(count => {
+            offlineStatus.textContent = count ? `${count} encuesta(s) pendiente(s) por sincronizar.` : '';
+            offlineStatus.classList.toggle('hidden', !count);
+        });
+    }
+
+    function syncQueue() {
+        if (!offlineQueue || !navigator.onLine) return;
+        offlineQueue.sync(form.dataset.syncUrl, csrfToken)
+            .catch(() => {})
+            .finally(refreshOfflineStatus);
+    }
+
+    if ('serviceWorker' in navigator) {
+        navigator.serviceWorker.register(form.dataset.serviceWorkerUrl).catch(() => {});
+    }
+    window.addEventListener('online', syncQueue);
+    syncQueue();
+
+    submitBtn.addEventListener('click', () => {
+        collectSection();
+        if (!validateSection()) return;
+        submitBtn.setAttribute('disabled', 'disabled');
+        const payload = buildPayload();
+        if (!navigator.onLine) {
+            queueSubmission(payload).finally(() => submitBtn.removeAttribute('disabled'));
+            return;
+        }
+        fetch(form.dataset.submitUrl, {
+            method: 'POST',
+            credentials: 'same-origin',
+            headers: { 'Content-Type': 'application/json', 'X-CSRFToken': csrfToken },
+            body: JSON.stringify(payload),
+        })
+            .then(response => response.json().then(data => {
+                if (data.ok) {
+                    onSubmitted(data);
+                    return;
+                }
+                showFormError(data.message);
+                if (data.errors) showServerErrors(data.errors);
+            }), () => queueSubmission(payload))  // network failure: keep it on the device
+            .finally(() => submitBtn.removeAttribute('disabled'));
+    });
+})();
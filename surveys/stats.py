@@ -0,0 +1,589 @@
+"""
+Aggregates behind the statistics pages.
+
+The stats page reads the per-day rollups kept by ``surveys.rollups`` (``question_stats``,
+``question_coverage``, ``response_totals``), so its cost grows with the number of
+options and days in the range, not with the number of responses.
+
+Distribution statistics of INTEGER, DECIMAL and DATE questions (quartiles, standard
+deviation, histograms) need the raw values: ``distribution_stats`` reads them as one
+responses × questions array, from the columnar store when it is current or with one
+query otherwise, and sorts it once. Results are cached (``cached_stats``) per survey and
+filter until the survey's responses version is bumped by a new, edited or deleted response.
+
+``time_series`` counts responses per hour, day, week or month in the local time zone,
+optionally per interviewer or per ubicacion. Day and coarser buckets are summed from the
+day rollups; hour buckets are grouped in the database over the ``(survey, created_at)``
+index of ResponseSet, so only the rows of the range are read.
+
+Date ranges are local days and include both ends.
+
+Location rollups group the responses by the Ubicacion picked in a UBICACION question.
+Per-ubicacion counts come from one grouped query (two with an option breakdown); zona
+and municipio totals are derived in Python from the in-memory location catalog, so
+adding a level costs no extra query.
+"""
+import math
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+
+import numpy as np
+from django.core.cache import cache
+from django.db.models import Count, Max, Min, Sum
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from .caching import bump_version, get_version
+from .catalog import get_catalog
+from .columnar import EPOCH, current_matrix
+from .crosstab import DEFAULT_BINS, bin_values
+from .models import (
+    Answer, Interviewer, InterviewerDayRollup, OptionDayRollup, QuestionDayRollup, QuestionType, ResponseDayRollup, ResponseSet,
+    UbicacionDayRollup,
+)
+
+UbicacionThrough = Answer.selected_ubicaciones.through
+
+OPTION_TYPES = (QuestionType.SINGLE, QuestionType.MULTI, QuestionType.LIKERT)
+NUMERIC_TYPES = (QuestionType.INTEGER, QuestionType.DECIMAL)
+DISTRIBUTION_TYPES = NUMERIC_TYPES + (QuestionType.DATE,)
+QUARTILES = (0.25, 0.5, 0.75)
+STATS_CACHE_TIMEOUT = 60 * 60 * 24
+GRANULARITIES = ('hour', 'day', 'week', 'month')
+BREAKDOWNS = ('interviewer', 'ubicacion')
+MAX_BUCKETS = 5000
+# Larger breakdowns fold their smallest series into "Otros"
+MAX_SERIES = 15
+
+
+def _empty_bucket(option_ids):
+    bucket = {'responses': 0}
+    if option_ids is not None:
+        bucket['options'] = dict.fromkeys(option_ids, 0)
+    return bucket
+
+
+def _fold_locations(catalog, question, counts, option_ids=None):
+    """
+    Per-ubicacion ``{(ubicacion_id, option_id or None): responses}`` folded into the
+    ubicacion, zona and municipio buckets.
+    """
+    by_ubicacion, by_zona, by_municipio = {}, {}, {}
+    for (ubicacion_id, option_id), responses in counts.items():
+        ubicacion = catalog.ubicacion(ubicacion_id)
+        municipio_id = catalog.municipio_of(ubicacion_id)
+        zona = ubicacion[3] if ubicacion else ''
+        for buckets, key in ((by_ubicacion, ubicacion_id), (by_zona, zona), (by_municipio, municipio_id)):
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = _empty_bucket(option_ids)
+            if option_id is None:
+                bucket['responses'] += responses
+            elif option_id in bucket['options']:
+                bucket['options'][option_id] += responses
+
+    municipio_names = dict(catalog.municipios)
+    for ubicacion_id, bucket in by_ubicacion.items():
+        ubicacion = catalog.ubicacion(ubicacion_id)
+        bucket['nombre'] = ubicacion[1] if ubicacion else ''
+        bucket['zona'] = ubicacion[3] if ubicacion else ''
+    for municipio_id, bucket in by_municipio.items():
+        bucket['nombre'] = municipio_names.get(municipio_id, '')
+
+    return {
+        'question': {'id': question.id, 'text': question.text},
+        'total_responses': sum(bucket['responses'] for bucket in by_municipio.values()),
+        'max_responses': max((bucket['responses'] for bucket in by_ubicacion.values()), default=0),
+        'by_ubicacion': by_ubicacion,
+        'by_zona': by_zona,
+        'by_municipio': by_municipio,
+    }
+
+
+def location_rollup(response_sets, question, by_question=None):
+    """
+    Responses per ubicacion, zona and municipio for the UBICACION ``question``, and,
+    with ``by_question`` (a single/multi/likert question), how many of those responses
+    picked each of its options.
+    """
+    catalog = get_catalog()
+    option_ids = [option.id for option in by_question.options] if by_question is not None else None
+
+    rows = (
+        UbicacionThrough.objects
+        .filter(answer__question_id=question.id, answer__response__in=response_sets)
+        .values_list('ubicacion_id')
+        .annotate(responses=Count('answer__response_id', distinct=True))
+    )
+    counts = {(ubicacion_id, None): responses for ubicacion_id, responses in rows}
+    if by_question is not None:
+        # (ubicacion, option) pairs: the location answer and the option answer of the
+        # same response, joined through the response
+        rows = (
+            Answer.objects
+            .filter(question_id=by_question.id, response__in=response_sets,
+                    response__answers__question_id=question.id)
+            .values_list('response__answers__selected_ubicaciones', 'options')
+            .annotate(responses=Count('response_id', distinct=True))
+        )
+        counts.update({
+            (ubicacion_id, option_id): responses
+            for ubicacion_id, option_id, responses in rows if ubicacion_id and option_id
+        })
+
+    result = _fold_locations(catalog, question, counts, option_ids)
+    if by_question is not None:
+        result['by_question'] = {
+            'id': by_question.id, 'text': by_question.text,
+            'options': [{'id': option.id, 'label': option.label} for option in by_question.options],
+        }
+    return result
+
+
+def location_questions(survey):
+    return [q for q in survey.questions if q.qtype == QuestionType.UBICACION]
+
+
+def _rollups(model, survey, start=None, end=None):
+    """Rollup rows of ``survey`` for the days from ``start`` to ``end``, both included."""
+    rows = model.objects.filter(survey_id=survey.id)
+    if start:
+        rows = rows.filter(day__gte=start)
+    if end:
+        rows = rows.filter(day__lte=end)
+    return rows
+
+
+def response_totals(survey, start=None, end=None):
+    """
+    ``(responses, [(day, responses)], [{'interviewer__full_name', 'count'}])`` for the
+    days from ``start`` to ``end``; responses without an interviewer are grouped under None.
+    """
+    daily = list(
+        _rollups(ResponseDayRollup, survey, start, end)
+        .filter(responses__gt=0)
+        .values_list('day')
+        .annotate(total=Sum('responses'))
+        .order_by('day')
+    )
+    total = sum(responses for _, responses in daily)
+    by_interviewer = list(
+        _rollups(InterviewerDayRollup, survey, start, end)
+        .values('interviewer__full_name')
+        .annotate(count=Sum('responses'))
+        .filter(count__gt=0)
+    )
+    without_interviewer = total - sum(row['count'] for row in by_interviewer)
+    if without_interviewer:
+        by_interviewer.append({'interviewer__full_name': None, 'count': without_interviewer})
+    by_interviewer.sort(key=lambda row: -row['count'])
+    return total, daily, by_interviewer
+
+
+def response_count(survey, start=None, end=None):
+    """Responses of the days from ``start`` to ``end``, from the day rollups."""
+    return _rollups(ResponseDayRollup, survey, start, end).aggregate(total=Sum('responses'))['total'] or 0
+
+
+def _scoped(rows, questions):
+    """``rows`` limited to ``questions`` (a subset of the survey's), or all of them for None."""
+    return rows if questions is None else rows.filter(question_id__in=[q.id for q in questions])
+
+
+def question_coverage(survey, response_count, start=None, end=None, questions=None):
+    """
+    Per question id (of ``questions``, by default every question of the survey): responses
+    that answered it, that skipped it by its dependencies, and the rest.
+    """
+    rows = {
+        question_id: (answered, not_applicable)
+        for question_id, answered, not_applicable in (
+            _scoped(_rollups(QuestionDayRollup, survey, start, end), questions)
+            .values_list('question_id')
+            .annotate(Sum('answered'), Sum('not_applicable'))
+        )
+    }
+    coverage = {}
+    for q in survey.questions if questions is None else questions:
+        answered, not_applicable = rows.get(q.id, (0, 0))
+        coverage[q.id] = {
+            'answered': answered,
+            'not_applicable': not_applicable,
+            'missing': max(response_count - answered - not_applicable, 0),
+        }
+    return coverage
+
+
+def _numeric_data(qtype, count, total, total_sq, low, high):
+    if not count:
+        return {'avg': None, 'min': None, 'max': None, 'stddev': None}
+    mean = total / count
+    stddev = math.sqrt(max(total_sq / count - mean * mean, 0))
+    if qtype == QuestionType.INTEGER:
+        return {'avg': round(mean, 2), 'min': int(low), 'max': int(high), 'stddev': round(stddev, 2)}
+    return {'avg': round(Decimal(mean), 2), 'min': low, 'max': high, 'stddev': round(stddev, 2)}
+
+
+def question_stats(survey, start=None, end=None, questions=None):
+    """
+    ``{question_id: data}`` in the shapes the stats template renders, for the responses
+    of the days from ``start`` to ``end``, read from the rollups. ``questions`` limits it to
+    some of the survey's questions.
+    """
+    scope = questions
+    questions = survey.questions if questions is None else questions
+    option_counts = dict(
+        _scoped(_rollups(OptionDayRollup, survey, start, end), scope)
+        .values_list('option_id')
+        .annotate(Sum('count'))
+    )
+    values = {
+        question_id: rest
+        for question_id, *rest in (
+            _scoped(_rollups(QuestionDayRollup, survey, start, end), scope)
+            .filter(value_count__gt=0)
+            .values_list('question_id')
+            .annotate(Sum('value_count'), Sum('value_sum'), Sum('value_sum_sq'), Min('value_min'), Max('value_max'))
+        )
+    }
+    locations = {}
+    has_locations = any(q.qtype == QuestionType.UBICACION for q in questions)
+    if has_locations:
+        rows = (
+            _scoped(_rollups(UbicacionDayRollup, survey, start, end), scope)
+            .values_list('question_id', 'ubicacion_id')
+            .annotate(Sum('count'))
+            .filter(count__sum__gt=0)
+        )
+        for question_id, ubicacion_id, responses in rows:
+            locations.setdefault(question_id, {})[(ubicacion_id, None)] = responses
+
+    catalog = get_catalog() if has_locations else None
+    data = {}
+    for q in questions:
+        if q.qtype in OPTION_TYPES:
+            total_votes = sum(option_counts.get(o.id, 0) for o in q.options)
+            options = [
+                {
+                    'label': o.label,
+                    'count': option_counts.get(o.id, 0),
+                    'percentage': round(option_counts.get(o.id, 0) / total_votes * 100, 2) if total_votes else 0,
+                }
+                for o in q.options
+            ]
+            options.sort(key=lambda option: -option['count'])
+            data[q.id] = {'options': options, 'total_votes': total_votes}
+        elif q.qtype in NUMERIC_TYPES:
+            data[q.id] = _numeric_data(q.qtype, *values.get(q.id, (0, 0, 0, None, None)))
+        elif q.qtype == QuestionType.BOOL:
+            count, trues = values.get(q.id, (0, 0))[:2]
+            data[q.id] = {'true': int(trues), 'false': count - int(trues)}
+        elif q.qtype == QuestionType.UBICACION:
+            data[q.id] = _fold_locations(catalog, q, locations.get(q.id, {}))
+    return data
+
+
+def _responses_version_key(survey_id):
+    return f"surveys:responses:{survey_id}:version"
+
+
+def get_responses_version(survey_id):
+    return get_version(_responses_version_key(survey_id))
+
+
+def bump_responses_version(survey_id):
+    return bump_version(_responses_version_key(survey_id))
+
+
+def cached_stats(survey, name, params, build):
+    """
+    ``build()``, cached per survey, ``name`` and ``params`` until the survey's schema or
+    responses version changes.
+    """
+    # Read the version first: a response committed meanwhile bumps it past this entry
+    key = ':'.join(str(part) for part in (
+        'surveys:stats', name, survey.id, survey.version, get_responses_version(survey.id), *params,
+    ))
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        cache.set(key, value, timeout=STATS_CACHE_TIMEOUT)
+    return value
+
+
+def _day_start(day):
+    return timezone.make_aware(datetime.combine(day, datetime.min.time())) if day else None
+
+
+def datetime_bounds(start=None, end=None):
+    """
+    Aware ``[since, until)`` datetimes covering the local days from ``start`` to ``end``,
+    both included (None for an open end).
+    """
+    return _day_start(start), _day_start(end + timedelta(days=1)) if end else None
+
+
+def _answer_values(survey, questions, start=None, end=None):
+    """
+    Responses × ``questions`` float array of the answers given on the days from ``start``
+    to ``end``, read with one query.
+    """
+    columns = {q.id: i for i, q in enumerate(questions)}
+    fields = {
+        q.id: {QuestionType.INTEGER: 0, QuestionType.DECIMAL: 1, QuestionType.DATE: 2}[q.qtype]
+        for q in questions
+    }
+    answers = Answer.objects.filter(response__survey_id=survey.id, question_id__in=list(columns))
+    since, until = datetime_bounds(start, end)
+    if since:
+        answers = answers.filter(response__created_at__gte=since)
+    if until:
+        answers = answers.filter(response__created_at__lt=until)
+    response_ids, question_columns, values = [], [], []
+    for response_id, question_id, *answer in answers.values_list(
+        'response_id', 'question_id', 'integer_answer', 'decimal_answer', 'date_answer',
+    ):
+        value = answer[fields[question_id]]
+        if value is None:
+            continue
+        response_ids.append(response_id)
+        question_columns.append(columns[question_id])
+        values.append((value - EPOCH).days if fields[question_id] == 2 else float(value))
+    responses, rows = np.unique(np.array(response_ids, dtype=np.int64), return_inverse=True)
+    matrix = np.full((len(responses), len(questions)), np.nan)
+    matrix[rows, np.array(question_columns, dtype=np.int64)] = values
+    return matrix
+
+
+def _distribution_values(survey, questions, start=None, end=None):
+    matrix = current_matrix(survey)
+    if matrix is None:
+        return _answer_values(survey, questions, start, end)
+    rows = matrix.rows_between(*datetime_bounds(start, end))
+    return np.column_stack([matrix.column(q.id)[rows] for q in questions])
+
+
+def _format_value(question, value):
+    if question.qtype == QuestionType.DATE:
+        return (EPOCH + timedelta(days=int(round(value)))).isoformat()
+    if question.qtype == QuestionType.INTEGER and value == int(value):
+        return int(value)
+    return round(float(value), 2)
+
+
+def _distributions(questions, values, bins):
+    """``{question_id: data}`` from the responses × ``questions`` array ``values`` (NaN when unanswered)."""
+    if not len(values):
+        # One unanswered row keeps the indexing below valid
+        values = np.full((1, len(questions)), np.nan)
+    # NaN sorts last, so the answered values of column j are ordered[:counts[j], j]
+    ordered = np.sort(values, axis=0)
+    counts = (~np.isnan(values)).sum(axis=0)
+    columns = np.arange(len(questions))
+    last = np.maximum(counts - 1, 0)
+    quartiles = []
+    for q in QUARTILES:
+        # Linear interpolation between the closest ranks, as numpy.percentile
+        position = last * q
+        low = np.floor(position).astype(np.int64)
+        high = np.ceil(position).astype(np.int64)
+        weight = position - low
+        quartiles.append(ordered[low, columns] * (1 - weight) + ordered[high, columns] * weight)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.nansum(values, axis=0) / counts
+        stddevs = np.sqrt(np.nansum((values - means) ** 2, axis=0) / counts)
+
+    data = {}
+    for j, question in enumerate(questions):
+        count = int(counts[j])
+        if not count:
+            data[question.id] = {'count': 0, 'histogram': []}
+            continue
+        answered = ordered[:count, j]
+        is_date = question.qtype == QuestionType.DATE
+        label = (lambda day: (EPOCH + timedelta(days=day)).isoformat()) if is_date else str
+        codes, labels = bin_values(answered, question.qtype != QuestionType.DECIMAL, bins, label)
+        bin_counts = np.bincount(codes, minlength=len(labels)).tolist()
+        q1, median, q3 = (_format_value(question, quartile[j]) for quartile in quartiles)
+        data[question.id] = {
+            'count': count,
+            'min': _format_value(question, answered[0]),
+            'max': _format_value(question, answered[-1]),
+            'q1': q1,
+            'median': median,
+            'q3': q3,
+            # In days for dates
+            'stddev': round(float(stddevs[j]), 2),
+            'histogram': [
+                {'label': bin_label, 'count': n, 'percentage': round(n / count * 100, 2)}
+                for bin_label, n in zip(labels, bin_counts)
+            ],
+        }
+    return data
+
+
+def distribution_stats(survey, start=None, end=None, bins=DEFAULT_BINS, section=None):
+    """
+    Quartiles, standard deviation and histogram of every INTEGER, DECIMAL and DATE
+    question, ``{question_id: data}``, for the responses of the days from ``start`` to ``end``.
+    ``section`` limits it to the questions of one section, cached on their own.
+    """
+    questions = [
+        q for q in (survey.questions if section is None else section.questions)
+        if q.qtype in DISTRIBUTION_TYPES
+    ]
+    if not questions:
+        return {}
+    return cached_stats(
+        survey, 'distributions' if section is None else f'distributions:{section.id}', (start, end, bins),
+        lambda: _distributions(questions, _distribution_values(survey, questions, start, end), bins),
+    )
+
+
+def _day_bucket(day, granularity):
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def _shift_hours(moment, hours):
+    # In UTC, so a DST change neither repeats nor skips an hour
+    return timezone.localtime(moment.astimezone(dt_timezone.utc) + timedelta(hours=hours))
+
+
+def _next_bucket(bucket, granularity):
+    if granularity == 'hour':
+        return _shift_hours(bucket, 1)
+    if granularity == 'day':
+        return bucket + timedelta(days=1)
+    if granularity == 'week':
+        return bucket + timedelta(weeks=1)
+    return (bucket.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def _hour_counts(survey, start, end, by=None, question=None):
+    """``{(hour, key): responses}`` grouped in the database over the ``(survey, created_at)`` index."""
+    since, until = datetime_bounds(start, end)
+    responses = ResponseSet.objects.filter(survey_id=survey.id)
+    if since:
+        responses = responses.filter(created_at__gte=since)
+    if until:
+        responses = responses.filter(created_at__lt=until)
+    hour = TruncHour('created_at', tzinfo=timezone.get_current_timezone())
+    if by == 'interviewer':
+        rows = responses.annotate(hour=hour).values_list('hour', 'interviewer_id').annotate(Count('pk'))
+    elif by == 'ubicacion':
+        rows = (
+            UbicacionThrough.objects
+            .filter(answer__question_id=question.id, answer__response__in=responses)
+            .annotate(hour=TruncHour('answer__response__created_at', tzinfo=timezone.get_current_timezone()))
+            .values_list('hour', 'ubicacion_id')
+            .annotate(Count('answer__response_id', distinct=True))
+        )
+    else:
+        rows = ((hour_start, None, count) for hour_start, count in
+                responses.annotate(hour=hour).values_list('hour').annotate(Count('pk')))
+    counts = {}
+    for hour_start, key, count in rows:
+        bucket = (timezone.localtime(hour_start), key)
+        counts[bucket] = counts.get(bucket, 0) + count
+    return counts
+
+
+def _day_counts(survey, start, end, granularity, by=None, question=None):
+    """``{(bucket, key): responses}`` summed from the day rollups."""
+    if by == 'interviewer':
+        rows = (
+            _rollups(InterviewerDayRollup, survey, start, end)
+            .values_list('day', 'interviewer_id').annotate(Sum('responses'))
+        )
+    elif by == 'ubicacion':
+        rows = (
+            _rollups(UbicacionDayRollup, survey, start, end).filter(question_id=question.id)
+            .values_list('day', 'ubicacion_id').annotate(Sum('count'))
+        )
+    else:
+        rows = ((day, None, responses) for day, responses in
+                _rollups(ResponseDayRollup, survey, start, end).values_list('day').annotate(Sum('responses')))
+    counts = {}
+    for day, key, count in rows:
+        if count:
+            bucket = (_day_bucket(day, granularity), key)
+            counts[bucket] = counts.get(bucket, 0) + count
+    return counts
+
+
+def _series_labels(by, keys):
+    if by == 'interviewer':
+        names = dict(Interviewer.objects.filter(pk__in=[key for key in keys if key]).values_list('pk', 'full_name'))
+        return {key: names.get(key, '') if key else 'Sin encuestador' for key in keys}
+    catalog = get_catalog()
+    return {key: (catalog.ubicacion(key) or (None, ''))[1] for key in keys}
+
+
+def time_series(survey, granularity='day', start=None, end=None, by=None, question=None):
+    """
+    Responses of ``survey`` per ``granularity`` bucket for the days from ``start`` to
+    ``end``, with one series per interviewer or per ubicacion of the UBICACION
+    ``question`` when ``by`` asks for it. Empty buckets inside the range are included;
+    ValueError when the range has more than ``MAX_BUCKETS`` of them.
+    """
+    if granularity == 'hour':
+        counts = _hour_counts(survey, start, end, by, question)
+        first = _day_start(start)
+        last = _shift_hours(datetime_bounds(end=end)[1], -1) if end else None
+    else:
+        counts = _day_counts(survey, start, end, granularity, by, question)
+        first = _day_bucket(start, granularity) if start else None
+        last = _day_bucket(end, granularity) if end else None
+    if by == 'interviewer' and granularity != 'hour':
+        # The rollups only keep responses with an interviewer; the rest go under None
+        counted = {}
+        for (bucket, _), count in counts.items():
+            counted[bucket] = counted.get(bucket, 0) + count
+        for (bucket, _), total in _day_counts(survey, start, end, granularity).items():
+            if total > counted.get(bucket, 0):
+                counts[(bucket, None)] = total - counted.get(bucket, 0)
+
+    present = sorted({bucket for bucket, _ in counts})
+    first = first or (present[0] if present else None)
+    last = last or (present[-1] if present else None)
+    buckets = []
+    bucket = first
+    while first is not None and last is not None and bucket <= last:
+        if len(buckets) >= MAX_BUCKETS:
+            raise ValueError(f'More than {MAX_BUCKETS} buckets in the range.')
+        buckets.append(bucket)
+        bucket = _next_bucket(bucket, granularity)
+    index = {bucket: i for i, bucket in enumerate(buckets)}
+
+    totals = [0] * len(buckets)
+    by_key = {}
+    for (bucket, key), count in counts.items():
+        i = index.get(bucket)
+        if i is None:
+            continue
+        totals[i] += count
+        by_key.setdefault(key, [0] * len(buckets))[i] += count
+    data = {
+        'granularity': granularity,
+        'timezone': timezone.get_current_timezone_name(),
+        'buckets': [bucket.isoformat() for bucket in buckets],
+        'counts': totals,
+        'total': sum(totals),
+    }
+    if by:
+        labels = _series_labels(by, list(by_key))
+        series = sorted(
+            ({'key': key, 'label': labels[key], 'counts': values, 'total': sum(values)} for key, values in by_key.items()),
+            key=lambda item: -item['total'],
+        )
+        if len(series) > MAX_SERIES:
+            rest = series[MAX_SERIES - 1:]
+            others = [sum(values) for values in zip(*(item['counts'] for item in rest))]
+            series = series[:MAX_SERIES - 1] + [{'key': 'otros', 'label': 'Otros', 'counts': others, 'total': sum(others)}]
+        data['by'] = by
+        data['series'] = series
+    return data
@@ -0,0 +1,70 @@
+{% load static %}// Service worker of the offline fill mode. Static assets are served cache-first; pages,
+// survey schemas and the location catalog go to the network first and fall back to the
+// last cached copy when there is no coverage.
+const CACHE_NAME = 'surveys-offline-v2';
+const PRECACHE_URLS = [
+    '{% static "surveys/js/survey_single.js" %}',
+    '{% static "surveys/js/offline_queue.js" %}',
+    '{% static "surveys/images/logo.png" %}',
+    '{% url "surveys:catalog" %}',
+];
+const CROSS_ORIGIN_ASSETS = ['https://cdn.tailwindcss.com'];
+const STATIC_PREFIX = '{% get_static_prefix %}';
+
+self.addEventListener('install', event => {
+    event.waitUntil(
+        caches.open(CACHE_NAME).then(cache => Promise.all([
+            cache.addAll(PRECACHE_URLS),
+            ...CROSS_ORIGIN_ASSETS.map(url => fetch(new Request(url, { mode: 'no-cors' })).then(response => cache.put(url, response))),
+        ])).then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(
+        caches.keys()
+            .then(keys => Promise.all(keys.filter(key => key.startsWith('surveys-offline-') && key !== CACHE_NAME).map(key => caches.delete(key))))
+            .then(() => self.clients.claim())
+    );
+});
+
+function networkFirst(request) {
+    return fetch(request)
+        .then(response => {
+            if (response.ok) {
+                const copy = response.clone();
+                caches.open(CACHE_NAME).then(cache => cache.put(request, copy));
+            }
+            return response;
+        })
+        // The catalog URL carries its version; any cached version beats no catalog at all
+        .catch(() => caches.match(request)
+            .then(cached => cached || caches.match(request, { ignoreSearch: true }))
+            .then(cached => cached || Response.error()));
+}
+
+function cacheFirst(request) {
+    return caches.match(request).then(cached => cached || fetch(request).then(response => {
+        if (response.ok || response.type === 'opaque') {
+            const copy = response.clone();
+            caches.open(CACHE_NAME).then(cache => cache.put(request, copy));
+        }
+        return response;
+    }));
+}
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    if (request.method !== 'GET') return;  // submissions and sync always go to the server
+
+    const url = new URL(request.url);
+    if (url.origin !== self.location.origin) {
+        if (CROSS_ORIGIN_ASSETS.some(asset => request.url.startsWith(asset))) event.respondWith(cacheFirst(request));
+        return;
+    }
+    if (url.pathname.startsWith(STATIC_PREFIX)) {
+        event.respondWith(cacheFirst(request));
+    } else if (/^\/s\/[^/]+\/(single\/|schema\.json)$/.test(url.pathname) || url.pathname === '{% url "surveys:catalog" %}') {
+        event.respondWith(networkFirst(request));
+    }
+});
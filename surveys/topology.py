@@ -0,0 +1,166 @@
+"""
+TopoJSON-style topology of the Ubicacion polygons for the map picker.
+
+Rings are cut at the points where neighbouring polygons stop sharing a border, and
+identical pieces (in either direction) are stored once as "arcs", so a border between
+two barrios is shipped a single time. Each zoom level simplifies the arcs (not the
+rings, so neighbours stay glued together), quantizes them to an integer grid about a
+quarter pixel wide and delta-encodes them. Geometries are keyed by ``Ubicacion.id``.
+"""
+from pathlib import Path
+
+from django.conf import settings
+
+from .geo import simplify_line
+
+# Degrees covered by one 256 px tile pixel at zoom 0
+PIXEL_DEGREES_Z0 = 360 / 256
+DEFAULT_ZOOMS = (11, 13, 15)
+MAP_ARTIFACTS_SUBDIR = 'map'
+
+
+def _polygons(geometry):
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    return geometry['coordinates']
+
+
+def _clean_ring(ring):
+    """Ring as a list of distinct consecutive points, without the closing point."""
+    points = []
+    for x, y in ring:
+        point = (float(x), float(y))
+        if not points or points[-1] != point:
+            points.append(point)
+    if len(points) > 1 and points[0] == points[-1]:
+        points.pop()
+    return points
+
+
+class Topology:
+    """Arcs shared by a set of ``(id, properties, geometry)`` polygons."""
+
+    def __init__(self, features):
+        rings_by_feature = []
+        for feature_id, properties, geometry in features:
+            polygons = [[ring for ring in map(_clean_ring, polygon) if len(ring) >= 3] for polygon in _polygons(geometry)]
+            polygons = [polygon for polygon in polygons if polygon]
+            if polygons:
+                rings_by_feature.append((feature_id, properties, polygons))
+
+        junctions = self._junctions(ring for _, _, polygons in rings_by_feature for polygon in polygons for ring in polygon)
+        self.arcs = []
+        self._arc_index = {}
+        self.objects = [
+            (feature_id, properties, [[self._ring_arcs(ring, junctions) for ring in polygon] for polygon in polygons])
+            for feature_id, properties, polygons in rings_by_feature
+        ]
+        points = [point for arc in self.arcs for point in arc]
+        self.bbox = (
+            (min(p[0] for p in points), min(p[1] for p in points), max(p[0] for p in points), max(p[1] for p in points))
+            if points else None
+        )
+
+    @staticmethod
+    def _junctions(rings):
+        """Points whose neighbours differ between the rings that pass through them."""
+        neighbours = {}
+        junctions = set()
+        for ring in rings:
+            count = len(ring)
+            for i, point in enumerate(ring):
+                previous, following = ring[i - 1], ring[(i + 1) % count]
+                pair = (previous, following) if previous <= following else (following, previous)
+                seen = neighbours.setdefault(point, pair)
+                if seen != pair:
+                    junctions.add(point)
+        return junctions
+
+    def _arc(self, points):
+        """Index of ``points`` as an arc; ``~index`` when it is a stored arc reversed."""
+        key = tuple(points)
+        index = self._arc_index.get(key)
+        if index is not None:
+            return index
+        index = self._arc_index.get(key[::-1])
+        if index is not None:
+            return ~index
+        self._arc_index[key] = len(self.arcs)
+        self.arcs.append(key)
+        return len(self.arcs) - 1
+
+    def _ring_arcs(self, ring, junctions):
+        cuts = [i for i, point in enumerate(ring) if point in junctions]
+        if not cuts:
+            # A ring that shares nothing (or is shared whole) starts at its smallest point
+            # so the same ring always produces the same arc
+            start = ring.index(min(ring))
+            rotated = ring[start:] + ring[:start]
+            return [self._arc(rotated + [rotated[0]])]
+        rotated = ring[cuts[0]:] + ring[:cuts[0]]
+        offsets = [i - cuts[0] for i in cuts] + [len(ring)]
+        rotated.append(rotated[0])
+        return [self._arc(rotated[start:end + 1]) for start, end in zip(offsets, offsets[1:])]
+
+    def encode(self, zoom, properties=True):
+        """TopoJSON document for ``zoom``: simplified, quantized, delta-encoded arcs."""
+        if self.bbox is None:
+            return {'type': 'Topology', 'objects': {'ubicaciones': {'type': 'GeometryCollection', 'geometries': []}}, 'arcs': []}
+        pixel = PIXEL_DEGREES_Z0 / 2 ** zoom
+        min_x, min_y, max_x, max_y = self.bbox
+        kx = ky = pixel / 4
+        quantized_arcs = []
+        for arc in self.arcs:
+            simplified = simplify_line(arc, pixel)
+            points = []
+            for x, y in simplified:
+                point = (round((x - min_x) / kx), round((y - min_y) / ky))
+                if not points or points[-1] != point:
+                    points.append(point)
+            if len(points) == 1:
+                points.append(points[0])  # an arc always has two positions
+            quantized_arcs.append(points)
+
+        def ring_size(refs):
+            # Distinct vertices left in a ring once its arcs are simplified
+            return sum(len(quantized_arcs[ref if ref >= 0 else ~ref]) - 1 for ref in refs)
+
+        geometries = []
+        for feature_id, feature_properties, polygons in self.objects:
+            kept = []
+            for polygon in polygons:
+                rings = [refs for refs in polygon if ring_size(refs) >= 3]
+                # A polygon whose outer ring collapsed is below a pixel at this zoom
+                if rings and rings[0] is polygon[0]:
+                    kept.append(rings)
+            if not kept:
+                continue
+            geometry = {'type': 'Polygon', 'arcs': kept[0]} if len(kept) == 1 else {'type': 'MultiPolygon', 'arcs': kept}
+            geometry['id'] = feature_id
+            if properties and feature_properties:
+                geometry['properties'] = feature_properties
+            geometries.append(geometry)
+
+        encoded_arcs = []
+        for points in quantized_arcs:
+            delta, previous = [], (0, 0)
+            for point in points:
+                delta.append([point[0] - previous[0], point[1] - previous[1]])
+                previous = point
+            encoded_arcs.append(delta)
+        return {
+            'type': 'Topology',
+            'bbox': [min_x, min_y, max_x, max_y],
+            'transform': {'scale': [kx, ky], 'translate': [min_x, min_y]},
+            'objects': {'ubicaciones': {'type': 'GeometryCollection', 'geometries': geometries}},
+            'arcs': encoded_arcs,
+        }
+
+
+def map_artifacts_dir():
+    """Directory under MEDIA_ROOT with the built map payloads and their manifest."""
+    return Path(settings.MEDIA_ROOT) / MAP_ARTIFACTS_SUBDIR
+
+
+def map_manifest_path():
+    return map_artifacts_dir() / 'manifest.json'
@@ -9,9 +9,21 @@ urlpatterns = [
     path("public/", views.survey_list_public, name="public_list"),
     path("s/<slug:survey_code>/", views.survey_fill, name="fill"), # Changed 'code' to 'survey_code'
     path("s/<slug:survey_code>/check-respondent/", views.check_duplicate_respondent, name="check_respondent"), # Changed 'code' to 'survey_code'
+    path("s/<slug:survey_code>/single/", views.survey_fill_single, name="fill_single"),
+    path("s/<slug:survey_code>/schema.json", views.survey_schema_json, name="schema_json"),
+    path("s/<slug:survey_code>/submit/", views.survey_submit, name="submit"),
+    path("sync/", views.sync_responses, name="sync"),
+    path("catalog.json", views.location_catalog, name="catalog"),
+    path("sw.js", views.service_worker, name="service_worker"),
+    path("map/manifest.json", views.map_manifest, name="map_manifest"),
     path("stats/<slug:survey_code>/", views.survey_stats_view, name="stats"),
+    path("stats/<slug:survey_code>/map.json", views.survey_location_stats, name="location_stats"),
+    path("stats/<slug:survey_code>/crosstab.json", views.survey_crosstab, name="crosstab"),
+    path("stats/<slug:survey_code>/timeseries.json", views.survey_time_series, name="time_series"),
+    path("stats/<slug:survey_code>/sections/<int:section_id>.json", views.survey_stats_section, name="stats_section"),
     path("stats/<slug:survey_code>/export/excel/", views.export_survey_responses_excel, name="export_excel"),
     path("dashboard/", views.dashboard_view, name="dashboard"),
+    path("metrics/", views.metrics_view, name="metrics"),
     path("upload/", views.survey_upload_view, name="survey_upload"),
     path('download-template/', views.download_excel_template, name='download_excel_template'),
     path('download-example-template/', views.download_example_template, name='download_example_template'),
@@ -20,6 +32,8 @@ urlpatterns = [
     path("logout/", auth_views.LogoutView.as_view(), name="logout"),
     # AJAX
     path('ajax/get_ubicaciones/', views.get_ubicaciones, name='get_ubicaciones'),
+    path('ajax/search_ubicaciones/', views.search_ubicaciones_view, name='search_ubicaciones'),
+    path('ajax/locate_ubicacion/', views.locate_ubicacion_view, name='locate_ubicacion'),
     path('ajax/get_ubicacion_details/', views.get_ubicacion_details, name='get_ubicacion_details'),
     path('ajax/get_question_dependency_data/', views.get_question_dependency_data, name='get_question_dependency_data'),
 ]
\ No newline at end of file
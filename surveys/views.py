@@ -1,16 +1,34 @@
-from django.db import models
 from datetime import datetime
 from django.conf import settings # Added
 from django.shortcuts import render, get_object_or_404, redirect
+from django.template.loader import render_to_string
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import login
-from django.db import transaction
-from django.http import JsonResponse
+from django.db import IntegrityError
+from django.http import JsonResponse, HttpResponse, HttpResponseForbidden, HttpResponseNotModified, Http404
+from django.utils.datastructures import MultiValueDict
+from django.views.decorators.http import require_POST
 from django.urls import reverse
 from django.contrib import messages # <-- Añadido
-from .models import Survey, Section, Question, ResponseSet, Answer, DOCUMENT_TYPES, Ubicacion, Municipio, Interviewer, QuestionType, Option, SingleChoiceDisplayType, SingleChoiceDisplayType
+from .models import Survey, Section, Question, ResponseSet, DOCUMENT_TYPES, Ubicacion, Municipio, Interviewer, QuestionType, Option, SingleChoiceDisplayType, SingleChoiceDisplayType, ResponseDayRollup, InterviewerDayRollup
 from .forms import ResponseSetForm, build_answers_form_for_section, SurveyUploadForm
 from .forms_signup import SignUpForm
+from .schema import get_schema_or_404, get_survey_schema_by_code, schema_json
+from .persistence import save_survey_response, save_survey_responses
+from .dependencies import get_dependency_evaluator, inactive_questions, state_from_answers, state_from_data, state_from_survey_answers
+from .drafts import clear_draft_cookie, discard_draft, draft_answers, get_draft, save_draft_section, set_draft_cookie, start_draft
+from .metrics import registry as metrics_registry
+from .catalog import catalog_bundle_response, get_catalog, get_catalog_version, municipio_ubicaciones_response
+from .search import SEARCH_DEFAULT_LIMIT, SEARCH_MAX_LIMIT, search_ubicaciones
+from .geo import locate_ubicacion
+from .topology import map_manifest_path
+from .crosstab import CROSSTAB_TYPES, DEFAULT_BINS, MAX_BINS, crosstab, matrix_crosstab
+from .columnar import current_matrix
+from .stats import (
+    BREAKDOWNS, GRANULARITIES, cached_stats, datetime_bounds, distribution_stats, location_questions,
+    location_rollup, question_coverage, question_stats, response_count, response_totals, time_series,
+)
+import json
 import pandas as pd
 from django.utils.text import slugify
 
@@ -166,7 +184,13 @@ def _process_survey_excel(excel_file, status_callback):
                 continue
             
             # Asignar la pregunta padre
+            previous_parent_id = dependent_question.depends_on_id
             dependent_question.depends_on = parent_question
+            if dependent_question.has_dependency_cycle():
+                # Se guardaría sin full_clean y el formulario, el envío y las estadísticas fallarían
+                dependent_question.depends_on_id = previous_parent_id
+                status_callback('error', f"Error en la fila {index + 2}: la dependencia de '{dependent_question_text}' sobre '{parent_question_text}' crea un ciclo entre preguntas y no se aplicó.")
+                continue
 
             # Caso 1: Dependencia de Opción (radio/select)
             if pd.notna(row.get('depends_on_option')):
@@ -283,27 +307,62 @@ def cleaned_data_to_json(cleaned_data):
             json_data[key] = value
     return json_data
 
+def section_answers_to_json(section, answers_form, inactive=()):
+    cleaned_data = answers_form.cleaned_data
+    # Manually add the 'other' text to the cleaned_data before serialization
+    for question in section.questions:
+        trigger_option = question.trigger_option
+        if not trigger_option:
+            continue
+
+        field_name = f"question_{question.pk}"
+        selected_value = cleaned_data.get(field_name)
+
+        if not selected_value:
+            continue
+
+        if not isinstance(selected_value, list):
+            selected_value = [selected_value]
+
+        if trigger_option.value in selected_value:
+            other_text_field_name = f"question_{question.pk}_other_text"
+            other_text = (answers_form.data.get(other_text_field_name) or '').strip()
+            if other_text:
+                cleaned_data[other_text_field_name] = other_text
+
+    # Hidden questions are neither validated nor stored
+    for question in section.questions:
+        if question.id in inactive:
+            for field_name in answers_form.question_field_names.get(question.id, ()):
+                cleaned_data.pop(field_name, None)
+            cleaned_data.pop(f"question_{question.pk}_other_text", None)
+    return cleaned_data_to_json(cleaned_data)
+
+def _requested_section_index(request):
+    try:
+        return int(request.GET.get('section', 0))
+    except (TypeError, ValueError):
+        return -1
+
 def survey_fill(request, survey_code):
-    survey = get_object_or_404(Survey, code=survey_code, is_active=True)
-    sections = survey.sections.all()
+    survey = get_schema_or_404(survey_code, active_only=True)
+    total_sections = survey.total_sections
     url = reverse('surveys:fill', kwargs={'survey_code': survey_code})
 
-    # Initialize session data
-    if 'survey_answers' not in request.session:
-        request.session['survey_answers'] = {}
-    if 'respondent_data' not in request.session:
-        request.session['respondent_data'] = {}
-
+    # In-progress answers live in a draft (see surveys/drafts.py), not in the session
+    draft = get_draft(request, survey)
     is_respondent_step = 'section' not in request.GET
 
-    # If this is a GET request for the very first step, clear any old session data
-    # only if it's not a navigation from a later step.
-    if request.method == 'GET' and is_respondent_step and 'from_section' not in request.GET:
-        if 'survey_answers' in request.session:
-            del request.session['survey_answers']
-        if 'respondent_data' in request.session:
-            del request.session['respondent_data']
-        request.session.modified = True
+    # A GET of the very first step starts over, unless it is a navigation back from a later step
+    reset_draft = False
+    if request.method == 'GET' and is_respondent_step and 'from_section' not in request.GET and draft is not None:
+        discard_draft(draft)
+        draft = None
+        reset_draft = True
+
+    if not is_respondent_step and draft is None:
+        messages.warning(request, 'Tu avance en la encuesta expiró. Por favor, empieza de nuevo.')
+        return redirect(url)
 
     if request.method == 'POST':
         if request.POST.get('step_name') == 'respondent':
@@ -320,9 +379,8 @@ def survey_fill(request, survey_code):
 
             respondent_form = ResponseSetForm(request.POST, document_types=DOCUMENT_TYPES, user=request.user)
             if respondent_form.is_valid():
-                request.session['respondent_data'] = cleaned_data_to_json(respondent_form.cleaned_data)
-                request.session.modified = True
-                return redirect(f"{url}?section=0")
+                draft = start_draft(survey, cleaned_data_to_json(respondent_form.cleaned_data), draft=draft)
+                return set_draft_cookie(redirect(f"{url}?section=0"), survey, draft)
             else:
                 # Re-render respondent step with errors
                 context = {
@@ -333,128 +391,61 @@ def survey_fill(request, survey_code):
                 }
                 return render(request, 'surveys/survey_fill_steps.html', context)
         else:
-            current_section_idx = int(request.GET.get('section', 0))
-            current_section = sections[current_section_idx]
+            current_section_idx = _requested_section_index(request)
+            current_section = survey.section_at(current_section_idx)
+            if current_section is None:
+                return redirect('surveys:list')
+            is_last_section = current_section_idx == total_sections - 1
+
+            # Evaluate dependencies against the answers so far plus this section's POST
+            inactive = set()
+            evaluator = get_dependency_evaluator(survey)
+            if is_last_section or evaluator.has_dependencies(q.id for q in current_section.questions):
+                survey_answers = draft_answers(draft)
+                survey_answers.pop(str(current_section.pk), None)
+                state = state_from_survey_answers(survey_answers)
+                state.update(state_from_data(request.POST))
+                inactive = inactive_questions(evaluator, survey, state)
+
             AnswersForm = build_answers_form_for_section(current_section)
-            answers_form = AnswersForm(request.POST)
+            answers_form = AnswersForm(request.POST, inactive_questions=inactive)
 
             if answers_form.is_valid():
-                cleaned_data = answers_form.cleaned_data
-                # Manually add the 'other' text to the cleaned_data before session serialization
-                for question in current_section.questions.all():
-                    trigger_option = question.options.filter(is_other_trigger=True).first()
-                    if not trigger_option:
-                        continue
-
-                    field_name = f"question_{question.pk}"
-                    selected_value = cleaned_data.get(field_name)
-
-                    if not selected_value:
-                        continue
-
-                    if not isinstance(selected_value, list):
-                        selected_value = [selected_value]
-
-                    trigger_pk_code = f"{trigger_option.pk}__{trigger_option.code}"
-                    if trigger_pk_code in selected_value:
-                        other_text_field_name = f"question_{question.pk}_other_text"
-                        other_text = answers_form.data.get(other_text_field_name, '').strip()
-                        if other_text:
-                            cleaned_data[other_text_field_name] = other_text
-
-                request.session['survey_answers'][str(current_section.pk)] = cleaned_data_to_json(cleaned_data)
-                request.session.modified = True
-
-                if current_section_idx == len(sections) - 1:
-                    # --- SAVE TO DB LOGIC (same as before) ---
-                    with transaction.atomic():
-                        respondent_data = request.session.get('respondent_data', {})
-                        interviewer_id = respondent_data.get('interviewer')
-                        interviewer_instance = Interviewer.objects.get(pk=interviewer_id) if interviewer_id else None
-
-                        response_set, _ = ResponseSet.objects.get_or_create(
-                            survey=survey,
-                            identificacion=respondent_data.get('identificacion'),
-                            document_type=respondent_data.get('document_type'),
-                            defaults={
-                                'full_name': respondent_data.get('full_name'),
-                                'email': respondent_data.get('email'),
-                                'phone': respondent_data.get('phone'),
-                                'user': request.user if request.user.is_authenticated else None,
-                                'interviewer': interviewer_instance,
-                            }
-                        )
+                section_answers = section_answers_to_json(current_section, answers_form, inactive)
 
-                        for section_pk, section_answers in request.session.get('survey_answers', {}).items():
-                            section_obj = Section.objects.get(pk=section_pk)
-                            for question in section_obj.questions.all():
-                                field_name = f"question_{question.pk}"
-                                if question.qtype == 'ubicacion':
-                                    field_name = f"question_{question.pk}_ubicacion"
-                                
-                                answer_value = section_answers.get(field_name)
-                                other_text = section_answers.get(f"question_{question.pk}_other_text")
-
-                                # Determine the value for text_answer
-                                final_text_answer = ''
-                                if other_text:
-                                    final_text_answer = other_text
-                                elif question.qtype == 'text':
-                                    final_text_answer = answer_value
-                                
-                                answer, _ = Answer.objects.update_or_create(
-                                    response=response_set,
-                                    question=question,
-                                    defaults={
-                                        'text_answer': final_text_answer,
-                                        'integer_answer': answer_value if question.qtype == 'int' else None,
-                                        'decimal_answer': answer_value if question.qtype == 'dec' else None,
-                                        'bool_answer': answer_value if question.qtype == 'bool' else None,
-                                        'date_answer': answer_value if question.qtype == 'date' else None,
-                                    }
-                                )
-                                if question.qtype in ['single', 'multi', 'likert']:
-                                    if answer_value:
-                                        if not isinstance(answer_value, list):
-                                            answer_value = [answer_value]
-                                        
-                                        pks = [val.split('__')[0] for val in answer_value if '__' in val]
-                                        answer.options.set(pks)
-                                    else:
-                                        answer.options.clear()
-                                elif question.qtype == 'ubicacion':
-                                    if answer_value:
-                                        answer.selected_ubicaciones.set([answer_value])
-                                    else:
-                                        answer.selected_ubicaciones.clear()
-                    
-                    del request.session['survey_answers']
-                    del request.session['respondent_data']
+                if is_last_section:
+                    # --- SAVE TO DB LOGIC ---
+                    survey_answers[str(current_section.pk)] = section_answers
+                    save_survey_response(
+                        survey, draft.respondent_data, survey_answers, user=request.user, data_protection_accepted=True,
+                    )
+
+                    discard_draft(draft)
                     messages.success(request, '¡Encuesta guardada exitosamente!')
-                    return render(request, 'surveys/survey_complete.html', {'survey': survey})
+                    response = render(request, 'surveys/survey_complete.html', {'survey': survey})
+                    return clear_draft_cookie(response, survey)
                 else:
+                    save_draft_section(draft, current_section.pk, section_answers)
                     next_section_idx = current_section_idx + 1
                     return redirect(f"{url}?section={next_section_idx}")
             else:
                 # Re-render section step with errors
-                questions_before = 0
-                for i in range(current_section_idx):
-                    questions_before += sections[i].questions.count()
                 context = {
                     'survey': survey,
                     'section': current_section,
                     'answers_form': answers_form,
                     'current_section_idx': current_section_idx,
-                    'total_sections': len(sections),
+                    'total_sections': total_sections,
                     'is_respondent_step': False,
                     'data_protection_clause_text': settings.DATA_PROTECTION_CLAUSE_TEXT,
-                    'questions_before': questions_before,
+                    'questions_before': survey.questions_before(current_section_idx),
+                    'catalog_version': get_catalog_version(),
                 }
                 return render(request, 'surveys/survey_fill_steps.html', context)
 
     # GET request logic
     if is_respondent_step:
-        respondent_form = ResponseSetForm(initial=request.session.get('respondent_data', {}), document_types=DOCUMENT_TYPES, user=request.user)
+        respondent_form = ResponseSetForm(initial=draft.respondent_data if draft else {}, document_types=DOCUMENT_TYPES, user=request.user)
         context = {
             'survey': survey,
             'respondent_form': respondent_form,
@@ -463,11 +454,10 @@ def survey_fill(request, survey_code):
             'previous_section_url': None,  # No previous step
         }
     else:
-        current_section_idx = int(request.GET.get('section', 0))
-        if not sections.exists() or current_section_idx >= len(sections):
+        current_section_idx = _requested_section_index(request)
+        current_section = survey.section_at(current_section_idx)
+        if current_section is None:
             return redirect('surveys:list')
-        
-        current_section = sections[current_section_idx]
 
         # Calculate previous section URL
         previous_section_url = None
@@ -477,19 +467,21 @@ def survey_fill(request, survey_code):
             # The step before the first section is the respondent info step
             previous_section_url = f"{url}?from_section=0"
 
+        survey_answers = draft_answers(draft)
+
         # Lógica para copiar respuestas de preguntas anteriores
-        initial_data = request.session.get('survey_answers', {}).get(str(current_section.pk), {})
-        for question in current_section.questions.all():
+        initial_data = survey_answers.get(str(current_section.pk), {})
+        for question in current_section.questions:
             if question.copy_from:
                 source_field_name = question.copy_from
                 copied_value = None
 
                 # Buscar en los datos del encuestado
-                if source_field_name in request.session.get('respondent_data', {}):
-                    copied_value = request.session['respondent_data'][source_field_name]
+                if source_field_name in draft.respondent_data:
+                    copied_value = draft.respondent_data[source_field_name]
                 else:
                     # Buscar en las respuestas de otras preguntas
-                    for section_id, answers in request.session.get('survey_answers', {}).items():
+                    for section_id, answers in survey_answers.items():
                         if source_field_name in answers:
                             copied_value = answers[source_field_name]
                             break
@@ -500,9 +492,8 @@ def survey_fill(request, survey_code):
         AnswersForm = build_answers_form_for_section(current_section)
         answers_form = AnswersForm(initial=initial_data)
         # --- New logic to pass all previous answers for dependency checks ---
-        import json
         all_previous_answers = {}
-        for section_id, answers in request.session.get('survey_answers', {}).items():
+        for section_id, answers in survey_answers.items():
             for field_name, value in answers.items():
                 if field_name.startswith('question_'):
                     parts = field_name.split('_')
@@ -516,38 +507,268 @@ def survey_fill(request, survey_code):
 
         initial_data_json = json.dumps(initial_data)
 
-        questions_before = 0
-        for i in range(current_section_idx):
-            questions_before += sections[i].questions.count()
-
         context = {
             'survey': survey,
             'section': current_section,
             'answers_form': answers_form,
             'current_section_idx': current_section_idx,
-            'total_sections': len(sections),
+            'total_sections': total_sections,
             'is_respondent_step': False,
             'data_protection_clause_text': settings.DATA_PROTECTION_CLAUSE_TEXT,
             'previous_section_url': previous_section_url,
             'previous_answers_json': previous_answers_json,
             'initial_data_json': initial_data_json,
-            'questions_before': questions_before,
+            'questions_before': survey.questions_before(current_section_idx),
+            'catalog_version': get_catalog_version(),
         }
     
-    return render(request, 'surveys/survey_fill_steps.html', context)
+    response = render(request, 'surveys/survey_fill_steps.html', context)
+    return clear_draft_cookie(response, survey) if reset_draft else response
+
+def survey_fill_single(request, survey_code):
+    """Single-page fill mode: the whole schema is downloaded once and sections are navigated client-side."""
+    survey = get_schema_or_404(survey_code, active_only=True)
+    context = {
+        'survey': survey,
+        'respondent_form': ResponseSetForm(document_types=DOCUMENT_TYPES, user=request.user),
+        'data_protection_clause_text': settings.DATA_PROTECTION_CLAUSE_TEXT,
+        'catalog_version': get_catalog_version(),
+    }
+    return render(request, 'surveys/survey_fill_single.html', context)
+
+def survey_schema_json(request, survey_code):
+    survey = get_schema_or_404(survey_code, active_only=True)
+    etag = f'"{survey.id}-{survey.version}"'
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(schema_json(survey), content_type='application/json')
+    response['ETag'] = etag
+    # Always revalidate: the ETag changes as soon as the survey is edited
+    response['Cache-Control'] = 'public, max-age=0, must-revalidate'
+    return response
+
+def _submission_data(answers):
+    # Mimic request.POST so the section forms see exactly what the wizard would send
+    data = MultiValueDict()
+    for key, value in (answers or {}).items():
+        if value is None or value is False:
+            continue
+        if value is True:
+            value = 'on'
+        values = value if isinstance(value, list) else [value]
+        data.setlist(key, [str(v) for v in values])
+    return data
+
+def submission_shape_error(payload):
+    """Message for a submission whose payload, ``respondent`` or ``answers`` is not an object, else None."""
+    if not isinstance(payload, dict):
+        return 'El envío debe ser un objeto JSON.'
+    if not isinstance(payload.get('respondent') or {}, dict):
+        return 'Los datos del encuestado deben ser un objeto JSON.'
+    if not isinstance(payload.get('answers') or {}, dict):
+        return 'Las respuestas deben ser un objeto JSON.'
+    return None
+
+def validate_submission(survey, payload, user):
+    """
+    Validate a complete submission (respondent data plus every section) with the same
+    forms the wizard uses. Returns ``(respondent_data, survey_answers, errors)``.
+    """
+    errors = {}
+    respondent_form = ResponseSetForm(payload.get('respondent') or {}, document_types=DOCUMENT_TYPES, user=user)
+    respondent_data = None
+    if respondent_form.is_valid():
+        respondent_data = cleaned_data_to_json(respondent_form.cleaned_data)
+    else:
+        errors['respondent'] = respondent_form.errors.get_json_data()
+
+    data = _submission_data(payload.get('answers'))
+    inactive = inactive_questions(get_dependency_evaluator(survey), survey, state_from_data(data))
+    survey_answers = {}
+    section_errors = {}
+    for section in survey.sections:
+        answers_form = build_answers_form_for_section(section)(data, inactive_questions=inactive)
+        if answers_form.is_valid():
+            survey_answers[str(section.pk)] = section_answers_to_json(section, answers_form, inactive)
+        else:
+            section_errors[str(section.pk)] = answers_form.errors.get_json_data()
+    if section_errors:
+        errors['sections'] = section_errors
+    return respondent_data, survey_answers, errors
+
+@require_POST
+def survey_submit(request, survey_code):
+    survey = get_schema_or_404(survey_code, active_only=True)
+    try:
+        payload = json.loads(request.body)
+    except (ValueError, UnicodeDecodeError):
+        return JsonResponse({'ok': False, 'message': 'El contenido enviado no es JSON válido.'}, status=400)
+    shape_error = submission_shape_error(payload)
+    if shape_error:
+        return JsonResponse({'ok': False, 'message': shape_error}, status=400)
+
+    if not payload.get('data_protection_accepted'):
+        return JsonResponse({'ok': False, 'message': 'Debes aceptar la cláusula de protección de datos para continuar.'}, status=400)
+
+    respondent_data, survey_answers, errors = validate_submission(survey, payload, request.user)
+    if errors:
+        return JsonResponse({'ok': False, 'message': 'Hay respuestas con errores.', 'errors': errors}, status=400)
+
+    is_duplicate = ResponseSet.objects.filter(
+        survey_id=survey.id,
+        identificacion=respondent_data.get('identificacion'),
+        document_type=respondent_data.get('document_type'),
+    ).exists()
+    if is_duplicate:
+        return JsonResponse({'ok': False, 'duplicate': True, 'message': 'Esta persona ya respondió esta encuesta.'}, status=409)
+
+    response_set = save_survey_response(
+        survey, respondent_data, survey_answers, user=request.user, data_protection_accepted=True,
+    )
+    return JsonResponse({'ok': True, 'response_id': response_set.pk, 'message': '¡Encuesta guardada exitosamente!'})
+
+# Upper bound of queued responses accepted by one sync request
+SYNC_MAX_BATCH = getattr(settings, 'SURVEYS_SYNC_MAX_BATCH', 200)
+
+@require_POST
+def sync_responses(request):
+    """
+    Batch endpoint of the offline mode: validates and saves the responses queued on
+    the device and returns one result per item (created, duplicate or invalid).
+    """
+    try:
+        payload = json.loads(request.body)
+    except (ValueError, UnicodeDecodeError):
+        return JsonResponse({'ok': False, 'message': 'El contenido enviado no es JSON válido.'}, status=400)
+
+    items = payload.get('responses') if isinstance(payload, dict) else None
+    if not isinstance(items, list):
+        return JsonResponse({'ok': False, 'message': 'Falta la lista de respuestas.'}, status=400)
+    if len(items) > SYNC_MAX_BATCH:
+        return JsonResponse({'ok': False, 'message': f'Se permiten máximo {SYNC_MAX_BATCH} respuestas por envío.'}, status=400)
+
+    results = [None] * len(items)
+    pending = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[index] = {'client_id': None, 'status': 'invalid', 'message': 'Elemento no válido.'}
+            continue
+        client_id = item.get('client_id')
+        shape_error = submission_shape_error(item)
+        if shape_error:
+            results[index] = {'client_id': client_id, 'status': 'invalid', 'message': shape_error}
+            continue
+        survey = get_survey_schema_by_code(str(item.get('survey') or ''))
+        if survey is None or not survey.is_active:
+            results[index] = {'client_id': client_id, 'status': 'invalid', 'message': 'No se encontró la encuesta.'}
+            continue
+        if not item.get('data_protection_accepted'):
+            results[index] = {'client_id': client_id, 'status': 'invalid', 'message': 'No se aceptó la cláusula de protección de datos.'}
+            continue
+        respondent_data, survey_answers, errors = validate_submission(survey, item, request.user)
+        if errors:
+            results[index] = {'client_id': client_id, 'status': 'invalid', 'message': 'Hay respuestas con errores.', 'errors': errors}
+            continue
+        key = (survey.id, respondent_data.get('identificacion'), respondent_data.get('document_type'))
+        pending.append((index, client_id, key, survey, respondent_data, survey_answers))
+
+    # One query finds the respondents that already answered; repeats inside the batch count too
+    existing = set(ResponseSet.objects.filter(
+        survey_id__in={entry[2][0] for entry in pending},
+        identificacion__in={entry[2][1] for entry in pending},
+    ).values_list('survey_id', 'identificacion', 'document_type')) if pending else set()
+    to_save = []
+    for entry in pending:
+        index, client_id, key = entry[:3]
+        if key in existing:
+            results[index] = {'client_id': client_id, 'status': 'duplicate', 'message': 'Esta persona ya respondió esta encuesta.'}
+        else:
+            existing.add(key)
+            to_save.append(entry)
+
+    try:
+        response_ids = save_survey_responses(
+            [(survey, respondent_data, survey_answers) for _, _, _, survey, respondent_data, survey_answers in to_save],
+            user=request.user,
+        )
+    except IntegrityError:
+        # Another request saved one of these respondents meanwhile; the device retries the whole batch
+        return JsonResponse({'ok': False, 'message': 'Conflicto al guardar, intenta sincronizar de nuevo.'}, status=409)
+
+    for (index, client_id, *_), response_id in zip(to_save, response_ids):
+        results[index] = {'client_id': client_id, 'status': 'created', 'response_id': response_id}
+    return JsonResponse({'ok': True, 'results': results})
+
+def location_catalog(request):
+    """Municipios with their ubicaciones (loc/zona included), loaded once per page and catalog version."""
+    return catalog_bundle_response(request)
+
+def service_worker(request):
+    # Served from the site root so its scope covers every survey page
+    response = render(request, 'surveys/service_worker.js', content_type='application/javascript')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+@login_required
+def metrics_view(request):
+    if not request.user.is_staff:
+        return HttpResponseForbidden("Acceso no autorizado.")
+    return HttpResponse(metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 def get_ubicaciones(request):
-    municipio_id = request.GET.get('municipio_id')
-    ubicaciones = Ubicacion.objects.filter(municipio_id=municipio_id).order_by('nombre')
-    return JsonResponse(list(ubicaciones.values('id', 'nombre')), safe=False)
+    try:
+        municipio_id = int(request.GET.get('municipio_id'))
+    except (TypeError, ValueError):
+        return JsonResponse([], safe=False)
+    return municipio_ubicaciones_response(request, municipio_id)
+
+def search_ubicaciones_view(request):
+    """Typeahead over ubicacion nombre/codigo, accent- and case-insensitive."""
+    try:
+        municipio_id = int(request.GET['municipio_id']) if request.GET.get('municipio_id') else None
+        limit = min(max(int(request.GET.get('limit', SEARCH_DEFAULT_LIMIT)), 1), SEARCH_MAX_LIMIT)
+    except (TypeError, ValueError):
+        return JsonResponse([], safe=False)
+    results = search_ubicaciones(request.GET.get('q', ''), municipio_id, limit)
+    response = JsonResponse(results, safe=False)
+    response['Cache-Control'] = 'private, max-age=60'
+    return response
+
+def locate_ubicacion_view(request):
+    """Ubicacion whose barrio polygon contains the device's ``lat``/``lon``."""
+    try:
+        lat = float(request.GET['lat'])
+        lon = float(request.GET['lon'])
+    except (KeyError, TypeError, ValueError):
+        return JsonResponse({'found': False, 'message': 'Coordenadas inválidas.'}, status=400)
+    ubicacion = locate_ubicacion(lat, lon)
+    if ubicacion is None:
+        return JsonResponse({'found': False, 'message': 'No se encontró un barrio para esta ubicación.'}, status=404)
+    return JsonResponse({'found': True, **ubicacion})
+
+def map_manifest(request):
+    """
+    Index of the map payloads written by build_map_topology. The payloads themselves
+    have content-hashed names and can be cached forever; only this file is revalidated.
+    """
+    try:
+        with open(map_manifest_path(), 'rb') as f:
+            body = f.read()
+    except FileNotFoundError:
+        raise Http404("El mapa todavía no ha sido generado.")
+    response = HttpResponse(body, content_type='application/json')
+    response['Cache-Control'] = 'public, max-age=300'
+    return response
 
 def get_ubicacion_details(request):
-    ubicacion_id = request.GET.get('ubicacion_id')
-    ubicacion = get_object_or_404(Ubicacion, pk=ubicacion_id)
-    return JsonResponse({'loc': ubicacion.loc, 'zona': ubicacion.zona})
+    # Kept for older clients; the fill pages read loc/zona from the catalog bundle
+    ubicacion = get_catalog().ubicacion(request.GET.get('ubicacion_id'))
+    if ubicacion is None:
+        raise Http404
+    return JsonResponse({'loc': ubicacion[2], 'zona': ubicacion[3]})
 
-from django.db.models import Count, Avg, Min, Max, Q
-from django.db.models.functions import TruncDay
+from django.db.models import Count, Max, Q, Prefetch, Sum
 
 @login_required
 def dashboard_view(request):
@@ -555,15 +776,28 @@ def dashboard_view(request):
         messages.error(request, "Acceso no autorizado.")
         return redirect('surveys:list')
     total_surveys = Survey.objects.count()
-    total_responses = ResponseSet.objects.count()
     total_interviewers = Interviewer.objects.count()
 
-    # Anotar cada encuesta con sus estadísticas relevantes
-    surveys_stats = Survey.objects.annotate(
-        response_count=Count('responses'),
-        interviewer_count=Count('responses__interviewer', distinct=True),
-        last_response_date=Max('responses__created_at')
-    ).order_by('-last_response_date')
+    # Conteos leídos de los rollups diarios, no de las respuestas
+    rollups = {
+        row['survey_id']: row
+        for row in ResponseDayRollup.objects.values('survey_id').annotate(
+            response_count=Sum('responses'), last_response_date=Max('last_response_at'),
+        )
+    }
+    interviewer_counts = dict(
+        InterviewerDayRollup.objects.filter(responses__gt=0).values_list('survey_id')
+        .annotate(Count('interviewer', distinct=True))
+    )
+    surveys_stats = list(Survey.objects.all())
+    for survey in surveys_stats:
+        row = rollups.get(survey.pk, {})
+        survey.response_count = row.get('response_count') or 0
+        survey.last_response_date = row.get('last_response_date') if survey.response_count else None
+        survey.interviewer_count = interviewer_counts.get(survey.pk, 0)
+    # Igual que order_by('-last_response_date'): las encuestas sin respuestas al final
+    surveys_stats.sort(key=lambda survey: (survey.last_response_date is not None, survey.last_response_date or 0), reverse=True)
+    total_responses = sum(survey.response_count for survey in surveys_stats)
 
     # Anotar cada encuestador con el número de respuestas y la fecha de la última respuesta
     # interviewers_stats = Interviewer.objects.annotate(
@@ -572,14 +806,14 @@ def dashboard_view(request):
     # ).order_by('-response_count', 'full_name')
 
     # Nuevo: Obtener estadísticas agrupadas por encuestador y luego por encuesta
-    interviewer_survey_stats = ResponseSet.objects.filter(interviewer__isnull=False).values(
+    interviewer_survey_stats = InterviewerDayRollup.objects.values(
         'interviewer__full_name',
         'interviewer__document_type',
         'interviewer__document_number',
         'survey__name'
     ).annotate(
-        count=Count('id')
-    ).order_by('interviewer__full_name', 'survey__name')
+        count=Sum('responses')
+    ).filter(count__gt=0).order_by('interviewer__full_name', 'survey__name')
 
     # Agrupar los resultados en una estructura anidada para la plantilla
     grouped_stats = {}
@@ -613,102 +847,229 @@ def dashboard_view(request):
 
 from datetime import datetime
 
-@login_required
-def survey_stats_view(request, survey_code):
-    if not request.user.is_staff:
-        messages.error(request, "Acceso no autorizado.")
-        return redirect('surveys:list')
-    survey = get_object_or_404(Survey, code=survey_code)
-    
-    # Date range filter
+NOT_APPLICABLE_LABEL = 'No aplica'
+
+def _stats_date_range(request):
+    """``(start, end, start_str, end_str)`` of the ``start_date``/``end_date`` filter; dates or None."""
     start_date_str = request.GET.get('start_date')
     end_date_str = request.GET.get('end_date')
-    
-    response_sets = ResponseSet.objects.filter(survey=survey)
-    
-    if start_date_str:
-        start_date = datetime.strptime(start_date_str, '%Y-%m-%d')
-        response_sets = response_sets.filter(created_at__gte=start_date)
-        
-    if end_date_str:
-        end_date = datetime.strptime(end_date_str, '%Y-%m-%d')
-        response_sets = response_sets.filter(created_at__lte=end_date)
+    start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date() if start_date_str else None
+    end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date() if end_date_str else None
+    return start_date, end_date, start_date_str, end_date_str
 
-    response_count = response_sets.count()
-    
-    # Get response counts by interviewer for this survey
-    interviewer_response_counts = response_sets.values('interviewer__full_name').annotate(count=Count('id')).order_by('-count')
+def _response_sets_between(survey, start_date, end_date):
+    """Responses of ``survey`` from the day ``start_date`` through the day ``end_date`` (either may be None)."""
+    since, until = datetime_bounds(start_date, end_date)
+    response_sets = ResponseSet.objects.filter(survey_id=survey.id)
+
+    if since:
+        response_sets = response_sets.filter(created_at__gte=since)
 
-    questions = Question.objects.filter(section__survey=survey).order_by('section__order', 'order')
+    if until:
+        response_sets = response_sets.filter(created_at__lt=until)
+    return response_sets
 
-    # Overall stats
+def _stats_bins(request):
+    try:
+        return min(max(int(request.GET.get('bins', DEFAULT_BINS)), 2), MAX_BINS)
+    except ValueError:
+        return DEFAULT_BINS
+
+def _question_stats_data(survey, section, start_date, end_date, bins):
+    """Cards of the stats page for the questions of ``section``, in the shape survey_stats_section.html renders."""
+    questions = section.questions
+    # Everything but the distributions reads the per-day rollups, not the answers
+    count = response_count(survey, start_date, end_date)
+    coverage = question_coverage(survey, count, start_date, end_date, questions)
+    per_question = question_stats(survey, start_date, end_date, questions)
+    # Quartiles and histograms need the raw values; cached until the next response
+    distributions = distribution_stats(survey, start_date, end_date, bins, section=section)
     stats_data = []
     for q in questions:
         q_stats = {
             'text': q.text,
             'type': q.qtype,
-            'data': None
+            'data': None,
+            'distribution': distributions.get(q.id),
+            'coverage': coverage[q.id],
         }
         
-        if q.qtype in [QuestionType.SINGLE, QuestionType.MULTI, QuestionType.LIKERT]:
-            options_with_counts = []
-            # Usamos anotaciones de Django para contar las respuestas por opción
-            options = q.options.all().annotate(count=Count('selected_in', filter=models.Q(selected_in__response__in=response_sets))).order_by('-count')
-            total_votes = sum(opt.count for opt in options)
-            
-            for option in options:
-                percentage = (option.count / total_votes * 100) if total_votes > 0 else 0
-                options_with_counts.append({
-                    'label': option.label,
-                    'count': option.count,
-                    'percentage': round(percentage, 2)
-                })
-            
-            q_stats['data'] = {'options': options_with_counts, 'total_votes': total_votes}
-
-        elif q.qtype in [QuestionType.INTEGER, QuestionType.DECIMAL]:
-            agg_field = 'integer_answer' if q.qtype == QuestionType.INTEGER else 'decimal_answer'
-            result = Answer.objects.filter(question=q, response__in=response_sets).aggregate(
-                avg=Avg(agg_field),
-                min=Min(agg_field),
-                max=Max(agg_field)
-            )
-            # Redondear el promedio si no es nulo
-            if result['avg'] is not None:
-                result['avg'] = round(result['avg'], 2)
-            q_stats['data'] = result
-
-        elif q.qtype == QuestionType.BOOL:
-            counts = Answer.objects.filter(question=q, response__in=response_sets).values('bool_answer').annotate(count=Count('id'))
-            result = {'true': 0, 'false': 0}
-            for item in counts:
-                if item['bool_answer'] == True:
-                    result['true'] = item['count']
-                elif item['bool_answer'] == False:
-                    result['false'] = item['count']
-            q_stats['data'] = result
+        data = per_question.get(q.id)
+        if q.qtype == QuestionType.UBICACION:
+            data = {
+                'ubicaciones': sorted(data['by_ubicacion'].values(), key=lambda b: -b['responses'])[:10],
+                'zonas': sorted(({'zona': zona, **b} for zona, b in data['by_zona'].items()), key=lambda b: -b['responses']),
+                'map_url': reverse('surveys:location_stats', kwargs={'survey_code': survey.code}) + f"?question={q.id}",
+            }
+        q_stats['data'] = data
 
         stats_data.append(q_stats)
+    return stats_data
 
-    # Chart data
-    daily_counts = response_sets.annotate(day=TruncDay('created_at')).values('day').annotate(count=Count('id')).order_by('day')
+@login_required
+def survey_stats_view(request, survey_code):
+    """
+    Skeleton of the stats page: the response totals (from the rollups) and one
+    placeholder per section, filled in by the browser from ``survey_stats_section``.
+    """
+    if not request.user.is_staff:
+        messages.error(request, "Acceso no autorizado.")
+        return redirect('surveys:list')
+    survey = get_schema_or_404(survey_code)
     
-    chart_labels = [d['day'].strftime('%Y-%m-%d') for d in daily_counts]
-    chart_data = [d['count'] for d in daily_counts]
+    # Date range filter; both ends are included
+    start_date, end_date, start_date_str, end_date_str = _stats_date_range(request)
+
+    total, daily_counts, interviewer_response_counts = response_totals(survey, start_date, end_date)
+
+    # Chart data
+    chart_labels = [day.strftime('%Y-%m-%d') for day, _ in daily_counts]
+    chart_data = [count for _, count in daily_counts]
 
     context = {
         'survey': survey,
-        'response_count': response_count,
+        'response_count': total,
+        'crosstab_questions': [q for q in survey.questions if q.qtype in CROSSTAB_TYPES],
         'interviewer_response_counts': interviewer_response_counts,
-        'stats_data': stats_data,
         'start_date': start_date_str,
         'end_date': end_date_str,
+        'bins': _stats_bins(request),
         'chart_labels': chart_labels,
         'chart_data': chart_data,
     }
     return render(request, 'surveys/survey_stats.html', context)
 
 
+@login_required
+def survey_stats_section(request, survey_code, section_id):
+    """
+    Question cards of one section of the stats page as an HTML fragment, cached on its
+    own per filter until the survey gets a new response.
+    """
+    if not request.user.is_staff:
+        return HttpResponseForbidden("Acceso no autorizado.")
+    survey = get_schema_or_404(survey_code)
+    try:
+        section = survey.section(section_id)
+    except KeyError:
+        return JsonResponse({'error': 'La sección no pertenece a esta encuesta.'}, status=404)
+    try:
+        start_date, end_date, _, _ = _stats_date_range(request)
+    except ValueError:
+        return JsonResponse({'error': 'Las fechas deben tener el formato AAAA-MM-DD.'}, status=400)
+    bins = _stats_bins(request)
+
+    html = cached_stats(
+        survey, f'section:{section.id}', (start_date, end_date, bins),
+        lambda: render_to_string('surveys/survey_stats_section.html', {
+            'stats_data': _question_stats_data(survey, section, start_date, end_date, bins),
+        }),
+    )
+    return JsonResponse({'section': section.id, 'html': html})
+
+
+@login_required
+def survey_location_stats(request, survey_code):
+    """
+    Responses (and, with ``by``, option distributions) per ubicacion, zona and municipio
+    for a UBICACION question, keyed by Ubicacion id for the choropleth map.
+    """
+    if not request.user.is_staff:
+        return HttpResponseForbidden("Acceso no autorizado.")
+    survey = get_schema_or_404(survey_code)
+    try:
+        if request.GET.get('question'):
+            question = survey.question(request.GET['question'])
+        else:
+            question = next(iter(location_questions(survey)), None)
+        by_question = survey.question(request.GET['by']) if request.GET.get('by') else None
+    except (KeyError, TypeError, ValueError):
+        return JsonResponse({'error': 'La pregunta no pertenece a esta encuesta.'}, status=404)
+    if question is None or question.qtype != QuestionType.UBICACION:
+        return JsonResponse({'error': 'La encuesta no tiene esa pregunta de ubicación.'}, status=404)
+    if by_question is not None and not by_question.options:
+        return JsonResponse({'error': 'La pregunta de desglose debe tener opciones.'}, status=400)
+    try:
+        start_date, end_date, _, _ = _stats_date_range(request)
+    except ValueError:
+        return JsonResponse({'error': 'Las fechas deben tener el formato AAAA-MM-DD.'}, status=400)
+
+    data = location_rollup(_response_sets_between(survey, start_date, end_date), question, by_question)
+    data['survey'] = survey.code
+    return JsonResponse(data)
+
+@login_required
+def survey_crosstab(request, survey_code):
+    """Contingency table, percentages and chi-square of question ``row`` by question ``col``."""
+    if not request.user.is_staff:
+        return HttpResponseForbidden("Acceso no autorizado.")
+    survey = get_schema_or_404(survey_code)
+    try:
+        row_question = survey.question(request.GET['row'])
+        col_question = survey.question(request.GET['col'])
+    except (KeyError, TypeError, ValueError):
+        return JsonResponse({'error': 'La pregunta no pertenece a esta encuesta.'}, status=404)
+    if row_question.qtype not in CROSSTAB_TYPES or col_question.qtype not in CROSSTAB_TYPES:
+        return JsonResponse({'error': 'Este tipo de pregunta no se puede cruzar.'}, status=400)
+    try:
+        bins = min(max(int(request.GET.get('bins', DEFAULT_BINS)), 2), MAX_BINS)
+    except ValueError:
+        return JsonResponse({'error': 'El número de rangos no es válido.'}, status=400)
+    try:
+        start_date, end_date, _, _ = _stats_date_range(request)
+    except ValueError:
+        return JsonResponse({'error': 'Las fechas deben tener el formato AAAA-MM-DD.'}, status=400)
+
+    matrix = current_matrix(survey)
+    if matrix is not None:
+        # Same bounds as _response_sets_between, read from the memory-mapped store
+        rows = matrix.rows_between(*datetime_bounds(start_date, end_date))
+        data = matrix_crosstab(matrix, rows, row_question, col_question, bins=bins)
+    else:
+        data = crosstab(_response_sets_between(survey, start_date, end_date), row_question, col_question, bins=bins)
+    data['survey'] = survey.code
+    return JsonResponse(data)
+
+@login_required
+def survey_time_series(request, survey_code):
+    """
+    Responses per hour, day, week or month (``granularity``) in the local time zone,
+    optionally broken down ``by`` interviewer or by the ubicacion of a UBICACION ``question``.
+    """
+    if not request.user.is_staff:
+        return HttpResponseForbidden("Acceso no autorizado.")
+    survey = get_schema_or_404(survey_code)
+    granularity = request.GET.get('granularity', 'day')
+    by = request.GET.get('by') or None
+    if granularity not in GRANULARITIES:
+        return JsonResponse({'error': 'La granularidad debe ser hour, day, week o month.'}, status=400)
+    if by is not None and by not in BREAKDOWNS:
+        return JsonResponse({'error': 'El desglose debe ser interviewer o ubicacion.'}, status=400)
+    question = None
+    if by == 'ubicacion':
+        try:
+            if request.GET.get('question'):
+                question = survey.question(request.GET['question'])
+            else:
+                question = next(iter(location_questions(survey)), None)
+        except (KeyError, TypeError, ValueError):
+            return JsonResponse({'error': 'La pregunta no pertenece a esta encuesta.'}, status=404)
+        if question is None or question.qtype != QuestionType.UBICACION:
+            return JsonResponse({'error': 'La encuesta no tiene esa pregunta de ubicación.'}, status=404)
+    try:
+        start_date, end_date, start_date_str, end_date_str = _stats_date_range(request)
+    except ValueError:
+        return JsonResponse({'error': 'Las fechas deben tener el formato AAAA-MM-DD.'}, status=400)
+
+    try:
+        data = time_series(survey, granularity, start_date, end_date, by=by, question=question)
+    except ValueError:
+        return JsonResponse({'error': 'El rango es demasiado largo para esta granularidad.'}, status=400)
+    data.update({'survey': survey.code, 'start_date': start_date_str, 'end_date': end_date_str})
+    if question is not None:
+        data['question'] = {'id': question.id, 'text': question.text}
+    return JsonResponse(data)
+
 def get_question_dependency_data(request):
 
 
@@ -1498,18 +1859,18 @@ def download_example_template(request):
 
 @login_required
 def export_survey_responses_excel(request, survey_code):
-    survey = get_object_or_404(Survey, code=survey_code)
+    survey = get_schema_or_404(survey_code)
     
     # Obtener todas las respuestas para esta encuesta
-    response_sets = ResponseSet.objects.filter(survey=survey).prefetch_related(
+    response_sets = ResponseSet.objects.filter(survey_id=survey.id).select_related('interviewer').prefetch_related(
         'answers', 
-        'answers__question', 
         'answers__options',
-        'answers__selected_ubicaciones'
+        Prefetch('answers__selected_ubicaciones', queryset=Ubicacion.objects.defer('geometry'))
     ).order_by('created_at')
 
     # Obtener todas las preguntas de la encuesta en orden
-    questions = Question.objects.filter(section__survey=survey).order_by('section__order', 'order')
+    questions = survey.questions
+    evaluator = get_dependency_evaluator(survey)
 
     # Definir las columnas básicas del encuestado
     base_columns = [
@@ -1539,11 +1900,16 @@ def export_survey_responses_excel(request, survey_code):
         }
         
         # Crear un diccionario de respuestas para este conjunto para un acceso rápido
-        answers_map = {a.question.id: a for a in r_set.answers.all()}
+        answers_map = {a.question_id: a for a in r_set.answers.all()}
+        active = evaluator.active_questions(state_from_answers(answers_map.values()))
         
         for q in questions:
             header = question_headers[q.id]
             answer = answers_map.get(q.id)
+
+            if q.id not in active:
+                row[header] = NOT_APPLICABLE_LABEL # Oculta por sus dependencias
+                continue
             
             if not answer:
                 row[header] = '' # Dejar en blanco si no hay respuesta